@@ -19,6 +19,9 @@ const int ECHO2 = 33;
 const int MAX_WAIT = 20000;
 double sonic = 331.5 + (0.6 * 25); // 気温25℃のとき
 int turnDelayTime = 1300;
+// straight / back の区間がこの時間 (ms) で終わらなければ、進めない (通行止め・障害物) とみなす
+const unsigned long SEGMENT_TIMEOUT_MS = 15000;
+unsigned long segmentStartedAt = 0;
 
 // ==================
 // 状態管理
@@ -30,12 +33,51 @@ bool ignoringWallCheck = true;
 // ==================
 // コマンド格納用
 // ==================
-// 例: "straight,left,straight,right" などを分割して配列に入れる
-#define MAX_COMMANDS 100
-String commandList[MAX_COMMANDS];
+// 命令番号 (バックエンドの motor_program.py と同じ) と、命令ごとの旋回時間 (ms) を配列に入れる
+// 例: "straight,left,straight,right" -> {0, 2, 0, 1}
+#define MAX_COMMANDS 1024
+const uint8_t OP_STRAIGHT = 0;
+const uint8_t OP_RIGHT = 1;
+const uint8_t OP_LEFT = 2;
+const uint8_t OP_STOP = 3;
+const uint8_t OP_BACK = 4;
+const char *OP_NAMES[] = {"straight", "right", "left", "stop", "back"};
+uint8_t commandOps[MAX_COMMANDS];
+uint16_t commandDelays[MAX_COMMANDS];
 int commandCount = 0;
 int currentIndex = 0;
 
+// ==================
+// 2進プログラムの受信 (バックエンドの motor_program.py と同じ形式)
+// ==================
+// フレーム: [0xA6][種類][seq][n][payload n バイト][チェックサム (種類・seq・n・payload の XOR)]
+//   BEGIN (0x10): [版][id][本体の長さ u16][命令数 u16][既定の旋回時間 u16][CRC-16 u16]  (u16 はリトルエンディアン)
+//   CHUNK (0x11): [id][開始位置 u16][本体の一部]
+//   END   (0x12): [id]  CRC-16/CCITT を確かめてから命令を展開して走り出す
+//   STOP  (0x13): 停止
+// 本体は1命令1バイト (bit0〜2 = 命令番号、bit7 が立っていれば続く2バイトがその命令の旋回時間)。
+// 返事: "ACK id 受け取った長さ" / "NAK id 期待している開始位置" / "OK id 命令数" / "ERR id 理由"
+// 命令が MAX_COMMANDS より多いプログラムは切り詰めずに "ERR id too_many" を返し、走らせない。
+const uint8_t PROGRAM_MAGIC = 0xA6;
+const uint8_t PROGRAM_VERSION = 1;
+const uint8_t FRAME_BEGIN = 0x10;
+const uint8_t FRAME_CHUNK = 0x11;
+const uint8_t FRAME_END = 0x12;
+const uint8_t FRAME_STOP = 0x13;
+#define MAX_PROGRAM_BYTES 4096
+uint8_t programBuf[MAX_PROGRAM_BYTES];
+int programId = -1;
+uint16_t programLength = 0;
+uint16_t programReceived = 0;
+uint16_t programSteps = 0;
+uint16_t programDefaultDelay = 0;
+uint16_t programCrc = 0;
+// 途中で切れたフレームの残りを捨てている間は true (次の 0xA6 が来るか、受信が途切れるまで)
+// 残りのバイトを文字列の命令として読むと、知らない命令が stop になって走行中のプログラムを置き換えてしまう
+const unsigned long FRAME_RESYNC_QUIET_MS = 200;
+bool resyncingFrame = false;
+unsigned long resyncLastByteAt = 0;
+
 // ==================
 // プロトタイプ
 // ==================
@@ -46,13 +88,17 @@ void leftTurnMotor();
 void stopMotor();
 double read_distance1();
 double read_distance2();
-void executeCommand(const String &cmd);
+void executeCommand(int index);
 void moveToNextCommandIfNeeded();
+bool handleProgramFrame();
+void discardPartialFrame();
+void stopAll();
 
 void setup()
 {
     Serial.begin(115200);
     SerialBT.begin("ESP32_Motordenkouchidou");
+    SerialBT.setTimeout(100); // フレームの残りを待つ最大時間 (ms)
     Serial.println("Bluetooth Serial started. Waiting for commands...");
 
     pinMode(m1Pin1, OUTPUT);
@@ -79,7 +125,24 @@ void loop()
     // =======================
     // 1) 新しいコマンド列(一行)が届いたら受け取り、解析する
     // =======================
-    if (SerialBT.available())
+    // 途中で切れたフレームの残りは捨てる (文字列の命令としては読まない)
+    if (resyncingFrame)
+    {
+        discardPartialFrame();
+    }
+
+    // 先頭が 0xA6 なら2進プログラムのフレーム (届いている分をまとめて処理する)
+    while (!resyncingFrame && SerialBT.available() && SerialBT.peek() == PROGRAM_MAGIC)
+    {
+        SerialBT.read();
+        if (!handleProgramFrame())
+        {
+            resyncingFrame = true;
+            resyncLastByteAt = millis();
+        }
+    }
+
+    if (!resyncingFrame && SerialBT.available())
     {
         // 1) 新しい行を読み込む
         String line = SerialBT.readStringUntil('\n');
@@ -102,18 +165,14 @@ void loop()
         // 2) stopコマンドの特例
         if (line == "stop")
         {
-            stopMotor();
-            running = false;
-            turning = false;
-            ignoringWallCheck = true;
-            commandCount = 0;
-            currentIndex = 0;
+            stopAll();
             return; // 関数抜け
         }
 
-        // 3) 新しい行をパースして commandList[] を再構築
+        // 3) 新しい行をパースして commandOps[] / commandDelays[] を再構築
         commandCount = 0;
         currentIndex = 0;
+        bool tooMany = false; // MAX_COMMANDS を超えた (切り詰めて走らせず、止まる)
         if (line.length() > 0)
         {
             int startIdx = 0;
@@ -125,9 +184,17 @@ void loop()
                     // 最後の要素
                     String cmd = line.substring(startIdx);
                     cmd.trim();
-                    if (cmd.length() > 0 && commandCount < MAX_COMMANDS)
+                    if (cmd.length() > 0)
                     {
-                        commandList[commandCount++] = cmd;
+                        if (commandCount < MAX_COMMANDS)
+                        {
+                            commandDelays[commandCount] = turnDelayTime;
+                            commandOps[commandCount++] = opcodeOf(cmd);
+                        }
+                        else
+                        {
+                            tooMany = true;
+                        }
                     }
                     break;
                 }
@@ -135,21 +202,35 @@ void loop()
                 {
                     String cmd = line.substring(startIdx, commaPos);
                     cmd.trim();
-                    if (cmd.length() > 0 && commandCount < MAX_COMMANDS)
+                    if (cmd.length() > 0)
                     {
-                        commandList[commandCount++] = cmd;
+                        if (commandCount < MAX_COMMANDS)
+                        {
+                            commandDelays[commandCount] = turnDelayTime;
+                            commandOps[commandCount++] = opcodeOf(cmd);
+                        }
+                        else
+                        {
+                            tooMany = true;
+                        }
                     }
                     startIdx = commaPos + 1;
                 }
             }
         }
+        if (tooMany)
+        {
+            Serial.println("Too many commands, program ignored");
+            stopAll();
+            return;
+        }
         Serial.print("Parsed commandCount = ");
         Serial.println(commandCount);
 
         // 4) コマンド数が1以上あれば最初を実行
         if (commandCount > 0)
         {
-            executeCommand(commandList[0]);
+            executeCommand(0);
         }
     }
 
@@ -161,14 +242,31 @@ void loop()
     {
         double dist1 = read_distance1();
         double dist2 = read_distance2();
+        // 距離はバックエンドにも送る (telemetry.py)
         Serial.print("dist1: ");
         Serial.println(dist1);
         Serial.print("dist2: ");
         Serial.println(dist2);
+        SerialBT.print("dist1: ");
+        SerialBT.println(dist1);
+        SerialBT.print("dist2: ");
+        SerialBT.println(dist2);
         Serial.print("ignoringWallCheck: ");
         Serial.println(ignoringWallCheck);
 
-        if (ignoringWallCheck)
+        if (millis() - segmentStartedAt > SEGMENT_TIMEOUT_MS)
+        {
+            // 区間が終わらない -> 止まってバックエンドに知らせ ("BLOCKED <番号>")、
+            // 今の位置から引き直した新しいプログラムを待つ (残りの命令は実行しない)
+            Serial.println("Segment timeout → Blocked");
+            SerialBT.print("BLOCKED ");
+            SerialBT.println(currentIndex);
+            stopMotor();
+            running = false;
+            turning = false;
+            ignoringWallCheck = true;
+        }
+        else if (ignoringWallCheck)
         {
             // まだ壁を見つけていない状態
             if (dist1 <= 13.0 && dist2 <= 13.0)
@@ -183,6 +281,8 @@ void loop()
             if (dist1 > 25.0 || dist2 > 25.0)
             {
                 Serial.println("No Wall → Stop and move to next command");
+                SerialBT.print("STOP ");
+                SerialBT.println(currentIndex);
                 stopMotor();
                 delay(500);
                 running = false;
@@ -200,72 +300,321 @@ void loop()
     delay(200);
 }
 
+// =======================
+// テキストのコマンド名 -> 命令番号
+// =======================
+uint8_t opcodeOf(const String &cmd)
+{
+    if (cmd == "straight") return OP_STRAIGHT;
+    if (cmd == "right") return OP_RIGHT;
+    if (cmd == "left") return OP_LEFT;
+    if (cmd == "back") return OP_BACK;
+    return OP_STOP;
+}
+
+// =======================
+// 停止してコマンド列を捨てる
+// =======================
+void stopAll()
+{
+    stopMotor();
+    running = false;
+    turning = false;
+    ignoringWallCheck = true;
+    commandCount = 0;
+    currentIndex = 0;
+}
+
+// =======================
+// CRC-16/CCITT (初期値 0xFFFF、多項式 0x1021)
+// =======================
+uint16_t crc16(const uint8_t *data, int len)
+{
+    uint16_t crc = 0xFFFF;
+    for (int i = 0; i < len; i++)
+    {
+        crc ^= (uint16_t)data[i] << 8;
+        for (int b = 0; b < 8; b++)
+        {
+            crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+        }
+    }
+    return crc;
+}
+
+uint16_t readU16(const uint8_t *p)
+{
+    return p[0] | ((uint16_t)p[1] << 8);
+}
+
+void replyProgram(const char *kind, int id, long value)
+{
+    SerialBT.print(kind);
+    SerialBT.print(" ");
+    SerialBT.print(id);
+    SerialBT.print(" ");
+    SerialBT.println(value);
+}
+
+// 本体の命令数を数える (旋回時間つきの命令は3バイト)
+int countProgramSteps()
+{
+    int steps = 0;
+    int i = 0;
+    while (i < programLength)
+    {
+        i += (programBuf[i] & 0x80) ? 3 : 1;
+        steps++;
+    }
+    return steps;
+}
+
+void replyError(int id, const char *reason)
+{
+    SerialBT.print("ERR ");
+    SerialBT.print(id);
+    SerialBT.print(" ");
+    SerialBT.println(reason);
+}
+
+// =======================
+// 途中で切れたフレームの残りを、次の 0xA6 が来るか受信が FRAME_RESYNC_QUIET_MS 途切れるまで捨てる
+// =======================
+void discardPartialFrame()
+{
+    while (SerialBT.available() && SerialBT.peek() != PROGRAM_MAGIC)
+    {
+        SerialBT.read();
+        resyncLastByteAt = millis();
+    }
+    if (SerialBT.available() || millis() - resyncLastByteAt >= FRAME_RESYNC_QUIET_MS)
+    {
+        resyncingFrame = false;
+    }
+}
+
+// フレームが途中で切れた (readBytes がタイムアウトした)。受信中のプログラムがあれば NAK で送り直してもらう
+void replyTruncatedFrame()
+{
+    Serial.println("[BT] program frame truncated");
+    if (programId >= 0 && programReceived < programLength)
+    {
+        replyProgram("NAK", programId, programReceived);
+    }
+}
+
+// =======================
+// 2進プログラムのフレームを1つ読んで処理する (先頭の 0xA6 は読み済み)
+// フレームが途中で切れていたら false (残りのバイトは呼び出し側で捨てる)
+// =======================
+bool handleProgramFrame()
+{
+    uint8_t header[3];
+    uint8_t payload[256];
+    uint8_t checksum;
+    if (SerialBT.readBytes(header, 3) != 3)
+    {
+        replyTruncatedFrame();
+        return false;
+    }
+    uint8_t kind = header[0];
+    uint8_t seq = header[1];
+    uint8_t n = header[2];
+    if (SerialBT.readBytes(payload, n) != n || SerialBT.readBytes(&checksum, 1) != 1)
+    {
+        replyTruncatedFrame();
+        return false;
+    }
+
+    uint8_t c = kind ^ seq ^ n;
+    for (int k = 0; k < n; k++) c ^= payload[k];
+    if (c != checksum)
+    {
+        // 壊れたフレームは捨てる (CHUNK なら次の CHUNK で NAK が返る)
+        Serial.println("[BT] program frame checksum mismatch");
+        return true;
+    }
+
+    if (kind == FRAME_BEGIN && n >= 12)
+    {
+        int id = payload[1];
+        if (payload[0] != PROGRAM_VERSION)
+        {
+            replyError(id, "version");
+            return true;
+        }
+        uint16_t length = readU16(payload + 2);
+        if (length > MAX_PROGRAM_BYTES)
+        {
+            replyError(id, "too_long");
+            return true;
+        }
+        if (readU16(payload + 4) > MAX_COMMANDS)
+        {
+            replyError(id, "too_many");
+            return true;
+        }
+        programId = id;
+        programLength = length;
+        programSteps = readU16(payload + 4);
+        programDefaultDelay = readU16(payload + 6);
+        programCrc = readU16(payload + 8);
+        programReceived = 0;
+        replyProgram("ACK", id, 0);
+    }
+    else if (kind == FRAME_CHUNK && n >= 3)
+    {
+        int id = payload[0];
+        uint16_t offset = readU16(payload + 1);
+        int size = n - 3;
+        if (id != programId)
+        {
+            replyError(id, "unknown");
+            return true;
+        }
+        if (offset != programReceived || programReceived + size > programLength)
+        {
+            replyProgram("NAK", id, programReceived);
+            return true;
+        }
+        memcpy(programBuf + programReceived, payload + 3, size);
+        programReceived += size;
+        replyProgram("ACK", id, programReceived);
+    }
+    else if (kind == FRAME_END && n >= 1)
+    {
+        int id = payload[0];
+        if (id != programId || programReceived != programLength)
+        {
+            replyError(id, "incomplete");
+            return true;
+        }
+        if (crc16(programBuf, programLength) != programCrc)
+        {
+            replyError(id, "checksum");
+            return true;
+        }
+        if (countProgramSteps() > MAX_COMMANDS)
+        {
+            // 命令の配列に入りきらない (一部だけ走らせることはしない)
+            replyError(id, "too_many");
+            return true;
+        }
+        // 本体を命令の配列に展開して走り出す
+        stopAll();
+        int i = 0;
+        while (i < programLength)
+        {
+            uint8_t b = programBuf[i++];
+            uint16_t d = programDefaultDelay;
+            if (b & 0x80)
+            {
+                if (i + 2 > programLength) break;
+                d = readU16(programBuf + i);
+                i += 2;
+            }
+            commandOps[commandCount] = b & 0x07;
+            commandDelays[commandCount++] = d;
+        }
+        replyProgram("OK", id, commandCount);
+        Serial.print("Program loaded, commandCount = ");
+        Serial.println(commandCount);
+        if (commandCount > 0)
+        {
+            executeCommand(0);
+        }
+    }
+    else if (kind == FRAME_STOP)
+    {
+        stopAll();
+    }
+    return true;
+}
+
 // =======================
 // コマンドを実行する関数
 // =======================
-void executeCommand(const String &cmd)
+void executeCommand(int index)
 {
+    uint8_t op = commandOps[index];
     Serial.print("Execute Command: ");
-    Serial.println(cmd);
-
-    if (cmd == "straight")
+    Serial.println(op);
+    // 区間の始まりをバックエンドに知らせる ("STEP <番号> <命令>")
+    SerialBT.print("STEP ");
+    SerialBT.print(index);
+    SerialBT.print(" ");
+    SerialBT.println(op <= OP_BACK ? OP_NAMES[op] : "stop");
+
+    if (op == OP_STRAIGHT)
     {
         forwardMotor();
+        segmentStartedAt = millis();
         running = true;
         turning = false;
         ignoringWallCheck = true;
     }
-    else if (cmd == "back")
+    else if (op == OP_BACK)
     {
         backwardMotor();
+        segmentStartedAt = millis();
         running = true;
         turning = false;
         ignoringWallCheck = true;
     }
-    else if (cmd == "left")
+    else if (op == OP_LEFT)
     {
         leftTurnMotor();
         running = false;
         turning = true;
         ignoringWallCheck = true; // 旋回中は壁チェックしない
-        delay(turnDelayTime);
+        delay(commandDelays[index]);
         stopMotor();
         turning = false;
         ignoringWallCheck = true;
 
         // 次のコマンドが straight でない場合は追加する
-        if (currentIndex < commandCount - 1 && commandList[currentIndex + 1] != "straight")
+        if (currentIndex < commandCount - 1 && commandOps[currentIndex + 1] != OP_STRAIGHT)
         {
             Serial.println("Auto-inserting 'straight' after left turn");
-            commandList[currentIndex + 1] = "straight";
+            commandOps[currentIndex + 1] = OP_STRAIGHT;
         }
 
         moveToNextCommandIfNeeded();
     }
 
-    else if (cmd == "right")
+    else if (op == OP_RIGHT)
     {
         rightTurnMotor();
         running = false;
         turning = true;
         ignoringWallCheck = true;
-        delay(turnDelayTime);
+        delay(commandDelays[index]);
         stopMotor();
         turning = false;
         ignoringWallCheck = true;
 
         // 次のコマンドが straight でない場合は追加する
-        if (currentIndex < commandCount - 1 && commandList[currentIndex + 1] != "straight")
+        if (currentIndex < commandCount - 1 && commandOps[currentIndex + 1] != OP_STRAIGHT)
         {
             // Serial.println("Auto-inserting 'straight' after right turn");
-            // commandList[currentIndex + 1] = "straight";
+            // commandOps[currentIndex + 1] = OP_STRAIGHT;
         }
 
         moveToNextCommandIfNeeded();
     }
+    else if (op == OP_STOP)
+    {
+        // プログラムの途中の stop は、その命令の旋回時間だけその場で待つ (複数台の計画の待ち合わせ)
+        stopMotor();
+        running = false;
+        turning = false;
+        ignoringWallCheck = true;
+        delay(commandDelays[index]);
+        moveToNextCommandIfNeeded();
+    }
     else
     {
-        // "stop" など未知コマンドの場合はとりあえず停止
+        // 未知コマンドの場合はとりあえず停止
         stopMotor();
         running = false;
         turning = false;
@@ -283,11 +632,12 @@ void moveToNextCommandIfNeeded()
     if (currentIndex < commandCount)
     {
         // 次コマンドを実行
-        executeCommand(commandList[currentIndex]);
+        executeCommand(currentIndex);
     }
     else
     {
         Serial.println("All commands finished");
+        SerialBT.println("All commands finished");
         // すべて終わったら念のため停止
         stopMotor();
         running = false;
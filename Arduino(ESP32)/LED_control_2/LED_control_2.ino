@@ -10,6 +10,7 @@ bool ledStates[numLeds] = {false};
 void setup() {
   SerialBT.begin("ESP32_LED_Control_2_ver2");
   Serial.begin(115200);  // シリアルモニタ用の通信速度を設定
+  SerialBT.setTimeout(100);  // フレームの残りを待つ最大時間 (ms)
 
   // すべてのピンを出力モードに設定し、初期状態を消灯
   for (int i = 0; i < numLeds; i++) {
@@ -20,10 +21,78 @@ void setup() {
   Serial.println("ESP32 is ready to receive signals!");
 }
 
+// =========================
+// 2進フレーム (バックエンドの led_frames.py と同じ形式)
+// =========================
+// [0xA5][種類][seq][n][payload n バイト][チェックサム (種類・seq・n・payload の XOR)]
+//   FULL  (0x01): payload = 点灯状態のビットマスク (LED 0 が先頭バイトの bit0)
+//   DELTA (0x02): payload = [基準の seq][変更...] (変更は bit7 = 点灯/消灯、bit0〜6 = LED 番号)
+// DELTA の基準の seq が最後に適用した seq と違うときは適用せず "RESYNC" を返して FULL を待つ。
+const uint8_t FRAME_MAGIC = 0xA5;
+const uint8_t FRAME_FULL = 0x01;
+const uint8_t FRAME_DELTA = 0x02;
+int lastSeq = -1;  // 最後に適用したフレームの seq (-1 なら FULL 待ち)
+
+void handleFrame() {
+  uint8_t header[3];
+  if (SerialBT.readBytes(header, 3) != 3) return;
+  uint8_t kind = header[0];
+  uint8_t seq = header[1];
+  uint8_t n = header[2];
+  uint8_t payload[256];
+  uint8_t checksum;
+  if (SerialBT.readBytes(payload, n) != n) return;
+  if (SerialBT.readBytes(&checksum, 1) != 1) return;
+
+  uint8_t c = kind ^ seq ^ n;
+  for (int k = 0; k < n; k++) c ^= payload[k];
+  if (c != checksum) {
+    requestResync();
+    return;
+  }
+
+  if (kind == FRAME_FULL) {
+    for (int i = 0; i < numLeds; i++) {
+      bool on = (i >> 3) < n && ((payload[i >> 3] >> (i & 7)) & 1);
+      setLed(i, on);
+    }
+    lastSeq = seq;
+  } else if (kind == FRAME_DELTA) {
+    if (n == 0 || payload[0] != lastSeq) {
+      requestResync();
+      return;
+    }
+    for (int k = 1; k < n; k++) {
+      int i = payload[k] & 0x7F;
+      if (i < numLeds) setLed(i, payload[k] & 0x80);
+    }
+    lastSeq = seq;
+  }
+}
+
+void requestResync() {
+  lastSeq = -1;
+  SerialBT.println("RESYNC");
+}
+
+// 状態が変わるときだけ書き込む (点いたままの LED はちらつかない)
+void setLed(int i, bool on) {
+  if (ledStates[i] != on) {
+    ledStates[i] = on;
+    digitalWrite(ledPins[i], on ? HIGH : LOW);
+  }
+}
+
 void loop() {
   // Bluetooth経由で信号を受信
   Serial.println("ESP32 is ready to receive signals!");
   if (SerialBT.available()) {
+    // 先頭が 0xA5 なら2進フレーム
+    if (SerialBT.peek() == FRAME_MAGIC) {
+      SerialBT.read();
+      handleFrame();
+      return;
+    }
     String input = SerialBT.readStringUntil('\n'); // 信号を1行分受信
     input.trim(); // 不要な空白や改行を削除
 
@@ -68,5 +137,6 @@ void resetAllLeds() {
     digitalWrite(ledPins[i], LOW);
     ledStates[i] = false; // 状態をリセット
   }
+  lastSeq = -1;
   Serial.println("All LEDs have been reset.");
 }
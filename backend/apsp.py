@@ -0,0 +1,125 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# =========================
+# 全点対最短距離テーブル
+# =========================
+# ベースグラフは起動後に変わらないので、全ノード間の最短距離を起動時に
+# NumPy の V×V 行列として計算しておき、問い合わせは表引き + 経路復元だけにする。
+# 同距離の前駆ノードは行列から「dist[s][u] + w(u, v) == dist[s][v] となる隣接 u」として
+# その場で求めるので、前駆ノードの表は持たない。
+# メモリは V×V×8 バイトなので、数千ノードまでのマップ向け。
+# 通行止めが start -> goal の最短経路にかかるときは、その始点の行だけを探索し直し、
+# (通行止めの集合, 始点) ごとに REPAIRED_ROWS 行まで覚えておく。同じ通行止めで同じ始点の問い合わせ
+# (別の goal や、続きのページ) は、直した行の表引きになる。
+REPAIRED_ROWS = 256
+
+
+class RowPredecessors:
+    """
+    始点 s の距離行 row から、prev_nodes[v] (同距離の前駆ノードのリスト) を必要になった分だけ作る。
+    blocked に入っているエッジは使わない。iter_all_paths / count_all_paths にそのまま渡せる。
+    """
+
+    def __init__(self, csr, row, source, blocked=None):
+        self._csr = csr
+        self._row = row
+        self._source = source
+        self._blocked = blocked.slots if blocked else None
+        self._memo = {}
+
+    def __getitem__(self, v):
+        preds = self._memo.get(v)
+        if preds is not None:
+            return preds
+        row = self._row
+        dv = row[v]
+        preds = []
+        if v != self._source and dv != float("inf"):
+            csr = self._csr
+            indices = csr._indices_mv
+            weights = csr._weights_mv
+            blocked = self._blocked
+            for k in range(csr._indptr_mv[v], csr._indptr_mv[v + 1]):
+                if blocked is not None and k in blocked:
+                    continue
+                u = indices[k]
+                if row[u] + weights[k] == dv:
+                    preds.append(u)
+            # dijkstra で確定する順 (距離, 番号) に並べ、CSRGraph.dijkstra と同じ順番にする
+            preds.sort(key=lambda u: (row[u], u))
+        self._memo[v] = preds
+        return preds
+
+
+class AllPairsTable:
+    """
+    CSRGraph の全点対最短距離テーブル。
+    query() は通行止めエッジ (BlockedEdges) が最短経路に関係しなければ表引きだけで答え、
+    関係するときだけその始点の行を探索し直し (減分更新)、通行止めの集合ごとに使い回す。
+    """
+
+    def __init__(self, csr):
+        self.csr = csr
+        n = csr.num_nodes
+        self.dist = np.full((n, n), np.inf, dtype=np.float64)
+        for s in range(n):
+            row, _ = csr.dijkstra(s)
+            self.dist[s] = row
+        # 各 CSR スロット (u -> v) の u 側。影響判定のベクトル計算に使う
+        self._slot_src = np.repeat(np.arange(n, dtype=np.int64), np.diff(csr.indptr))
+        self.repairs = 0        # 探索し直した行の数
+        self.repair_hits = 0    # 直した行を使い回した回数
+        self._repaired = OrderedDict()  # (通行止めのスロット, 始点) -> (dist, prev)
+        # PLANNER_MODE = "thread" のときは複数スレッドから使われる
+        self._lock = threading.Lock()
+
+    def _blocked_edges(self, blocked):
+        """blocked の各スロットを (u, v, w) の配列にする。"""
+        slots = np.fromiter(blocked.slots, dtype=np.int64, count=len(blocked.slots))
+        return self._slot_src[slots], self.csr.indices[slots].astype(np.int64), self.csr.weights[slots]
+
+    def _goal_affected(self, start, goal, blocked):
+        D = self.dist
+        total = D[start, goal]
+        if total == np.inf:
+            return False  # もともと到達できない
+        # 3つの和は total と足す順が違うので、丸めの分だけ余裕を持たせて比べる (CSRGraph.astar と同じ許容幅)
+        tolerance = 1e-9 * max(1.0, total)
+        for u, v, w in zip(*self._blocked_edges(blocked)):
+            if abs(D[start, u] + w + D[v, goal] - total) <= tolerance:
+                return True
+        return False
+
+    def repaired_row(self, start, blocked):
+        """通行止めを反映した start の行 (dist, prev)。同じ通行止めで前に直した行があれば使い回す。"""
+        key = (blocked.slots, start)
+        with self._lock:
+            row = self._repaired.get(key)
+            if row is not None:
+                self._repaired.move_to_end(key)
+                self.repair_hits += 1
+                return row
+        row = self.csr.dijkstra(start, blocked)
+        with self._lock:
+            self._repaired[key] = row
+            self.repairs += 1
+            while len(self._repaired) > REPAIRED_ROWS:
+                self._repaired.popitem(last=False)
+        return row
+
+    def query(self, start, goal, blocked=None):
+        """
+        CSRGraph.dijkstra(start, blocked) と同じ形 (dist, prev_nodes) を返す。
+        goal までの最短経路が通行止めに関係しなければ表の行をそのまま使い、
+        関係するときは start の行だけを直す (repaired_row)。
+        表の行を使ったときは、dist が正しいのは goal (と影響のない終点) だけ。
+        """
+        if blocked and self._goal_affected(start, goal, blocked):
+            return self.repaired_row(start, blocked)
+        # goal までの距離は変わらないので、通行止めを避けた同距離の経路だけをたどればよい
+        # (通行止めで行き止まりになった枝は iter_all_paths / count_all_paths が 0 本として扱う)
+        row = self.dist[start].tolist()
+        return row, RowPredecessors(self.csr, row, start, blocked)
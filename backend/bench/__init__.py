@@ -0,0 +1,7 @@
+# =========================
+# 経路計算パイプラインのベンチマーク
+# =========================
+# 使い方 (backend ディレクトリで):
+#   python -m bench.run --maps grid road geometric --sizes 100 1000 10000 --out bench.json
+#   python -m bench.run --baseline bench.json   (前回の結果と比べて遅くなった段階を報告)
+#   python -m bench.loadgen --simulate --clients 8   (WebSocket サーバーの負荷試験)
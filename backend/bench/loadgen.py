@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import websockets
+
+from candidate_codec import ENCODINGS, decode_binary, expand_paths
+from map_loader import load_map
+from simulator.devices import SPP_BPS
+from simulator.run import MAP_FILE, create_devices, device_env, summarize
+
+# =========================
+# WebSocket サーバーの負荷試験
+# =========================
+# p5_test.js と同じ話し方をするクライアントを N 個同時につなぎ、それぞれが
+#   {"start", "goal", "remove_edges"} を送る -> 候補経路を受け取る (candidates)
+#   -> {"selected_path": ..., "ack": true} を送る -> "selection_applied" を受け取る (selection)
+# を繰り返す。request_id は付けない (1接続で問い合わせは1件ずつ、p5_test.js と同じ)。
+# --encoding compact / binary で、候補経路の小さな表現 (candidate_codec) を受け取る。
+# --simulate を付けると、同じプロセスで擬似端末のデバイス (simulator) とサーバーを起動し、
+# 選択した経路が LED に表示されるまで (led_applied)、車がプログラムを受け取るまで (motor_accepted) も測る
+# (シリアルの遅さ・バックプレッシャー込みの時間)。
+# 使い方 (backend ディレクトリで):
+#   python -m bench.loadgen --url ws://localhost:8765 --clients 8 --duration 20
+#   python -m bench.loadgen --simulate --clients 8 --duration 20 --out load.json
+
+
+class Workload:
+    """
+    問い合わせの (start, goal, remove_edges) を作る。
+    hot_ratio の割合は少数のよく使う組 (キャッシュに当たる)、残りはランダムな組で、
+    通行止めの数は remove_weights の重み (0本, 1本, 2本, ...) で選ぶ。
+    """
+
+    def __init__(self, names, edges, seed=0, hot_pairs=16, hot_ratio=0.5,
+                 remove_weights=(0.5, 0.3, 0.15, 0.05)):
+        self.names = names
+        self.edges = edges
+        self.rng = random.Random(seed)
+        self.hot_ratio = hot_ratio
+        self.remove_weights = remove_weights
+        self.hot = [self._fresh() for _ in range(hot_pairs)]
+
+    @classmethod
+    def from_map(cls, path, **kwargs):
+        csr = load_map(path).csr
+        names = csr.names
+        edges = [f"{names[u]}-{names[int(v)]}"
+                 for u in range(len(names)) for v in csr.indices[csr.indptr[u]:csr.indptr[u + 1]] if u < v]
+        return cls(names, edges, **kwargs)
+
+    def _fresh(self):
+        start, goal = self.rng.sample(self.names, 2)
+        n_remove = self.rng.choices(range(len(self.remove_weights)), self.remove_weights)[0]
+        return start, goal, self.rng.sample(self.edges, min(n_remove, len(self.edges)))
+
+    def next(self):
+        if self.hot and self.rng.random() < self.hot_ratio:
+            return self.rng.choice(self.hot)
+        return self._fresh()
+
+
+class LoadStats:
+    def __init__(self):
+        self.samples = {"candidates": [], "selection": []}
+        self.cycles = 0
+        self.route_errors = 0
+        self.protocol_errors = 0
+        self.candidates_received = 0
+
+
+async def run_client(url, workload, stats, deadline, rng, think_ms, select_ms, encoding="json", on_selected=None):
+    """1つの操作端末。deadline (loop.time()) まで問い合わせと選択を繰り返す。"""
+    loop = asyncio.get_running_loop()
+    async with websockets.connect(url, max_size=None) as ws:
+        while loop.time() < deadline:
+            start, goal, remove_edges = workload.next()
+            t0 = time.perf_counter()
+            request = {"start": start, "goal": goal, "remove_edges": remove_edges}
+            if encoding != "json":
+                request["encoding"] = encoding
+            await ws.send(json.dumps(request))
+            response = await ws.recv()
+            response = decode_binary(response) if isinstance(response, bytes) else json.loads(response)
+            if "leaves" in response:
+                # compact / binary: ノード番号の経路に戻す (選択もノード番号のまま返す)
+                response["candidate_paths"] = expand_paths(response["parent"], response["node"], response["leaves"])
+            stats.samples["candidates"].append((time.perf_counter() - t0) * 1000)
+            if "error" in response:
+                stats.route_errors += 1
+                continue
+            candidates = response["candidate_paths"]
+            stats.candidates_received += len(candidates)
+            if select_ms:
+                await asyncio.sleep(rng.uniform(0, 2 * select_ms) / 1000)  # 操作者が選ぶ時間
+            selected = rng.choice(candidates)
+            t1 = time.perf_counter()
+            if on_selected is not None:
+                on_selected(selected, t1)
+            await ws.send(json.dumps({"selected_path": selected, "ack": True}))
+            reply = json.loads(await ws.recv())
+            if reply.get("type") != "selection_applied":
+                stats.protocol_errors += 1
+                continue
+            stats.samples["selection"].append((time.perf_counter() - t1) * 1000)
+            stats.cycles += 1
+            if think_ms:
+                await asyncio.sleep(rng.uniform(0, 2 * think_ms) / 1000)
+
+
+class DeviceTracker:
+    """
+    --simulate のとき、選択した経路がデバイスに反映されるまでの時間を測る。
+    選択ごとに期待する状態 (LED のエッジ番号の集合 / 車の命令列) を送った順に覚えておき、
+    デバイスの状態がそれと一致したらその時刻を記録する。それより前の選択で
+    まだ反映されていないものは、新しい選択に追い越された (superseded) として数える。
+    """
+
+    def __init__(self, server, devices):
+        self.server = server
+        self.leds = [d for name, d in devices.items() if name != "motor"]
+        self.car = devices.get("motor")
+        self.pending = {"led_applied": [], "motor_accepted": []}  # [(送った時刻, 期待する状態), ...]
+        self.samples = {"led_applied": [], "motor_accepted": []}
+        self.superseded = {"led_applied": 0, "motor_accepted": 0}
+        for device in devices.values():
+            device.hooks.append(self.hook)
+
+    def on_selected(self, path, t):
+        if path and isinstance(path[0], int):
+            path = [self.server.BASE_CSR.names[node] for node in path]
+        self.pending["led_applied"].append((t, frozenset(self.server.BASE_CSR.path_edge_numbers(path))))
+        if self.car is not None:
+            index_path = [self.server.BASE_CSR.index[node] for node in path]
+            actions = self.server.TURN_TABLE.compile_actions([index_path])[0]
+            self.pending["motor_accepted"].append((t, tuple(actions)))
+
+    def hook(self, device, kind, t):
+        if kind == "led_frame":
+            lit = frozenset(n for led in self.leds for n in led.lit)
+            self._resolve("led_applied", lit, t)
+        elif kind == "program":
+            self._resolve("motor_accepted", tuple(op for op, _ in self.car.receiver.steps), t)
+
+    def _resolve(self, key, state, t):
+        pending = self.pending[key]
+        last = max((i for i, (_, expected) in enumerate(pending) if expected == state), default=None)
+        if last is None:
+            return
+        for sent, expected in pending[:last + 1]:
+            if expected == state:
+                self.samples[key].append((t - sent) * 1000)
+            else:
+                self.superseded[key] += 1
+        del pending[:last + 1]
+
+
+async def start_simulated_server(args):
+    """擬似端末のデバイスと dijkstra のサーバーを起動し、(server モジュール, devices, ws サーバー) を返す。"""
+    devices = create_devices(args)
+    for device in devices.values():
+        device.start()
+    os.environ.update(device_env(devices))
+    os.environ["ESP32_OPEN_WAIT"] = "0"
+    import dijkstra  # 環境変数を設定してから読み込む
+    await dijkstra.init_serial()
+    ws_server = await websockets.serve(dijkstra.handle_connection, "localhost", args.port, max_size=None)
+    return dijkstra, devices, ws_server
+
+
+async def stop_simulated_server(server, devices, ws_server):
+    ws_server.close()
+    await ws_server.wait_closed()
+    for reader in (server.reader_motor, server.reader_led1, server.reader_led2):
+        if reader is not None:
+            reader.close()
+    for writer in (server.writer_motor, server.writer_led1, server.writer_led2):
+        if writer is not None:
+            await writer.close()
+    for device in devices.values():
+        device.close()
+
+
+async def run_load(args):
+    workload = Workload.from_map(args.map, seed=args.seed, hot_pairs=args.hot_pairs, hot_ratio=args.hot_ratio)
+    stats = LoadStats()
+    tracker = None
+    url = args.url
+    if args.simulate:
+        server, devices, ws_server = await start_simulated_server(args)
+        tracker = DeviceTracker(server, devices)
+        url = f"ws://localhost:{args.port}"
+
+    loop = asyncio.get_running_loop()
+    t_start = time.perf_counter()
+    deadline = loop.time() + args.duration
+    clients = [run_client(url, workload, stats, deadline, random.Random(args.seed + i),
+                          args.think_ms, args.select_ms, args.encoding, tracker.on_selected if tracker else None)
+               for i in range(args.clients)]
+    try:
+        await asyncio.gather(*clients)
+        if tracker is not None:
+            await asyncio.sleep(args.drain)  # 最後の選択がデバイスに届くのを待つ
+    finally:
+        elapsed = time.perf_counter() - t_start
+        report = {
+            "meta": {"url": url, "clients": args.clients, "duration_s": args.duration, "think_ms": args.think_ms,
+                     "select_ms": args.select_ms, "encoding": args.encoding, "hot_ratio": args.hot_ratio, "seed": args.seed,
+                     "map": os.path.basename(args.map), "simulate": args.simulate},
+            "cycles": stats.cycles,
+            "throughput_rps": round(len(stats.samples["candidates"]) / elapsed, 2),
+            "cycles_per_s": round(stats.cycles / elapsed, 2),
+            "route_errors": stats.route_errors,
+            "protocol_errors": stats.protocol_errors,
+            "avg_candidates": round(stats.candidates_received / max(1, stats.cycles), 2),
+            "latency": {phase: summarize(values) for phase, values in stats.samples.items()}
+        }
+        if tracker is not None:
+            report["latency"].update({key: summarize(values) for key, values in tracker.samples.items()})
+            report["superseded"] = tracker.superseded
+            report["server_stats"] = server.collect_stats()
+            report["devices"] = {name: d.stats() for name, d in devices.items()}
+            await stop_simulated_server(server, devices, ws_server)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="WebSocket サーバーの負荷試験 (p5_test.js と同じ話し方のクライアントを同時に動かす)")
+    parser.add_argument("--url", default="ws://localhost:8765", help="試験するサーバー (--simulate のときは使わない)")
+    parser.add_argument("--clients", type=int, default=8, help="同時につなぐクライアントの数")
+    parser.add_argument("--duration", type=float, default=10.0, help="試験の秒数")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="1回の問い合わせのあとに待つ平均時間 (ms)")
+    parser.add_argument("--select-ms", type=float, default=0.0, help="候補を受け取ってから選ぶまでの平均時間 (ms)")
+    parser.add_argument("--encoding", choices=ENCODINGS, default="json", help="候補経路の受け取り方")
+    parser.add_argument("--hot-ratio", type=float, default=0.5, help="よく使う start/goal の組を送る割合")
+    parser.add_argument("--hot-pairs", type=int, default=16, help="よく使う組の数")
+    parser.add_argument("--map", default=MAP_FILE, help="start/goal/remove_edges を選ぶマップファイル")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="結果の JSON を書き出すファイル")
+    simulate = parser.add_argument_group("シミュレータ (--simulate)")
+    simulate.add_argument("--simulate", action="store_true",
+                          help="擬似端末のデバイスとサーバーを同じプロセスで起動して試験する")
+    simulate.add_argument("--port", type=int, default=8767, help="起動するサーバーのポート")
+    simulate.add_argument("--link-bps", type=float, default=SPP_BPS)
+    simulate.add_argument("--stall-prob", type=float, default=0.0)
+    simulate.add_argument("--stall-ms", type=float, default=0.0)
+    simulate.add_argument("--segment-ms", type=float, default=2000.0)
+    simulate.add_argument("--time-scale", type=float, default=1.0)
+    simulate.add_argument("--drain", type=float, default=2.0, help="終了後、デバイスへの反映を待つ秒数")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_load(args))
+    for phase, row in report["latency"].items():
+        print(f"{phase:<15} " + "  ".join(f"{k}={v}" for k, v in row.items()), file=sys.stderr)
+    print(f"throughput {report['throughput_rps']} req/s, {report['cycles_per_s']} cycles/s", file=sys.stderr)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import math
+
+import numpy as np
+
+from csr_graph import CSRGraph
+
+# =========================
+# ベンチマーク用の大きなマップ生成
+# =========================
+# どの生成関数も (names, xy, edge_list) を返す。
+#   names:     ["v0", "v1", ...]
+#   xy:        (V, 2) の座標配列
+#   edge_list: [(u, v, 重み, エッジ番号), ...] (無向、エッジ番号は 1 から順番)
+# 重みは整数にしておく (同じ距離の経路の判定が dijkstra_all と同じになるように)。
+
+
+def _finish(n, xy, pairs, weights):
+    names = [f"v{i}" for i in range(n)]
+    edge_list = [
+        (int(u), int(v), int(w), k + 1)
+        for k, ((u, v), w) in enumerate(zip(pairs, weights))
+    ]
+    return names, np.asarray(xy, dtype=np.float64), edge_list
+
+
+def grid_map(n_nodes, seed=0):
+    """一辺 ≒ sqrt(n_nodes) の格子。重みはすべて 1 (同じ距離の経路が非常に多い)。"""
+    side = max(2, int(round(math.sqrt(n_nodes))))
+    n = side * side
+    idx = np.arange(n).reshape(side, side)
+    horizontal = np.stack([idx[:, :-1].ravel(), idx[:, 1:].ravel()], axis=1)
+    vertical = np.stack([idx[:-1, :].ravel(), idx[1:, :].ravel()], axis=1)
+    pairs = np.concatenate([horizontal, vertical])
+    xy = np.stack([idx % side * 2, idx // side * 2], axis=-1).reshape(n, 2)
+    return _finish(n, xy, pairs, np.ones(len(pairs), dtype=np.int64))
+
+
+def road_map(n_nodes, seed=0, drop=0.1):
+    """
+    道路網風のマップ: 座標を少しずらした格子から drop の割合でエッジを抜き、
+    重みを 1〜4 (デモのマップと同じ範囲) にする。
+    """
+    rng = np.random.default_rng(seed)
+    names, xy, edge_list = grid_map(n_nodes, seed)
+    n = len(names)
+    xy = xy + rng.uniform(-0.3, 0.3, size=xy.shape)
+    pairs = np.array([(u, v) for u, v, _, _ in edge_list])
+    keep = rng.random(len(pairs)) >= drop
+    pairs = pairs[keep]
+    weights = rng.integers(1, 5, size=len(pairs))
+    return _finish(n, xy, pairs, weights)
+
+
+def geometric_map(n_nodes, seed=0, degree=6.0):
+    """
+    ランダム幾何グラフ: 単位正方形に点をばらまき、平均次数が degree 程度になる半径以内を結ぶ。
+    重みは距離を 10 倍して切り上げた整数。
+    """
+    rng = np.random.default_rng(seed)
+    n = n_nodes
+    pts = rng.random((n, 2))
+    radius = math.sqrt(degree / (math.pi * n))
+    # 半径ぶんのセルに分けて、隣のセルとの間だけ距離を調べる
+    cells = np.floor(pts / radius).astype(np.int64)
+    buckets = {}
+    for i, (cx, cy) in enumerate(cells.tolist()):
+        buckets.setdefault((cx, cy), []).append(i)
+    pairs = []
+    for (cx, cy), members in buckets.items():
+        for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1), (1, -1)):
+            others = buckets.get((cx + dx, cy + dy))
+            if not others:
+                continue
+            a = np.array(members)
+            b = np.array(others)
+            d = np.linalg.norm(pts[a][:, None, :] - pts[b][None, :, :], axis=-1)
+            ia, ib = np.nonzero(d <= radius)
+            for u, v in zip(a[ia].tolist(), b[ib].tolist()):
+                if (dx, dy) == (0, 0) and u >= v:
+                    continue
+                pairs.append((u, v))
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    lengths = np.linalg.norm(pts[pairs[:, 0]] - pts[pairs[:, 1]], axis=1)
+    weights = np.maximum(1, np.ceil(lengths / radius * 10)).astype(np.int64)
+    return _finish(n, pts * 100, pairs, weights)
+
+
+MAP_GENERATORS = {
+    "grid": grid_map,
+    "road": road_map,
+    "geometric": geometric_map,
+}
+
+
+def to_csr(names, xy, edge_list):
+    return CSRGraph.from_edge_list(names, xy, edge_list)
+
+
+def to_graph(graph_cls, names, xy, edge_list):
+    """文字列ベースの Graph と EDGE_NUM_MAP 形式の辞書を作る (dijkstra_all 用)。"""
+    g = graph_cls()
+    for name, (x, y) in zip(names, xy.tolist()):
+        g.add_node(name, (x, y))
+    edge_num_map = {}
+    for u, v, w, num in edge_list:
+        g.add_edge(names[u], names[v], w)
+        edge_num_map[(names[u], names[v])] = num
+        edge_num_map[(names[v], names[u])] = num
+    return g, edge_num_map
@@ -0,0 +1,324 @@
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from dijkstra import (Graph, dijkstra_all, iter_all_paths, count_all_paths,
+                      decide_directions, CANDIDATE_PAGE_SIZE)
+from bench.mapgen import MAP_GENERATORS, to_csr, to_graph
+from turn_table import TurnTable
+from k_shortest import KShortestPaths
+from replanner import DStarLite
+
+# =========================
+# 経路計算パイプラインのベンチマーク
+# =========================
+# 生成したマップの上で、問い合わせ1件の処理を段階ごとに時間を測る。
+#   search_legacy : dijkstra_all (文字列ノードの Graph)
+#   search_csr    : CSRGraph.dijkstra
+#   search_astar  : CSRGraph.astar (goal 向きの探索。reached_frac は到達したノードの割合)
+#   count         : count_all_paths (最短経路の本数)
+#   enumerate     : iter_all_paths から候補 1 ページ分 (CANDIDATE_PAGE_SIZE 本) を取り出す
+#   directions    : ページ内の全経路に decide_directions
+#   turn_table    : 同じ経路を TurnTable.compile_actions でまとめて変換
+#   edge_numbers  : 同じ経路 (整数ノード) を CSRGraph.paths_edge_numbers でまとめて
+#   edge_dict     : 従来どおり EDGE_NUM_MAP (タプルの辞書) を引く
+#   k_shortest    : KShortestPaths で短い順に K_SHORTEST 本 (goal からの最短経路木の作成込み)
+#   replan        : DStarLite で、経路の 1/4 まで進んだところで 2 つ先のエッジが通れなくなったときの引き直し
+#                   (最初の探索は含まない。search_astar で start から探し直すのと比べる)
+# 結果は段階ごとの p50/p95/p99 (ms)、スループット (件/秒)、ピークメモリ (KiB) の JSON。
+# --check は計測の代わりに、探索エンジン (dijkstra_all / CSRGraph.dijkstra / CSRGraph.astar) の
+# 最短距離と候補経路が一致するかを調べる (重み 0 のエッジを含むマップも使う)。
+
+STAGES = ("search_legacy", "search_csr", "search_astar", "count", "enumerate",
+          "directions", "turn_table", "edge_numbers", "edge_dict", "k_shortest", "replan")
+K_SHORTEST = 10
+LEGACY_MAX_NODES = 100_000  # これより大きいマップでは Graph を作らない (遅すぎるので)
+
+
+def percentile(samples, q):
+    return float(np.percentile(samples, q)) if samples else 0.0
+
+
+def summarize(samples_ms):
+    total_s = sum(samples_ms) / 1000
+    return {
+        "runs": len(samples_ms),
+        "p50_ms": round(percentile(samples_ms, 50), 4),
+        "p95_ms": round(percentile(samples_ms, 95), 4),
+        "p99_ms": round(percentile(samples_ms, 99), 4),
+        "max_ms": round(max(samples_ms), 4) if samples_ms else 0.0,
+        "throughput_qps": round(len(samples_ms) / total_s, 2) if total_s > 0 else None
+    }
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - t0) * 1000
+
+
+def peak_kib(fn, *args):
+    """fn(*args) の実行中に増えたメモリのピーク (tracemalloc, KiB)。"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round((peak - base) / 1024, 1)
+
+
+def edge_dict_lookup(edge_num_map, path):
+    used_edges = []
+    for i in range(len(path) - 1):
+        num = edge_num_map.get((path[i], path[i + 1]))
+        if num is not None:
+            used_edges.append(num)
+    return used_edges
+
+
+def edge_dict_pages(edge_num_map, paths):
+    return [edge_dict_lookup(edge_num_map, path) for path in paths]
+
+
+def first_page(prev, start, goal):
+    return list(itertools.islice(iter_all_paths(prev, start, goal), CANDIDATE_PAGE_SIZE))
+
+
+def zero_weight_maps(seed):
+    """重み 0 のエッジを含む確認用のマップ (names, xy, edge_list) のリスト。"""
+    maps = [(["a", "b", "c"], np.array([[0.0, 0.0], [1.0, 0.0], [2.0, 0.0]]),
+             [(0, 1, 0, 1), (1, 2, 1, 2)])]
+    rng = np.random.default_rng(seed)
+    for map_name in ("grid", "road"):
+        names, xy, edge_list = MAP_GENERATORS[map_name](100, seed)
+        zero = rng.random(len(edge_list)) < 0.2
+        maps.append((names, xy, [(u, v, 0 if z else w, num)
+                                 for (u, v, w, num), z in zip(edge_list, zero)]))
+    return maps
+
+
+def check_engines(seed, queries=20):
+    """
+    3つの探索エンジンで最短距離と候補経路 (最初の CANDIDATE_PAGE_SIZE 本) が同じになるかを調べ、
+    食い違いの説明のリストを返す。
+    """
+    cases = [(map_name, MAP_GENERATORS[map_name](100, seed)) for map_name in sorted(MAP_GENERATORS)]
+    cases += [(f"zero_weight{i}", m) for i, m in enumerate(zero_weight_maps(seed))]
+    rng = np.random.default_rng(seed)
+    problems = []
+    for case, (names, xy, edge_list) in cases:
+        csr = to_csr(names, xy, edge_list)
+        graph, _ = to_graph(Graph, names, xy, edge_list)
+        pairs = [(0, len(names) - 1)] + [tuple(int(i) for i in rng.integers(len(names), size=2))
+                                         for _ in range(queries)]
+        for start, goal in pairs:
+            dist, prev = csr.dijkstra(start)
+            legacy_dist, _ = dijkstra_all(graph, names[start])
+            try:
+                astar_dist, astar_prev = csr.astar(start, goal)
+            except Exception as e:
+                problems.append(f"{case} {start}->{goal}: astar raised {e!r}")
+                continue
+            expected = first_page(prev, start, goal) if dist[goal] != float("inf") else []
+            got = first_page(astar_prev, start, goal) if astar_dist[goal] != float("inf") else []
+            if not (dist[goal] == astar_dist[goal] == legacy_dist[names[goal]]):
+                problems.append(f"{case} {start}->{goal}: distance {dist[goal]} / "
+                                f"{astar_dist[goal]} / {legacy_dist[names[goal]]}")
+            elif got != expected:
+                problems.append(f"{case} {start}->{goal}: candidate paths differ")
+    return problems
+
+
+def bench_map(map_name, n_nodes, queries, seed, legacy):
+    """1つのマップで全段階を測り、結果の辞書のリストを返す。"""
+    rng = np.random.default_rng(seed)
+    build = {}
+    (names, xy, edge_list), build["generate"] = timed(MAP_GENERATORS[map_name], n_nodes, seed)
+    csr, build["csr"] = timed(to_csr, names, xy, edge_list)
+    turn_table, build["turn_table"] = timed(TurnTable, csr)
+    graph = edge_num_map = None
+    if legacy and len(names) <= LEGACY_MAX_NODES:
+        (graph, edge_num_map), build["graph"] = timed(to_graph, Graph, names, xy, edge_list)
+
+    samples = {stage: [] for stage in STAGES}
+    reached = {"search_csr": [], "search_astar": []}
+    peaks = {}
+    for qi in range(queries):
+        start = int(rng.integers(len(names)))
+        (dist, prev), ms = timed(csr.dijkstra, start)
+        samples["search_csr"].append(ms)
+        # 探索はゴールによらないので、到達できるノードの中からあとでゴールを選ぶ
+        reachable = np.flatnonzero(np.isfinite(np.asarray(dist)))
+        reachable = reachable[reachable != start]
+        if len(reachable) == 0:
+            continue
+        goal = int(rng.choice(reachable))
+        reached["search_csr"].append((len(reachable) + 1) / len(names))
+        (astar_dist, _), ms = timed(csr.astar, start, goal)
+        samples["search_astar"].append(ms)
+        reached["search_astar"].append(float(np.isfinite(np.asarray(astar_dist)).mean()))
+
+        _, ms = timed(count_all_paths, prev, start, goal)
+        samples["count"].append(ms)
+        page, ms = timed(first_page, prev, start, goal)
+        samples["enumerate"].append(ms)
+        named = [[names[i] for i in path] for path in page]
+        _, ms = timed(lambda: [decide_directions(csr, p) for p in named])
+        samples["directions"].append(ms)
+        _, ms = timed(turn_table.compile_actions, page)
+        samples["turn_table"].append(ms)
+        # エッジ番号の2つは数 µs の差を比べるので、どちらも1回空回ししてから続けて測り、
+        # 測る順番も問い合わせごとに入れ替える (あとから測るほうがキャッシュが温まっていて有利になるため)
+        edge_stages = [("edge_numbers", csr.paths_edge_numbers, (page,))]
+        if graph is not None:
+            edge_stages.append(("edge_dict", edge_dict_pages, (edge_num_map, named)))
+        for stage, fn, args in (edge_stages if qi % 2 == 0 else edge_stages[::-1]):
+            fn(*args)
+            _, ms = timed(fn, *args)
+            samples[stage].append(ms)
+        _, ms = timed(lambda: KShortestPaths(csr, start, goal).take(K_SHORTEST))
+        samples["k_shortest"].append(ms)
+        replanner = DStarLite(csr, start, goal)
+        path = replanner.path()
+        if len(path) >= 4:
+            here = len(path) // 4
+            replanner.move_to(path[here])
+            blocked_at = min(here + 2, len(path) - 2)
+            _, ms = timed(lambda: (replanner.block_edge(path[blocked_at], path[blocked_at + 1]),
+                                   replanner.path()))
+            samples["replan"].append(ms)
+        if graph is not None:
+            _, ms = timed(dijkstra_all, graph, names[start])
+            samples["search_legacy"].append(ms)
+
+        if qi == 0:
+            # メモリは時間計測と別に1回だけ測る (tracemalloc を有効にすると遅くなるため)
+            peaks["search_csr"] = peak_kib(csr.dijkstra, start)
+            peaks["search_astar"] = peak_kib(csr.astar, start, goal)
+            peaks["count"] = peak_kib(count_all_paths, prev, start, goal)
+            peaks["enumerate"] = peak_kib(first_page, prev, start, goal)
+            if graph is not None:
+                peaks["search_legacy"] = peak_kib(dijkstra_all, graph, names[start])
+
+    results = []
+    for stage in STAGES:
+        if not samples[stage]:
+            continue
+        row = {"map": map_name, "nodes": csr.num_nodes, "edges": csr.num_edges, "stage": stage}
+        row.update(summarize(samples[stage]))
+        row["peak_kib"] = peaks.get(stage)
+        if reached.get(stage):
+            row["reached_frac"] = round(float(np.mean(reached[stage])), 4)
+        results.append(row)
+    for stage, ms in build.items():
+        results.append({
+            "map": map_name, "nodes": csr.num_nodes, "edges": csr.num_edges,
+            "stage": f"build_{stage}", "runs": 1, "p50_ms": round(ms, 4)
+        })
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    baseline (前回の JSON) と p50 を比べ、(1 + tolerance) 倍より遅くなった段階を返す。
+    マップ・ノード数・段階が一致する行だけを比べる。
+    """
+    old = {(r["map"], r["nodes"], r["stage"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for row in results:
+        before = old.get((row["map"], row["nodes"], row["stage"]))
+        if before is None or not before.get("p50_ms"):
+            continue
+        ratio = row["p50_ms"] / before["p50_ms"]
+        row["baseline_p50_ms"] = before["p50_ms"]
+        row["ratio"] = round(ratio, 3)
+        if ratio > 1 + tolerance:
+            regressions.append(row)
+    return regressions
+
+
+def print_table(results):
+    print(f"{'map':<10}{'nodes':>9}{'stage':>18}{'p50 ms':>11}{'p99 ms':>11}"
+          f"{'qps':>11}{'peak KiB':>11}{'ratio':>8}")
+    for r in results:
+        qps = r.get("throughput_qps")
+        peak = r.get("peak_kib")
+        print(f"{r['map']:<10}{r['nodes']:>9}{r['stage']:>18}{r['p50_ms']:>11.3f}"
+              f"{r.get('p99_ms', r['p50_ms']):>11.3f}"
+              f"{qps if qps is not None else '-':>11}"
+              f"{peak if peak is not None else '-':>11}"
+              f"{r.get('ratio', '-'):>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="経路計算パイプラインのベンチマーク")
+    parser.add_argument("--maps", nargs="+", default=["grid", "road", "geometric"],
+                        choices=sorted(MAP_GENERATORS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000, 10000],
+                        help="ノード数 (10^2〜10^6)")
+    parser.add_argument("--queries", type=int, default=20, help="マップごとの問い合わせ数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-legacy", action="store_true",
+                        help="dijkstra_all と EDGE_NUM_MAP 辞書の計測を省く")
+    parser.add_argument("--out", help="結果の JSON を書き出すファイル")
+    parser.add_argument("--baseline", help="比較する前回の結果 (JSON)")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="p50 がこの割合より遅くなったら回帰とみなす")
+    parser.add_argument("--check", action="store_true",
+                        help="計測の代わりに探索エンジンの結果が一致するかだけを調べる")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        problems = check_engines(args.seed)
+        for problem in problems:
+            print(problem)
+        print(f"[check] {len(problems)} 件の食い違い", file=sys.stderr)
+        return 1 if problems else 0
+
+    results = []
+    for map_name in args.maps:
+        for size in args.sizes:
+            print(f"[bench] {map_name} {size} nodes ...", file=sys.stderr)
+            results.extend(bench_map(map_name, size, args.queries, args.seed, not args.no_legacy))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "queries": args.queries,
+            "seed": args.seed,
+            "page_size": CANDIDATE_PAGE_SIZE,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "results": results
+    }
+    print_table(results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if regressions:
+        print(f"\n{len(regressions)} 件の段階が baseline より遅くなっています:")
+        for r in regressions:
+            print(f"  {r['map']} {r['nodes']} {r['stage']}: "
+                  f"{r['baseline_p50_ms']} ms -> {r['p50_ms']} ms (x{r['ratio']})")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
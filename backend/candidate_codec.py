@@ -0,0 +1,139 @@
+import json
+import struct
+
+import numpy as np
+
+# =========================
+# 候補経路の小さな表現 (compact / binary)
+# =========================
+# 従来の応答は候補ごとに "vN" の文字列の列とエッジ番号の列を持つので、候補が多いと大きく、
+# ブラウザの JSON.parse も遅い。問い合わせに "encoding" を付けると次の形で返す。
+#   "json"    従来どおり (既定)
+#   "compact" ノード番号の木 (JSON)。候補経路は goal 側から見ると同じ部分を共有しているので、
+#             goal を根とした木 (trie) にまとめる:
+#               parent[t]: 木の頂点 t の親 (根は -1)、node[t]: 頂点 t のノード番号
+#               leaves[i]: 候補 i の start の頂点。leaf から親をたどると start -> goal の順になる
+#             エッジ番号は送らない。クライアントは {"type": "map"} で受け取った表 (ノード名と
+#             [u, v, エッジ番号]) から、隣り合うノードの組で引く。
+#   "binary"  compact と同じ中身を WebSocket のバイナリフレームで送る:
+#               0xA7, 版, ヘッダ長 (u16 LE), ヘッダ (JSON, UTF-8), 4 バイト境界までの 0 埋め,
+#               parent / node / leaves (int32 LE の配列。長さはヘッダの trie_nodes / paths)
+#             ブラウザでは Int32Array でそのまま読める。
+
+ENCODINGS = ("json", "compact", "binary")
+CANDIDATE_MAGIC = 0xA7
+CODEC_VERSION = 1
+_PREFIX = struct.Struct("<BBH")
+
+
+def _common_prefix_len(a, b):
+    """リスト a, b の先頭から一致している長さ (比較はスライス単位で C の速さ)。"""
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    lo, hi = 0, n  # a[:lo] == b[:lo], a[:hi] != b[:hi]
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def build_path_trie(paths):
+    """
+    整数ノードの経路 (start -> goal) の列を、goal を根とする木にまとめて (parent, node, leaves) を返す。
+    iter_all_paths の順 (goal 側から深さ優先) なら、同じ部分を持つ経路は並んで出てくるので、
+    直前の経路と共通の部分だけを比べれば木になる。ほかの順でも正しいが、共有は減る。
+    """
+    parent = []
+    node = []
+    leaves = []
+    prev_rev = []  # 直前の経路 (goal から逆順)
+    prev_ids = []  # prev_rev の各位置の木の頂点
+    for path in paths:
+        rev = list(path[::-1])
+        shared = _common_prefix_len(prev_rev, rev)  # 0 なら goal が違う -> 新しい根
+        ids = prev_ids[:shared]
+        # 共有していない部分は一続きの新しい頂点 base, base+1, ... (それぞれ1つ前の頂点が親)
+        base = len(node)
+        added = len(rev) - shared
+        if added:
+            parent.append(ids[-1] if ids else -1)
+            parent.extend(range(base, base + added - 1))
+            node.extend(map(int, rev[shared:]))
+            ids.extend(range(base, base + added))
+        leaves.append(ids[-1] if ids else -1)
+        prev_rev, prev_ids = rev, ids
+    return parent, node, leaves
+
+
+def expand_paths(parent, node, leaves):
+    """build_path_trie の逆。整数ノードの経路のリストに戻す。"""
+    paths = []
+    for t in leaves:
+        path = []
+        while t >= 0:
+            path.append(node[t])
+            t = parent[t]
+        paths.append(path)
+    return paths
+
+
+def compact_page(paths, cursor, next_cursor, total_paths, fingerprint):
+    """候補1ページ (整数ノードの経路) の "compact" 形式。"""
+    parent, node, leaves = build_path_trie(paths)
+    return {
+        "encoding": "compact",
+        "fingerprint": fingerprint,
+        "parent": parent,
+        "node": node,
+        "leaves": leaves,
+        "cursor": cursor,
+        "next_cursor": next_cursor,
+        "total_paths": total_paths
+    }
+
+
+def encode_binary(page, request_id=None):
+    """compact_page の結果をバイナリフレームにする。"""
+    header = {key: value for key, value in page.items() if key not in ("parent", "node", "leaves")}
+    header.update(encoding="binary", trie_nodes=len(page["node"]), paths=len(page["leaves"]))
+    if request_id is not None:
+        header["request_id"] = request_id
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    if len(header_bytes) > 0xFFFF:
+        raise ValueError("candidate header too large")
+    padding = -(_PREFIX.size + len(header_bytes)) % 4
+    arrays = np.concatenate([np.asarray(page["parent"], dtype="<i4"),
+                             np.asarray(page["node"], dtype="<i4"),
+                             np.asarray(page["leaves"], dtype="<i4")])
+    return (_PREFIX.pack(CANDIDATE_MAGIC, CODEC_VERSION, len(header_bytes)) + header_bytes
+            + b"\0" * padding + arrays.tobytes())
+
+
+def decode_binary(data):
+    """encode_binary の逆 (Python のクライアント・試験用)。compact と同じ形の辞書を返す。"""
+    magic, version, header_len = _PREFIX.unpack_from(data, 0)
+    if magic != CANDIDATE_MAGIC or version != CODEC_VERSION:
+        raise ValueError("not a candidate frame")
+    offset = _PREFIX.size + header_len
+    page = json.loads(bytes(data[_PREFIX.size:offset]).decode("utf-8"))
+    offset += -offset % 4
+    n, k = page["trie_nodes"], page["paths"]
+    arrays = np.frombuffer(data, dtype="<i4", count=2 * n + k, offset=offset).tolist()
+    page.update(parent=arrays[:n], node=arrays[n:2 * n], leaves=arrays[2 * n:])
+    return page
+
+
+def map_table(csr):
+    """{"type": "map"} の応答: ノード名と、番号のあるエッジ [u, v, エッジ番号] (u < v) の表。"""
+    edges = []
+    indptr, indices, edge_ids = csr.indptr.tolist(), csr.indices.tolist(), csr.edge_ids.tolist()
+    for u in range(len(csr.names)):
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            if u < v and edge_ids[k]:
+                edges.append([u, v, edge_ids[k]])
+    return {"type": "map", "fingerprint": csr.fingerprint, "names": csr.names, "edges": edges}
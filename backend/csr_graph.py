@@ -0,0 +1,416 @@
+import hashlib
+import heapq
+import itertools
+import math
+from collections.abc import Mapping
+
+import numpy as np
+
+# =========================
+# CSR形式のグラフ
+# =========================
+# ノード名を 0..V-1 の整数に置き換え、隣接リストを CSR (Compressed Sparse Row) 形式の
+# 連続した配列で持つ。ノード i の隣接は indices[indptr[i]:indptr[i+1]] で、
+# 同じ位置の weights / edge_ids がそのエッジの重み・LEDエッジ番号 (番号なしは 0)。
+# 無向グラフなので 1 本のエッジは両方向ぶん 2 スロットに入る。
+
+# 候補ページの辺がこの本数以上なら、エッジ番号を numpy でまとめて引く (少ないと辞書のほうが速い)
+EDGE_NUMBER_BATCH_MIN = 512
+
+
+class _EdgesView(Mapping):
+    """graph.edges[node] -> [(隣接ノード名, 重み), ...] の読み取り専用ビュー。"""
+
+    def __init__(self, csr):
+        self._csr = csr
+
+    def __getitem__(self, node):
+        csr = self._csr
+        i = csr.index[node]
+        lo, hi = csr.indptr[i], csr.indptr[i + 1]
+        names = csr.names
+        return [(names[j], w) for j, w in zip(csr.indices[lo:hi].tolist(), csr.weights[lo:hi].tolist())]
+
+    def __contains__(self, node):
+        return node in self._csr.index
+
+    def __iter__(self):
+        return iter(self._csr.names)
+
+    def __len__(self):
+        return len(self._csr.names)
+
+
+class _PositionsView(Mapping):
+    """graph.positions[node] -> (x, y) の読み取り専用ビュー。"""
+
+    def __init__(self, csr):
+        self._csr = csr
+
+    def __getitem__(self, node):
+        x, y = self._csr.xy[self._csr.index[node]].tolist()
+        return (x, y)
+
+    def __contains__(self, node):
+        return node in self._csr.index
+
+    def __iter__(self):
+        return iter(self._csr.names)
+
+    def __len__(self):
+        return len(self._csr.names)
+
+
+class BlockedEdges:
+    """
+    ベースグラフを書き換えずに「通行止めのエッジ」を表すオーバーレイ。
+    中身は通行止めエッジの CSR 上の位置 (両方向ぶん) の集合なので、
+    作るコストは O(|remove_edges|) で、ベースグラフのコピーは不要。
+    """
+
+    def __init__(self, slots=(), pairs=()):
+        self.slots = frozenset(slots)
+        self.pairs = tuple(pairs)  # ログ表示用の (node1, node2)
+
+    @classmethod
+    def from_remove_edges(cls, graph, remove_edges):
+        """
+        remove_edges: ["v1-v2", ...] (フロントエンドから届く形式) からオーバーレイを作る。
+        存在しないノード・エッジは従来どおり無視する。
+        """
+        slots = []
+        pairs = []
+        for edge_str in remove_edges:
+            node1, node2 = edge_str.split('-')
+            u = graph.index.get(node1)
+            v = graph.index.get(node2)
+            if u is None or v is None:
+                continue
+            k1 = graph.slot(u, v)
+            k2 = graph.slot(v, u)
+            if k1 < 0 and k2 < 0:
+                continue
+            slots.extend(k for k in (k1, k2) if k >= 0)
+            pairs.append((node1, node2))
+        return cls(slots, pairs)
+
+    def __contains__(self, slot):
+        return slot in self.slots
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __bool__(self):
+        return bool(self.slots)
+
+
+class CSRGraph:
+    """
+    整数インデックス・配列ベースのグラフ。
+    nodes / edges / positions は Graph と同じ形で読めるビューなので、
+    dijkstra_all や decide_directions にそのまま渡せる (ただし変更はできない)。
+    """
+
+    def __init__(self, names, xy, indptr, indices, weights, edge_ids, fingerprint=None):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.xy = np.ascontiguousarray(xy, dtype=np.float64).reshape(len(self.names), 2)
+        self.indptr = np.ascontiguousarray(indptr, dtype=np.int64)
+        self.indices = np.ascontiguousarray(indices, dtype=np.int32)
+        self.weights = np.ascontiguousarray(weights, dtype=np.float64)
+        self.edge_ids = np.ascontiguousarray(edge_ids, dtype=np.int32)
+        # 探索ループ用: memoryview の添字アクセスは Python の int/float をそのまま返すので速い
+        self._indptr_mv = memoryview(self.indptr)
+        self._indices_mv = memoryview(self.indices)
+        self._weights_mv = memoryview(self.weights)
+        self._xy_mv = memoryview(self.xy.reshape(-1))
+        self._heuristic_scales = {}  # A* のヒューリスティックの倍率 (距離の種類ごと)
+        self._slot_keys = None  # slots() の二分探索用 (u * V + v の昇順のキー, その CSR 上の位置)
+        self._numbered_edges = None  # 番号のあるエッジだけの {(u, v): エッジ番号}
+
+        self.edges = _EdgesView(self)
+        self.positions = _PositionsView(self)
+        # コンパイル済みのマップ (map_loader) は保存しておいた値を渡して計算を省く
+        self.fingerprint = fingerprint or self._compute_fingerprint()
+
+    def _compute_fingerprint(self):
+        """グラフの中身から作るハッシュ値。中身が変わればキャッシュを捨てる目印になる。"""
+        h = hashlib.blake2b(digest_size=16)
+        h.update("\0".join(self.names).encode("utf-8"))
+        for arr in (self.xy, self.indptr, self.indices, self.weights, self.edge_ids):
+            h.update(arr.tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def from_graph(cls, graph, edge_num_map=None):
+        """文字列ベースの Graph (と EDGE_NUM_MAP) から CSRGraph を作る。"""
+        edge_num_map = edge_num_map or {}
+        names = list(graph.nodes)
+        index = {name: i for i, name in enumerate(names)}
+        xy = np.array([graph.positions[name] for name in names], dtype=np.float64).reshape(len(names), 2)
+
+        degrees = np.array([len(graph.edges[name]) for name in names], dtype=np.int64)
+        indptr = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(degrees, out=indptr[1:])
+        m = int(indptr[-1])
+        indices = np.empty(m, dtype=np.int32)
+        weights = np.empty(m, dtype=np.float64)
+        edge_ids = np.zeros(m, dtype=np.int32)
+        k = 0
+        for name in names:
+            for neighbor, weight in graph.edges[name]:
+                indices[k] = index[neighbor]
+                weights[k] = weight
+                edge_ids[k] = edge_num_map.get((name, neighbor), 0)
+                k += 1
+        return cls(names, xy, indptr, indices, weights, edge_ids)
+
+    @classmethod
+    def from_edge_list(cls, names, xy, edge_list):
+        """
+        edge_list: [(u, v, weight, edge_id), ...] (u, v は整数インデックス、無向)
+        から CSRGraph を作る。大きなマップを Graph を経由せずに組み立てる用。
+        """
+        n = len(names)
+        arr = np.asarray(edge_list, dtype=np.float64).reshape(-1, 4)
+        u = arr[:, 0].astype(np.int64)
+        v = arr[:, 1].astype(np.int64)
+        # u->v, v->u を交互に並べてから安定ソートするので、各ノード内の隣接は
+        # Graph.add_edge を edge_list の順に呼んだときと同じ順番になる
+        src = np.stack([u, v], axis=1).ravel()
+        dst = np.stack([v, u], axis=1).ravel()
+        w = np.repeat(arr[:, 2], 2)
+        eid = np.repeat(arr[:, 3], 2).astype(np.int32)
+        order = np.argsort(src, kind="stable")
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+        return cls(names, xy, indptr, dst[order], w[order], eid[order])
+
+    # ---- 基本情報 ----
+    @property
+    def nodes(self):
+        return self.names
+
+    @property
+    def num_nodes(self):
+        return len(self.names)
+
+    @property
+    def num_edges(self):
+        """無向エッジの本数。"""
+        return len(self.indices) // 2
+
+    def nbytes(self):
+        """配列バッファが使っているバイト数。"""
+        return (self.xy.nbytes + self.indptr.nbytes + self.indices.nbytes
+                + self.weights.nbytes + self.edge_ids.nbytes)
+
+    # ---- エッジ番号 ----
+    def slot(self, u, v):
+        """u -> v のエッジが入っている CSR 上の位置 (なければ -1)。"""
+        lo, hi = self._indptr_mv[u], self._indptr_mv[u + 1]
+        indices = self._indices_mv
+        for k in range(lo, hi):
+            if indices[k] == v:
+                return k
+        return -1
+
+    def _slot_sources(self):
+        """各スロットの出発ノード (indices と同じ長さの配列)。"""
+        n = len(self.names)
+        return np.repeat(np.arange(n, dtype=np.int64), np.diff(self.indptr))
+
+    def slots(self, u, v):
+        """u -> v の CSR 上の位置を配列でまとめて引く (エッジがなければ -1)。"""
+        n = len(self.names)
+        if self._slot_keys is None:
+            # 最初に使うときに作る (スレッドが同時に作っても同じものになる)。
+            # 末尾の番兵はどのキーより大きいので、searchsorted の結果が範囲外にならない
+            keys = self._slot_sources() * n + self.indices
+            order = np.argsort(keys, kind="stable")
+            self._slot_keys = (np.append(keys[order], np.iinfo(np.int64).max), np.append(order, -1))
+        sorted_keys, order = self._slot_keys
+        keys = np.asarray(u, dtype=np.int64) * n + np.asarray(v, dtype=np.int64)
+        pos = sorted_keys.searchsorted(keys)
+        return np.where(sorted_keys[pos] == keys, order[pos], -1)
+
+    def edge_number(self, u, v):
+        """整数ノード u, v を結ぶエッジの LED エッジ番号 (なければ 0)。"""
+        k = self.slot(u, v)
+        return int(self.edge_ids[k]) if k >= 0 else 0
+
+    def _numbered_edge_map(self):
+        """番号のあるエッジ (LED のあるエッジ) だけの {(u, v): エッジ番号}。最初に使うときに作る。"""
+        if self._numbered_edges is None:
+            k = np.flatnonzero(self.edge_ids)
+            pairs = zip(self._slot_sources()[k].tolist(), self.indices[k].tolist())
+            self._numbered_edges = dict(zip(pairs, self.edge_ids[k].tolist()))
+        return self._numbered_edges
+
+    def path_edge_numbers(self, path):
+        """
+        ノード名の経路から、使ったエッジ番号のリストを作る。
+        番号のないエッジ (EDGE_NUM_MAP にない組) や未知のノードは従来どおり飛ばす。
+        """
+        index = self.index
+        idx = [index.get(name) for name in path]
+        get = self._numbered_edge_map().get
+        return [num for num in map(get, zip(idx, idx[1:])) if num]
+
+    def paths_edge_numbers(self, paths):
+        """
+        整数ノードの経路のリスト (候補ページ) から、経路ごとのエッジ番号のリストをまとめて作る
+        (規則は path_edge_numbers と同じ)。ページ内の辺が EDGE_NUMBER_BATCH_MIN 本以上なら
+        slots() で全部を一度に引き、少なければ番号付きエッジの辞書を整数の組で引く。
+        """
+        total = sum(map(len, paths))
+        if total - len(paths) < EDGE_NUMBER_BATCH_MIN:
+            numbered = self._numbered_edges
+            get = (self._numbered_edge_map() if numbered is None else numbered).get
+            return [[num for num in map(get, zip(path, path[1:])) if num] for path in paths]
+        lengths = list(map(len, paths))
+        flat = np.fromiter(itertools.chain.from_iterable(paths), dtype=np.int64, count=total)
+        # 経路の境目 (ある経路の最後 -> 次の経路の最初) の組も引いてしまうが、下で読み飛ばす
+        slots = self.slots(flat[:-1], flat[1:])
+        nums = np.where(slots >= 0, self.edge_ids[slots], 0).tolist()
+        result = []
+        lo = 0
+        for length in lengths:
+            result.append([num for num in nums[lo:lo + length - 1] if num])
+            lo += length
+        return result
+
+    # ---- 探索 ----
+    def dijkstra(self, start, blocked=None):
+        """
+        整数版の dijkstra_all。start は整数インデックス。
+        blocked (BlockedEdges) に入っているエッジは通らない。
+        dist[i] は最短距離 (到達不能なら inf)、prev[i] は同距離の前駆ノード (整数) のリスト。
+        """
+        n = len(self.names)
+        indptr = self._indptr_mv
+        indices = self._indices_mv
+        weights = self._weights_mv
+        inf = float("inf")
+        blocked_slots = blocked.slots if blocked else None
+
+        dist = [inf] * n
+        # 前駆リストは到達したノードの分だけ作る (未到達は空タプルのまま)
+        prev = [()] * n
+        settled = bytearray(n)
+        dist[start] = 0
+        heap = [(0, start)]
+
+        while heap:
+            d, u = heapq.heappop(heap)
+            if settled[u] or d > dist[u]:
+                continue
+            settled[u] = 1
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                if settled[v] or (blocked_slots is not None and k in blocked_slots):
+                    continue
+                nd = d + weights[k]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    prev[v] = [u]
+                    heapq.heappush(heap, (nd, v))
+                elif nd == dist[v]:
+                    prev[v].append(u)
+        return dist, prev
+
+    def heuristic_scale(self, metric="euclidean"):
+        """
+        A* のヒューリスティック h(v) = scale * (v と goal の座標上の距離) の倍率。
+        全エッジの「重み / 座標上の長さ」の最小値にするので、h は実際の最短距離を超えない
+        (許容的) うえに、h(u) <= 重み(u,v) + h(v) も成り立つ (無矛盾)。
+        """
+        scale = self._heuristic_scales.get(metric)
+        if scale is None:
+            src = np.repeat(np.arange(len(self.names)), np.diff(self.indptr))
+            delta = self.xy[self.indices] - self.xy[src]
+            if metric == "euclidean":
+                length = np.hypot(delta[:, 0], delta[:, 1])
+            elif metric == "manhattan":
+                length = np.abs(delta).sum(axis=1)
+            else:
+                raise ValueError(f"unknown heuristic: {metric}")
+            moving = length > 0
+            scale = float((self.weights[moving] / length[moving]).min()) if moving.any() else 0.0
+            self._heuristic_scales[metric] = scale
+        return scale
+
+    def astar(self, start, goal, blocked=None, metric="euclidean", scale=None, heuristic=None):
+        """
+        goal 向きに探索する A*。戻り値は dijkstra() と同じ形 (dist, prev)。
+        f = g + h が goal までの最短距離以下のノードをすべて確定させるので、
+        start から goal までの同距離の経路に乗るノードは前駆リストがすべてそろう
+        (prev の並びも dijkstra() と同じにする)。
+        dist が正しいのは goal とその最短経路上のノードだけ。
+        scale を指定するとヒューリスティックの倍率を上書きする (大きすぎると最短経路を外す)。
+        heuristic に h(v) を渡すと座標の代わりにそれを使う (無矛盾なものに限る。hub_labels など)。
+        """
+        n = len(self.names)
+        indptr = self._indptr_mv
+        indices = self._indices_mv
+        weights = self._weights_mv
+        xy = self._xy_mv
+        inf = float("inf")
+        blocked_slots = blocked.slots if blocked else None
+        if scale is None and heuristic is None:
+            scale = self.heuristic_scale(metric)
+        gx, gy = xy[2 * goal], xy[2 * goal + 1]
+        if heuristic is not None:
+            h = heuristic
+        elif metric == "manhattan":
+            def h(v):
+                return scale * (abs(xy[2 * v] - gx) + abs(xy[2 * v + 1] - gy))
+        else:
+            def h(v):
+                return scale * math.hypot(xy[2 * v] - gx, xy[2 * v + 1] - gy)
+
+        dist = [inf] * n
+        prev = [()] * n
+        settled = bytearray(n)
+        ties = []  # 前駆が2つ以上になったノード
+        dist[start] = 0
+        h_start = h(start)
+        if h_start == inf:
+            return dist, prev  # goal に届かないことがヒューリスティックから分かる
+        heap = [(h_start, 0, start)]
+        # 浮動小数の丸めで同距離の経路を取りこぼさないよう、goal の距離より少しだけ先まで見る
+        bound = inf
+
+        while heap:
+            f, d, u = heapq.heappop(heap)
+            if f > bound:
+                break
+            if settled[u] or d > dist[u]:
+                continue
+            settled[u] = 1
+            if u == goal:
+                bound = d + 1e-9 * max(1.0, d)
+            for k in range(indptr[u], indptr[u + 1]):
+                if blocked_slots is not None and k in blocked_slots:
+                    continue
+                v = indices[k]
+                nd = d + weights[k]
+                if nd < dist[v] and not settled[v]:
+                    dist[v] = nd
+                    prev[v] = [u]
+                    heapq.heappush(heap, (nd + h(v), nd, v))
+                elif nd == dist[v] and (nd > d or not settled[v]):
+                    # f が同じだと前駆より先に v が確定していることがあるので、確定済みでも追加する。
+                    # ただし重み 0 のエッジで確定済みのノード (start を含む) に戻るものは足さない
+                    # (dijkstra() と同じく前駆が輪にならないように)
+                    prev[v].append(u)
+                    ties.append(v)
+
+        # dijkstra() は (距離, 番号) の順に確定させるので、前駆リストも同じ順に並べ替える。
+        # h が 0 (重み 0 のエッジがあると倍率が 0 になる) なら確定の順番が dijkstra() と同じで、
+        # 前駆もその順に入っている。重み 0 のエッジがあると (距離, 番号) の順にはならないので並べ替えない
+        if heuristic is None and scale == 0:
+            return dist, prev
+        for v in set(ties):
+            prev[v].sort(key=lambda p: (dist[p], p))
+        return dist, prev
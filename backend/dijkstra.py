@@ -4,7 +4,30 @@ import json
 import serial
 import time
 import numpy as np
-import copy  # deepcopy を使う
+import heapq
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from csr_graph import CSRGraph, BlockedEdges
+from route_cache import RouteCache, make_route_key
+from apsp import AllPairsTable
+from batch_route import batch_distance_rows
+from planner_pool import PlannerPool, run_until_closed
+from serial_writer import SerialWriter, REPLACE, RESET
+from serial_reader import SerialReader
+from session import Session, SelectionSuperseded
+from fleet import FleetPlanner, WAIT_STEP
+from map_loader import load_map
+from hub_labels import load_or_build
+from turn_table import TurnTable
+from led_frames import LedFramebuffer
+from motor_program import MAX_COMMANDS, ProgramUploader
+from telemetry import CarTelemetry
+from metrics import METRICS, PROFILER
+from candidate_codec import ENCODINGS, compact_page, encode_binary, map_table
+from k_shortest import KShortestPaths
+from replanner import RouteReplanner
 
 # ==== シリアルポート設定 ====
 COM_PORT_MOTOR = "/dev/tty.ESP32_Motordenkouchidou"
@@ -16,47 +39,49 @@ BAUD_RATE = 115200
 MOTOR_ENABLED = False # TrueならモーターESP32を使う
 LED1_ENABLED  = False   # TrueならLED1 ESP32を使う
 LED2_ENABLED  = False  # TrueならLED2 ESP32を使う(テスト時にOFF)
+# シミュレータ (simulator/run.py) の擬似端末を使うときは、環境変数 ESP32_MOTOR_PORT / ESP32_LED1_PORT /
+# ESP32_LED2_PORT でポートを差し替える (指定したデバイスは上のフラグが False でも有効になる)
+COM_PORT_MOTOR = os.environ.get("ESP32_MOTOR_PORT", COM_PORT_MOTOR)
+COM_PORT_LED1 = os.environ.get("ESP32_LED1_PORT", COM_PORT_LED1)
+COM_PORT_LED2 = os.environ.get("ESP32_LED2_PORT", COM_PORT_LED2)
+MOTOR_ENABLED = MOTOR_ENABLED or "ESP32_MOTOR_PORT" in os.environ
+LED1_ENABLED = LED1_ENABLED or "ESP32_LED1_PORT" in os.environ
+LED2_ENABLED = LED2_ENABLED or "ESP32_LED2_PORT" in os.environ
+SERIAL_OPEN_WAIT = float(os.environ.get("ESP32_OPEN_WAIT", 1.0))  # ポートを開いてから待つ秒数
+LED_PROTOCOL = "binary"  # LED への送り方: "binary" (差分の2進フレーム) / "ascii" (従来の "1,2,3\n")
+MOTOR_PROTOCOL = "binary"  # 車への送り方: "binary" (チャンクで送る2進プログラム) / "ascii" (従来の "straight,left,...\n")
+MOTOR_TURN_DELAY_MS = 1120  # 旋回の時間 (ms)
+
+# ======= 経路計算モード =======
+APSP_ENABLED = False  # Trueなら起動時に全点対最短距離テーブルを作り、問い合わせを表引きにする
+SEARCH_ALGORITHM = "dijkstra"  # "dijkstra" / "astar" (座標を使って goal の方向から探す)
+ASTAR_HEURISTIC = "euclidean"  # A* の距離: "euclidean" / "manhattan"
+HUB_LABELS_ENABLED = False  # Trueならハブラベル (縮約階層から作る) の正確な距離を A* のヒューリスティックに使う
+PLANNER_MODE = "thread"  # 経路計算の実行場所: "thread" / "process" / "inline" (デバッグ用。計算中はイベントループが止まる)
+                         # process のときも経路のキャッシュ (ROUTE_CACHE) は親プロセスで引く (run_planner)
+PLANNER_WORKERS = 4      # thread / process のときのワーカー数
+PLANNER_MAX_PENDING = 32 # 同時に受け付ける経路計算の数 (超えたら空くまで待たせる)
+SESSION_MAX_REQUESTS = 16  # 1つの接続で同時に受け付ける問い合わせの数 (超えたら busy を返して断る)
 
 # ======= グローバル変数（シリアルオブジェクト） =======
 ser_motor = None
 ser_led1 = None
 ser_led2 = None
 
+# ======= グローバル変数（シリアル送信キュー） =======
+# 書き込みは各デバイスの送信タスクが行う (init_serial で作る)
+writer_motor = None
+motor_uploader = None  # MOTOR_PROTOCOL が "binary" のときのプログラム送信 (init_serial で作る)
+writer_led1 = None
+writer_led2 = None
+
+# ======= グローバル変数（シリアル受信） =======
+# 各デバイスから届いた行は、読めるようになった時点で handler に渡される (init_serial で作る)
+reader_motor = None
+reader_led1 = None
+reader_led2 = None
 
 
-# =========================
-# エッジ番号のマッピング
-# =========================
-# 「(ノード1, ノード2) -> エッジ番号」のように両方向ぶん作る。
-# たとえば v0-v1 がエッジ番号1なら、(v0, v1) と (v1, v0) 両方 1 にする。
-EDGE_NUM_MAP = {
-    ("v0", "v1"): 1, ("v1", "v0"): 1,
-    ("v1", "v2"): 2, ("v2", "v1"): 2,
-    ("v2", "v3"): 3, ("v3", "v2"): 3,
-    ("v3", "v4"): 4, ("v4", "v3"): 4,
-    ("v0", "v5"): 5, ("v5", "v0"): 5,
-    ("v1", "v6"): 6, ("v6", "v1"): 6,
-    ("v2", "v7"): 7, ("v7", "v2"): 7,
-    ("v3", "v8"): 8, ("v8", "v3"): 8,
-    ("v4", "v9"): 9, ("v9", "v4"): 9,
-    ("v5", "v6"): 10, ("v6", "v5"): 10,
-    ("v6", "v7"): 11, ("v7", "v6"): 11,
-    ("v7", "v8"): 12, ("v8", "v7"): 12,
-    ("v8", "v9"): 13, ("v9", "v8"): 13,
-    ("v5", "v14"): 14, ("v14", "v5"): 14,
-    ("v6", "v10"): 15, ("v10", "v6"): 15,
-    ("v7", "v11"): 16, ("v11", "v7"): 16,
-    ("v9", "v13"): 17, ("v13", "v9"): 17,
-    ("v10", "v11"): 18, ("v11", "v10"): 18,
-    ("v11", "v12"): 19, ("v12", "v11"): 19,
-    ("v12", "v13"): 20, ("v13", "v12"): 20,
-    ("v10", "v15"): 21, ("v15", "v10"): 21,
-    ("v12", "v16"): 22, ("v16", "v12"): 22,
-    ("v13", "v17"): 23, ("v17", "v13"): 23,
-    ("v14", "v15"): 24, ("v15", "v14"): 24,
-    ("v15", "v16"): 25, ("v16", "v15"): 25,
-    ("v16", "v17"): 26, ("v17", "v16"): 26
-}
 
 # =========================
 # グラフクラス & Dijkstra
@@ -85,50 +110,147 @@ class Graph:
 def dijkstra_all(graph, start):
     """
     各ノードに対して、最短距離となる全ての前駆ノードをリストで保持するDijkstraの改造版。
+    次に確定するノードは優先度付きキュー (heapq) から取り出すので O((V+E) log V)。
+    距離が同じノードは graph.nodes の登録順に確定させ、従来の min() 走査と同じ順序で
+    prev_nodes を作る。
     """
-    S = []
+    # 同距離のときの取り出し順を graph.nodes の並びに合わせるための番号
+    order = {node: i for i, node in enumerate(graph.nodes)}
+    S = set()
     distances = {node: np.inf for node in graph.nodes}
     distances[start] = 0
     # 各ノードの前駆ノードをリストで保持する
     prev_nodes = {node: [] for node in graph.nodes}
+    heap = [(0, order[start], start)]
 
-    while len(S) < len(graph.nodes):
-        notin_S = [node for node in graph.nodes if node not in S]
-        current_node = min(notin_S, key=lambda node: distances[node])
-        S.append(current_node)
+    while heap:
+        dist, _, current_node = heapq.heappop(heap)
+        if current_node in S or dist > distances[current_node]:
+            continue  # 既に確定済み、または古いエントリ
+        S.add(current_node)
 
         for neighbor, weight in graph.edges[current_node]:
             if neighbor not in S:
-                new_dist = distances[current_node] + weight
+                new_dist = dist + weight
                 if new_dist < distances[neighbor]:
                     distances[neighbor] = new_dist
                     prev_nodes[neighbor] = [current_node]  # 新たにリストを置き換え
+                    heapq.heappush(heap, (new_dist, order[neighbor], neighbor))
                 elif new_dist == distances[neighbor]:
                     # 同じ距離が見つかった場合、前駆ノードを追加する
                     prev_nodes[neighbor].append(current_node)
     return distances, prev_nodes
 
+def dijkstra_batch(graph, queries, table=None):
+    """
+    queries: [(start, goal, remove_edges), ...] (ノード名) をまとめて解く。
+    同じ障害物集合の問い合わせごとにまとめ、異なる始点の距離を batch_distance_rows で一度に計算し、
+    代表の経路と本数は1件ずつの問い合わせと同じく iter_all_paths / count_all_paths で求める。
+    table (graph の AllPairsTable) があれば、距離は探索せずに表から引く。
+    戻り値は問い合わせと同じ順の
+      {"distance": 最短距離, "path": 代表の最短経路1本, "path_count": 最短経路の本数}
+    のリスト。到達できなければ distance は None、未知のノードなら {"error": ...}。
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.from_graph(graph)
+    results = [None] * len(queries)
+    groups = {}  # 障害物集合 -> (BlockedEdges, {start_idx: [(問い合わせ番号, goal_idx), ...]})
+    parsed = {}  # 同じ remove_edges を何度も解釈しない
+    for qi, (start, goal, remove_edges) in enumerate(queries):
+        if start not in graph.index or goal not in graph.index:
+            results[qi] = {"error": f"unknown node: {start if start not in graph.index else goal}"}
+            continue
+        blocked = parsed.get(tuple(remove_edges))
+        if blocked is None:
+            blocked = parsed[tuple(remove_edges)] = BlockedEdges.from_remove_edges(graph, remove_edges)
+        group = groups.setdefault(blocked.slots, (blocked, {}))
+        group[1].setdefault(graph.index[start], []).append((qi, graph.index[goal]))
+
+    def solve(qi, start, goal, dist, prev_nodes, counts):
+        if dist[goal] == float("inf"):
+            results[qi] = {"distance": None, "path": [], "path_count": 0}
+            return
+        results[qi] = {
+            "distance": dist[goal],
+            "path": [graph.names[i] for i in next(iter_all_paths(prev_nodes, start, goal))],
+            "path_count": count_all_paths(prev_nodes, start, goal, counts)
+        }
+
+    for blocked, members in groups.values():
+        if table is not None:
+            # 表の行は goal ごとに違う (通行止めに関係するときだけ直した行) ので、本数は goal ごとに数える
+            for start, goals in members.items():
+                for qi, goal in goals:
+                    solve(qi, start, goal, *table.query(start, goal, blocked), None)
+            continue
+        for start, dist, prev_nodes in batch_distance_rows(graph, sorted(members), blocked):
+            counts = {start: 1}  # 同じ始点の goal どうしで本数の途中結果を使い回す
+            for qi, goal in members[start]:
+                solve(qi, start, goal, dist, prev_nodes, counts)
+    return results
+
+def iter_all_paths(prev_nodes, start, goal):
+    """
+    prev_nodes (前駆ノードのリスト) がつくる DAG を goal 側からたどり、
+    start から goal までの経路を1本ずつ返すジェネレータ。
+    再帰もリスト連結もしないので、メモリは経路1本分・深さの制限もない。
+    返す順番は従来の enumerate_all_paths と同じ。
+    """
+    stack = [goal]  # goal からたどっている途中のノード列 (逆順)
+    choice = [0]    # 各深さで次に試す前駆ノードの番号
+    while stack:
+        current = stack[-1]
+        if current == start:
+            yield stack[::-1]
+            stack.pop()
+            choice.pop()
+            continue
+        preds = prev_nodes[current]
+        i = choice[-1]
+        if i < len(preds):
+            choice[-1] = i + 1
+            stack.append(preds[i])
+            choice.append(0)
+        else:
+            stack.pop()
+            choice.pop()
+
+def count_all_paths(prev_nodes, start, goal, count=None):
+    """
+    start から goal までの最短経路の本数を、経路を列挙せずに数える (DP)。
+    count[v] = Σ count[p] (p は v の前駆ノード)、count[start] = 1。
+    同じ start・prev_nodes で別の goal を数えるときは、前回の count (辞書) を渡すと数え直さない。
+    """
+    if count is None:
+        count = {start: 1}
+    stack = [goal]
+    while stack:
+        current = stack[-1]
+        if current in count:
+            stack.pop()
+            continue
+        pending = [p for p in prev_nodes[current] if p not in count]
+        if pending:
+            stack.extend(pending)
+        else:
+            count[current] = sum(count[p] for p in prev_nodes[current])
+            stack.pop()
+    return count[goal]
+
 def enumerate_all_paths(prev_nodes, start, goal):
     """
     prev_nodes は dijkstra_all で得られた、各ノードの前駆ノードのリストを持つ辞書。
-    startからgoalまでのすべての経路（ノード列）を再帰的に列挙する。
+    startからgoalまでのすべての経路（ノード列）をリストで返す。
+    経路数が多いときは iter_all_paths で必要な分だけ取り出すこと。
     """
-    def _recurse(current):
-        if current == start:
-            return [[start]]
-        paths = []
-        for pred in prev_nodes[current]:
-            for path in _recurse(pred):
-                paths.append(path + [current])
-        return paths
-    return _recurse(goal)
+    return list(iter_all_paths(prev_nodes, start, goal))
 
 # =========================
 # 送信用 関数 (モーター用)
 # =========================
 def send_command_motor(command):
     """
-    車用ESP32 (ser_motor) に送るコマンド。
+    車用ESP32 (ser_motor) に送るコマンド。送信キューに積むだけで書き込みは待たない。
     """
     commands = {
         "straight": 0,
@@ -138,7 +260,7 @@ def send_command_motor(command):
         "back": 4
     }
     if command in commands:
-        ser_motor.write((commands[command]).to_bytes(1, "big"))
+        writer_motor.send((commands[command]).to_bytes(1, "big"))
         print(f"[SEND to MOTOR] {command} コマンドを送信しました")
     else:
         print(f"無効なコマンド: {command}")
@@ -198,244 +320,842 @@ def send_edges_to_led_controllers(used_edges):
     
     ・1～17 のエッジ番号を LED1 用
     ・18～26 のエッジ番号を LED2 用
+    (範囲はマップファイルの led_controllers で決める)
     両方に該当する場合はどちらも送る。
+    LED_PROTOCOL が "binary" なら、LED_FRAMEBUFFER で前の表示との差分をとり、
+    used_edges だけが点いた状態にする (前の経路の LED は消える)。
+    実際の書き込みは各LED用の送信タスクが行うので、ここでは待たない。
     """
-    # LED1用のエッジ
-    led1_edges = [e for e in used_edges if 1 <= e <= 17]
-    # LED2用のエッジ
-    led2_edges = [e for e in used_edges if 18 <= e <= 26]
+    writers = {"led1": writer_led1, "led2": writer_led2}
+    if LED_PROTOCOL == "binary":
+        with METRICS.timer("led_frames"):
+            frames = LED_FRAMEBUFFER.show(used_edges)
+        for name, frame in frames.items():
+            if writers.get(name) is not None:
+                writers[name].send(frame)
+                print(f"[SEND to {name.upper()}] {frame.hex(' ')}")
+        return
 
-    # 何らかのフォーマットで送る(ここでは JSONに "edges" フィールドを入れて送信)
-    # LED1に送信
-    if led1_edges:
-        led1_str = ",".join(str(e) for e in led1_edges) + "\n"
-        ser_led1.write(led1_str.encode("utf-8"))
-        print(f"[SEND to LED1] {led1_str.strip()}")
+    for name, (first, last) in BASE_MAP.led_controllers.items():
+        edges = [e for e in used_edges if first <= e <= last]
+        if edges and writers.get(name) is not None:
+            edge_str = ",".join(str(e) for e in edges) + "\n"
+            writers[name].send(edge_str.encode("utf-8"))
+            print(f"[SEND to {name.upper()}] {edge_str.strip()}")
 
-    # LED2に送信
-    if led2_edges:
-        led2_str = ",".join(str(e) for e in led2_edges) + "\n"
-        ser_led2.write(led2_str.encode("utf-8"))
-        print(f"[SEND to LED2] {led2_str.strip()}")
+def reset_led_controllers():
+    """全消灯のフレームを、未送信のフレームを捨てて送る (終了時用)。"""
+    writers = {"led1": writer_led1, "led2": writer_led2}
+    frames = LED_FRAMEBUFFER.clear() if LED_PROTOCOL == "binary" else {}
+    for name, writer in writers.items():
+        if writer is not None:
+            writer.send(frames.get(name, b"RESET\n"), RESET)
 
 
 # =========================
-# 非同期のモニタリング関数
+# 車・LED からの受信 (テレメトリ)
 # =========================
-'''
-async def monitor_and_respond(graph, path):
-    actions = decide_directions(graph, path)
-
-    # 最初に straight を送る
-    send_command_motor("straight")
-    path_index = 0
-
-    while path_index < len(actions):
-        print(f"現在のノード移動: {path[path_index]} → {path[path_index + 1]}")
-
-        signal = None
-        while signal is None:
-            # シリアルからの停止信号があるかチェック
-            if ser_motor.in_waiting > 0:
-                try:
-                    line = ser_motor.readline().decode().strip()
-                    signal = int(line)  # 1 or 0 と想定
-                except ValueError:
-                    signal = None
-            else:
-                await asyncio.sleep(0.1)
-
-        # 停止信号(1)を受信したら次のコマンドを送る
-        if signal == 1:
-            action = actions[path_index]
-            print(f"停止信号を受信 → 次のアクション: {action}")
-            send_command_motor(action)
-
-            # 左右旋回の場合は一定時間後に straight を送る (例)
-            if action == "left":
-                await asyncio.sleep(1.4513)  # 左折の後の待機時間
-                send_command_motor("straight")
-                print("1.4513秒後に straight を送信")
-            elif action == "right":
-                await asyncio.sleep(1.45)  # 右折の後の待機時間
-                send_command_motor("straight")
-                print("1.45秒後に straight を送信")
-
-            path_index += 1
-
-    print("GOAL地点に到達しました。経路上のコマンド送信を終了します。")
-'''
+# 以前の monitor_and_respond は停止信号を 0.1 秒おきのポーリングで待っていた。
+# 今は SerialReader がポートが読めるようになった時点で行を渡すので、
+#   車からの行   -> TELEMETRY (区間ごとの時間を記録し、購読中のクライアントに通知)
+#                   と motor_uploader (プログラム送信の ACK / NAK)
+#   LED からの行 -> "RESYNC" なら今の点灯状態を FULL で送り直す
+TELEMETRY = CarTelemetry()
+
+def on_motor_line(received, line):
+    TELEMETRY.on_line(received, line)
+    if motor_uploader is not None:
+        motor_uploader.on_reply(line)
+
+def on_led_line(name):
+    """LEDコントローラ name からの行を処理する handler を返す。"""
+    def handler(received, line):
+        if line == "RESYNC" and LED_PROTOCOL == "binary":
+            print(f"[{name.upper()}] RESYNC を受信したので全体を送り直す")
+            LED_FRAMEBUFFER.resync(name)
+            send_edges_to_led_controllers(sorted(LED_FRAMEBUFFER.lit))
+    return handler
 
 # =========================
-# ベースグラフ (固定ノード・固定エッジ)
+# ベースグラフ (マップファイルから読み込む)
 # =========================
-def create_base_graph():
-    g = Graph()
-    g.add_node('v0', (0,7))
-    g.add_node('v1', (2,7))
-    g.add_node('v2', (4,7))
-    g.add_node('v3', (6,7))
-    g.add_node('v4', (8,7))
-    g.add_node('v5', (0,5))
-    g.add_node('v6', (2,5))
-    g.add_node('v7', (4,5))
-    g.add_node('v8', (6,5))
-    g.add_node('v9', (8,5))
-    g.add_node('v10', (2,2))
-    g.add_node('v11', (4,2))
-    g.add_node('v12', (6,2))
-    g.add_node('v13', (8,2))
-    g.add_node('v14', (0,0))
-    g.add_node('v15', (2,0))
-    g.add_node('v16', (6,0))
-    g.add_node('v17', (8,0))
-
-# エッジ(無向)の定義
-    g.add_edge('v0', 'v1', 1) # 1
-    g.add_edge('v1', 'v2', 1) # 2
-    g.add_edge('v2', 'v3', 1) # 3
-    g.add_edge('v3', 'v4', 1) # 4
-    g.add_edge('v0', 'v5', 1) # 5
-    g.add_edge('v1', 'v6', 1) # 6
-    g.add_edge('v2', 'v7', 1) # 7
-    g.add_edge('v3', 'v8', 1) # 8
-    g.add_edge('v4', 'v9', 1) # 9
-    g.add_edge('v5', 'v6', 1) # 10
-    g.add_edge('v6', 'v7', 1) # 11
-    g.add_edge('v7', 'v8', 1) # 12
-    g.add_edge('v8', 'v9', 1) # 13
-    g.add_edge('v5', 'v14', 4) # 14
-    g.add_edge('v6', 'v10', 2) # 15
-    g.add_edge('v7', 'v11', 2) # 16
-    g.add_edge('v9', 'v13', 2) # 17
-    g.add_edge('v10', 'v11', 1) # 18
-    g.add_edge('v11', 'v12', 1) # 19
-    g.add_edge('v12', 'v13', 1) # 20
-    g.add_edge('v10', 'v15', 1) # 21
-    g.add_edge('v12', 'v16', 1) # 22
-    g.add_edge('v13', 'v17', 1) # 23
-    g.add_edge('v14', 'v15', 1) # 24
-    g.add_edge('v15', 'v16', 3) # 25
-    g.add_edge('v16', 'v17', 1) # 26
-    return g
-
-BASE_G = create_base_graph()
+# ノード・座標・エッジ・重み・LEDエッジ番号・LEDコントローラの受け持ちは maps/base_map.json に書く。
+# 初回の起動でコンパイルした CSR 配列 (maps/base_map.csr/) を、次からは mmap で開くだけ。
+MAP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "maps", "base_map.json")
+
+BASE_MAP = load_map(MAP_FILE)
+# 整数インデックス・配列ベースのグラフ (エッジ番号も CSR の配列に持つ)。
+# nodes / edges / positions は Graph と同じ形で読めるので decide_directions にもそのまま渡す
+BASE_CSR = BASE_MAP.csr
+# (前, 今, 次) のノードの組ごとの曲がる向き。候補経路のモーター命令はこの表からまとめて作る
+TURN_TABLE = TurnTable(BASE_CSR)
+# 全エッジの LED の点灯状態 (前回送ったフレームとの差分を作る)
+LED_FRAMEBUFFER = LedFramebuffer(BASE_MAP.led_controllers)
+# {"type": "map"} の応答 (compact / binary 形式の候補を読むための、ノード名とエッジ番号の表)
+MAP_TABLE_JSON = json.dumps(map_table(BASE_CSR))
+
+# 全点対最短距離テーブル (APSP_ENABLED のときだけ作る)
+APSP_TABLE = AllPairsTable(BASE_CSR) if APSP_ENABLED else None
+
+# ハブラベル (HUB_LABELS_ENABLED のときだけ)。前処理の結果は maps/base_map.hl/ に保存して次から読み込む
+HUB_LABELS = (load_or_build(os.path.splitext(MAP_FILE)[0] + ".hl", BASE_CSR)
+              if HUB_LABELS_ENABLED else None)
+
+def search_route(start_idx, goal_idx, blocked):
+    """
+    start から goal への (dist, prev_nodes) を求める。
+    APSP_TABLE があれば表引き (必要なときだけ部分的に再探索)、なければ Dijkstra か A*。
+    HUB_LABELS があれば、その距離 (通行止めなし) をヒューリスティックにした A* で
+    最短経路上のノードだけを確定させる (通行止めがあっても正しい)。
+    """
+    if APSP_TABLE is not None:
+        return APSP_TABLE.query(start_idx, goal_idx, blocked)
+    if HUB_LABELS is not None:
+        return BASE_CSR.astar(start_idx, goal_idx, blocked, heuristic=HUB_LABELS.heuristic(goal_idx))
+    if SEARCH_ALGORITHM == "astar":
+        return BASE_CSR.astar(start_idx, goal_idx, blocked, ASTAR_HEURISTIC)
+    return BASE_CSR.dijkstra(start_idx, blocked)
+
+# 1回の応答で送る候補経路の最大本数 (残りは cursor を指定して取りに来てもらう)
+CANDIDATE_PAGE_SIZE = 50
+# クライアントが "page_size" で指定できる本数の上限 (1ページ分の経路はメモリに並べるので)
+CANDIDATE_PAGE_MAX = 500
+# "mode": "k_shortest" (同距離に限らず、短い順に k 本) のときの既定の本数と上限
+K_SHORTEST_DEFAULT = 10
+K_SHORTEST_MAX = 200
+
+def build_candidate_page(paths_iter, cursor, page_size, total_paths):
+    """
+    paths_iter (iter_all_paths のジェネレータ) から page_size 本だけ取り出し、
+    JS側に送る候補経路ページを作る。next_cursor が None なら最後のページ。
+    """
+    page = list(itertools.islice(paths_iter, page_size))
+    candidate_paths = [[BASE_CSR.names[i] for i in path] for path in page]
+    # 各候補経路に対応するエッジ情報も作成 (整数ノードのままページ単位で引く)
+    candidate_edges = BASE_CSR.paths_edge_numbers(page)
+    next_cursor = cursor + len(candidate_paths)
+    return {
+        "candidate_paths": candidate_paths,
+        "candidate_edges": candidate_edges,
+        "cursor": cursor,
+        "next_cursor": next_cursor if next_cursor < total_paths else None,
+        "total_paths": total_paths
+    }
+
+# 同じ start / goal / 障害物の組み合わせの計算結果を覚えておくキャッシュ
+# PLANNER_MODE = "process" ではワーカーごとに別の ROUTE_CACHE になるので、親プロセスでも
+# 同じキーで覚えておき、ワーカーに渡す前に引く (run_planner)
+ROUTE_CACHE = RouteCache()
+
+def plan_route_key(start, goal, remove_edges, page_size):
+    return make_route_key(start, goal, remove_edges, page_size)
+
+def k_shortest_key(start, goal, remove_edges, k):
+    return make_route_key(start, goal, remove_edges, ("k_shortest", k))
+
+def cached_plan(key):
+    """ROUTE_CACHE にある plan (なければ None)。"""
+    plan = ROUTE_CACHE.get(key, BASE_CSR.fingerprint)
+    METRICS.incr("route_cache_hit" if plan is not None else "route_cache_miss")
+    return plan
+
+def cache_plan(key, plan):
+    """plan をおおよそのバイト数と一緒に ROUTE_CACHE に入れる。"""
+    nbytes = (len(plan["response_json"]) + sum(len(",".join(actions)) for actions in plan["candidate_actions"])
+              + sum(8 * len(path) for path in plan["candidate_index_paths"]))
+    ROUTE_CACHE.put(key, plan, nbytes, BASE_CSR.fingerprint)
+
+def plan_route(start, goal, remove_edges=(), page_size=CANDIDATE_PAGE_SIZE):
+    """
+    経路計算の本体 (WebSocket に依存しない部分)。戻り値の plan は
+      "response":          JS側に送る候補経路の最初のページ (見つからなければ error)
+      "response_json":     response を json.dumps したもの
+      "candidate_actions": 各候補経路のモーター命令リスト
+      "candidate_index_paths": 各候補経路 (整数ノード。compact / binary 形式の応答用)
+    を持つ辞書。同じ条件の問い合わせは探索せずに ROUTE_CACHE から返す。
+    plan はキャッシュと共有しているので書き換えないこと。
+    """
+    key = plan_route_key(start, goal, remove_edges, page_size)
+    plan = cached_plan(key)
+    if plan is not None:
+        return plan
+
+    # ベースグラフはコピーせず、指定エッジを「通行止め」オーバーレイとして重ねる
+    with METRICS.timer("overlay"):
+        blocked = BlockedEdges.from_remove_edges(BASE_CSR, remove_edges)
+    for node1, node2 in blocked.pairs:
+        print(f"→ エッジ削除: {node1} - {node2}")
+
+    # 整数インデックスで経路計算し、候補経路だけノード名に戻す
+    start_idx = BASE_CSR.index[start]
+    goal_idx = BASE_CSR.index[goal]
+    with METRICS.timer("search"):
+        _, prev_nodes = search_route(start_idx, goal_idx, blocked)
+    with METRICS.timer("count"):
+        total_paths = count_all_paths(prev_nodes, start_idx, goal_idx)
+    with METRICS.timer("enumerate"):
+        page = list(itertools.islice(iter_all_paths(prev_nodes, start_idx, goal_idx), page_size))
+        response = build_candidate_page(iter(page), 0, page_size, total_paths)
+    return finish_plan(key, response, page)
+
+def finish_plan(key, response, page):
+    """候補の最初のページ (response と整数ノードの経路 page) にモーター命令を付けて plan にし、キャッシュに入れる。"""
+    candidate_paths = response["candidate_paths"]
+    if candidate_paths and len(candidate_paths[0]) > 1:
+        with METRICS.timer("actions"):
+            candidate_actions = TURN_TABLE.compile_actions(page)
+    else:
+        response = {"error": "Path not found or path is too short"}
+        candidate_actions = []
+        page = []
+
+    with METRICS.timer("serialize"):
+        response_json = json.dumps(response)
+    plan = {
+        "response": response,
+        "response_json": response_json,
+        "candidate_actions": candidate_actions,
+        "candidate_index_paths": page
+    }
+    cache_plan(key, plan)
+    return plan
+
+def build_k_shortest_page(routes, cursor, has_more):
+    """KShortestPaths の (コスト, 経路) のリストから候補ページを作る (総数は分からないので total_paths は None)。"""
+    candidate_paths = [[BASE_CSR.names[i] for i in path] for _, path in routes]
+    next_cursor = cursor + len(routes)
+    return {
+        "mode": "k_shortest",
+        "candidate_paths": candidate_paths,
+        "candidate_edges": BASE_CSR.paths_edge_numbers([path for _, path in routes]),
+        "candidate_costs": [cost for cost, _ in routes],
+        "cursor": cursor,
+        "next_cursor": next_cursor if has_more else None,
+        "total_paths": None
+    }
+
+def k_shortest_routes(start, goal, remove_edges, count):
+    """start -> goal のループのない経路を短い順に count 本まで [(コスト, 整数ノードの経路), ...]。"""
+    with METRICS.timer("overlay"):
+        blocked = BlockedEdges.from_remove_edges(BASE_CSR, remove_edges)
+    with METRICS.timer("k_shortest"):
+        return KShortestPaths(BASE_CSR, BASE_CSR.index[start], BASE_CSR.index[goal], blocked).take(count)
+
+def plan_k_shortest(start, goal, remove_edges=(), k=K_SHORTEST_DEFAULT):
+    """
+    plan_route の k_shortest 版。最短距離の同点に限らず、コストの小さい順に k 本を候補にする
+    (候補ごとのコストは "candidate_costs")。plan の形とキャッシュの扱いは plan_route と同じ。
+    """
+    key = k_shortest_key(start, goal, remove_edges, k)
+    plan = cached_plan(key)
+    if plan is not None:
+        return plan
+    # 1本多く求めて、続きがあるかを調べる
+    routes = k_shortest_routes(start, goal, remove_edges, k + 1)
+    response = build_k_shortest_page(routes[:k], 0, len(routes) > k)
+    return finish_plan(key, response, [path for _, path in routes[:k]])
+
+def plan_k_shortest_page(start, goal, remove_edges, cursor, page_size, total_paths=None, encoding="json"):
+    """k_shortest の続きのページ (前のページの分も求め直す)。引数は plan_candidate_page と同じ。"""
+    routes = k_shortest_routes(start, goal, remove_edges, cursor + page_size + 1)[cursor:]
+    response = build_k_shortest_page(routes[:page_size], cursor, len(routes) > page_size)
+    if encoding == "json":
+        return response
+    return compact_response(response, [path for _, path in routes[:page_size]])
+
+def iter_candidate_paths(start, goal, remove_edges, cursor=0):
+    """候補経路を cursor 本目から順に返す (続きのページ用。探索をやり直す)。"""
+    with METRICS.timer("overlay"):
+        blocked = BlockedEdges.from_remove_edges(BASE_CSR, remove_edges)
+    start_idx = BASE_CSR.index[start]
+    goal_idx = BASE_CSR.index[goal]
+    with METRICS.timer("search"):
+        _, prev_nodes = search_route(start_idx, goal_idx, blocked)
+    return itertools.islice(iter_all_paths(prev_nodes, start_idx, goal_idx), cursor, None)
+
+def plan_candidate_page(start, goal, remove_edges, cursor, page_size, total_paths, encoding="json"):
+    """候補経路の続きのページを作る (ワーカーで実行できるよう、引数は全部ふつうの値)。"""
+    paths_iter = iter_candidate_paths(start, goal, remove_edges, cursor)
+    with METRICS.timer("enumerate"):
+        if encoding == "json":
+            return build_candidate_page(paths_iter, cursor, page_size, total_paths)
+        page = list(itertools.islice(paths_iter, page_size))
+    next_cursor = cursor + len(page)
+    return compact_page(page, cursor, next_cursor if next_cursor < total_paths else None,
+                        total_paths, BASE_CSR.fingerprint)
+
+def compact_response(response, index_paths):
+    """候補ページ response の compact 形式 (k_shortest ならコストも付ける)。"""
+    page = compact_page(index_paths, response["cursor"], response["next_cursor"],
+                        response["total_paths"], BASE_CSR.fingerprint)
+    if "candidate_costs" in response:
+        page.update(mode=response["mode"], candidate_costs=response["candidate_costs"])
+    return page
+
+def first_compact_page(plan):
+    """plan の最初のページの compact 形式 (キャッシュした plan からも作れる)。"""
+    with METRICS.timer("serialize_compact"):
+        return compact_response(plan["response"], plan["candidate_index_paths"])
+
+async def send_candidates(session, page, encoding, request_id):
+    """候補ページを encoding の形式で送る ("binary" はバイナリフレーム)。"""
+    if encoding == "binary":
+        with METRICS.timer("serialize_binary"):
+            frame = encode_binary(page, request_id)
+        await session.websocket.send(frame)
+    else:
+        await session.send(page, request_id)
+
+def resolve_selected_path(selected_path):
+    """compact / binary 形式のクライアントはノード番号で選択を返すことがあるので、ノード名に直す。"""
+    if selected_path and all(isinstance(node, int) for node in selected_path):
+        return [BASE_CSR.names[node] for node in selected_path]
+    return selected_path
+
+def plan_batch(queries):
+    """ベースグラフに対する dijkstra_batch (ワーカーで実行する用。APSP_TABLE があれば表引き)。"""
+    return dijkstra_batch(BASE_CSR, queries, APSP_TABLE)
+
+def plan_fleet(vehicles, remove_edges=(), order="given"):
+    """
+    複数台の車の経路を、ノード・エッジが同時刻に重ならないように計画する。
+    vehicles: [(車のid, start, goal), ...] (ノード名)
+    戻り値は車ごとの {"id", "path", "schedule", "arrival", "commands"}
+    (schedule は [(ノード, 到着, 出発), ...]、ゴールの出発は None、
+     commands は schedule どおりに走るモーター命令をカンマ区切りにしたもの。
+     ノードで待つ間は WAIT_STEP ごとに stop、来た道を戻るところは right,right の Uターンが入る)。
+    """
+    blocked = BlockedEdges.from_remove_edges(BASE_CSR, remove_edges)
+    names = BASE_CSR.names
+    requests = [(vid, BASE_CSR.index[start], BASE_CSR.index[goal]) for vid, start, goal in vehicles]
+    plans = FleetPlanner(BASE_CSR, blocked).plan(requests, order)
+    commands = iter(TURN_TABLE.compile_schedules(
+        [plan["schedule"] for plan in plans if "error" not in plan], WAIT_STEP))
+    results = []
+    for plan in plans:
+        if "error" in plan:
+            results.append(plan)
+            continue
+        path = [names[v] for v in plan["path"]]
+        results.append({
+            "id": plan["id"],
+            "path": path,
+            "schedule": [
+                (names[v], arrive, depart if depart != np.inf else None)
+                for v, arrive, depart in plan["schedule"]
+            ],
+            "arrival": plan["arrival"],
+            "commands": ",".join(next(commands))
+        })
+    return results
+
+def warm_up_planner():
+    """ワーカー起動時に1回探索して、ベースグラフを読み込んだ状態にしておく。"""
+    BASE_CSR.dijkstra(0)
+
+# 経路計算を実行するプール (既定はスレッド。inline にしたときだけイベントループの中で実行)
+PLANNER_POOL = PlannerPool(PLANNER_MODE, PLANNER_WORKERS, PLANNER_MAX_PENDING,
+                           initializer=warm_up_planner)
 
 # =========================
 # WebSocketハンドラ
 # =========================
-async def handle_connection(websocket):
-    async for message in websocket:
+SELECTION_TIMEOUT = 120.0  # 候補経路を送ってから選択結果を待つ最大秒数
+
+def choose_actions(plan, selected_path):
+    """選択された経路のモーター命令 (最初のページの候補なら計算済みのものを使う)。"""
+    candidate_paths = plan["response"]["candidate_paths"]
+    for path, path_actions in zip(candidate_paths, plan["candidate_actions"]):
+        if path == selected_path:
+            return path_actions
+    return TURN_TABLE.compile_actions([[BASE_CSR.index[node] for node in selected_path]])[0]
+
+def drive_selected_path(plan, selected_path, remove_edges=()):
+    """選択された経路を LED 用・車用 ESP32 の送信キューに積む。"""
+    actions = choose_actions(plan, selected_path) if MOTOR_ENABLED else None
+    drive_route(selected_path, actions)
+    if MOTOR_ENABLED:
+        # 走行中に通行止めが見つかったときのために、goal からの探索を今のうちに済ませておく
+        start_replanning(selected_path, remove_edges)
+
+def drive_route(path, actions, heading=None):
+    """
+    経路 path (ノード名) を LED に表示し、車にモーター命令 actions を送る。
+    heading は走り出す前の車の向き (経路を途中で引き直したとき。省略時は path[0] -> path[1])。
+    車の命令の配列 (MAX_COMMANDS) に入りきらない actions は、何も送らずに ValueError にする
+    (車に送ると後ろが切り捨てられ、途中で止まってしまう)。
+    """
+    if MOTOR_ENABLED and len(actions) > MAX_COMMANDS:
+        raise ValueError(f"route too long for the car: {len(actions)} steps (max {MAX_COMMANDS})")
+    # LED制御用ESP32へ送るエッジ情報は、選択された経路から算出
+    used_edges = BASE_CSR.path_edge_numbers(path)
+
+    # LED制御用ESP32へ送る
+    if LED1_ENABLED or LED2_ENABLED:
+        send_edges_to_led_controllers(used_edges)
+
+    # 3) 車用ESP32へモータ命令 (走行状況は TELEMETRY に届く)
+    if MOTOR_ENABLED:
+        # 例: ["straight","straight","left","straight", ...]
+        if MOTOR_PROTOCOL == "binary":
+            # 1命令1バイトのプログラムにして送る (送信中の古いプログラムは取り消される)
+            with METRICS.timer("motor_program"):
+                program = motor_uploader.start(actions, MOTOR_TURN_DELAY_MS)
+            TELEMETRY.start_program(actions, path, program.program_id, heading)
+            print(f"[SEND to MOTOR] program {program.program_id}: "
+                  f"{len(actions)} steps, {len(program.body)} bytes")
+            return
+
+        # 送信キューにまだ残っている古い delay / コマンド列は新しいもので置き換える
+        writer_motor.send(f"delay={MOTOR_TURN_DELAY_MS}\n".encode("utf-8"), REPLACE, "delay")
+        # すべてを一度に送る(カンマ区切り)
+        command_str = ",".join(actions) + "\n"
+        writer_motor.send(command_str.encode("utf-8"), REPLACE, "program")
+        TELEMETRY.start_program(actions, path, heading=heading)
+        print(f"[SEND to MOTOR] {command_str.strip()}")
+
+def stop_car():
+    """車を止める (送信中・未送信のプログラムは捨てる)。"""
+    if not MOTOR_ENABLED:
+        return
+    if MOTOR_PROTOCOL == "binary":
+        motor_uploader.stop()
+    else:
+        writer_motor.send(b"stop\n", RESET)
+
+# =========================
+# 走行中の経路の引き直し (D* Lite)
+# =========================
+# 車が進めなくなった ("BLOCKED <i>" がテレメトリに届いた) ときや、画面から
+# {"type": "block_edges", "edges": ["v3-v4", ...]} が届いたときに、車の今の位置から経路を直して
+# 新しいプログラムと LED の表示を送る。D* Lite の状態は経路を選んだときに作っておき (REPLANNER)、
+# 計算は1本のスレッド (REPLAN_EXECUTOR) で順番に行う。引き直しの時間は METRICS の "replan"。
+# 引き直しで見つかった通行止めは、この走行の中だけで使う (次の問い合わせの remove_edges には足さない)。
+REPLAN_VEHICLE = "car"  # 車は1台
+REPLANNER = RouteReplanner(BASE_CSR, TURN_TABLE, ASTAR_HEURISTIC)
+REPLAN_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="replan")
+_replan_tasks = set()
+
+def start_replanning(path, remove_edges=()):
+    """path (ノード名) を走り始めたので、D* Lite の状態を作る (待たない)。"""
+    idx_path = [BASE_CSR.index[node] for node in path]
+    blocked = BlockedEdges.from_remove_edges(BASE_CSR, remove_edges)
+    future = asyncio.get_running_loop().run_in_executor(
+        REPLAN_EXECUTOR, REPLANNER.start, REPLAN_VEHICLE, idx_path, blocked)
+    future.add_done_callback(report_replan_error)
+
+def report_replan_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"引き直しの準備に失敗: {future.exception()}")
+
+def position_indices(position):
+    """TELEMETRY.position() のノード名を整数ノードにする。"""
+    if position is None:
+        return None
+    index = BASE_CSR.index
+    converted = {"state": position["state"]}
+    if "node" in position:
+        converted["node"] = index[position["node"]]
+    for key in ("edge", "heading"):
+        if key in position:
+            converted[key] = tuple(index[node] for node in position[key])
+    return converted
+
+async def replan_route(pairs, source):
+    """
+    pairs ([(ノード名, ノード名), ...]) を通行止めにして、車の残りの経路にかかっていれば引き直して送る。
+    戻り値は {"type": "replan", ...} の応答。
+    """
+    idx_pairs = [(BASE_CSR.index[u], BASE_CSR.index[v]) for u, v in pairs]
+    position = position_indices(TELEMETRY.position())
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
+    with METRICS.timer("replan"):
+        result = await loop.run_in_executor(REPLAN_EXECUTOR, REPLANNER.block,
+                                            REPLAN_VEHICLE, idx_pairs, position)
+    ms = round((time.perf_counter() - t0) * 1000, 3)
+    if result is None:
+        return {"type": "replan", "source": source, "replanned": False, "ms": ms}
+
+    names = BASE_CSR.names
+    error = "goal is unreachable" if result["path"] is None else None
+    if error is None:
+        path = [names[i] for i in result["path"]]
+        heading = tuple(names[i] for i in result["heading"])
+        try:
+            drive_route(path, result["actions"], heading)
+        except ValueError as e:
+            # 引き直した経路が長すぎて車に送れない (古いプログラムのまま走らせない)
+            error = str(e)
+    if error is not None:
+        # goal に行けなくなった・送れる経路がない
+        stop_car()
+        loop.run_in_executor(REPLAN_EXECUTOR, REPLANNER.stop, REPLAN_VEHICLE)
+        notice = {"type": "replan", "source": source, "replanned": True, "path": None,
+                  "error": error, "ms": ms}
+    else:
+        notice = {"type": "replan", "source": source, "replanned": True, "path": path,
+                  "actions": result["actions"], "cost": result["cost"],
+                  "expanded": result["expanded"], "ms": ms}
+    print(f"[REPLAN] {source}: {notice.get('path')} ({ms} ms)")
+    TELEMETRY.notify(dict(notice, kind="replanned"))
+    return notice
+
+def on_telemetry_event(event):
+    """車が進めなくなったら、そのエッジを通行止めにして引き直す。"""
+    if event["kind"] != "blocked":
+        return
+    pairs = [(event["from"], event["to"])] if event.get("from") is not None else []
+    task = asyncio.get_running_loop().create_task(replan_route(pairs, "car"))
+    _replan_tasks.add(task)
+    task.add_done_callback(_replan_tasks.discard)
+
+TELEMETRY.subscribe(on_telemetry_event)
+
+async def handle_block_request(session, data):
+    """画面から通行止めが届いた ({"type": "block_edges", "edges": ["v3-v4", ...]})。"""
+    blocked = BlockedEdges.from_remove_edges(BASE_CSR, data.get("edges", []))
+    response = await replan_route(blocked.pairs, "ui")
+    await session.send(response, data.get("request_id"))
+
+async def handle_batch_request(session, data):
+    """まとめて経路計算 (候補の選択は待たない)。"""
+    request_id = data.get("request_id")
+    queries = [
+        (q["start"], q["goal"], q.get("remove_edges", []))
+        for q in data["queries"]
+    ]
+    with METRICS.timer("request_batch"):
+        results = await run_until_closed(session.websocket, PLANNER_POOL, plan_batch, queries)
+    await session.send({"type": "batch_result", "results": results}, request_id)
+    print(f"[WS送信] まとめて経路計算: {len(queries)} 件")
+
+async def handle_fleet_request(session, data):
+    """複数台の車の経路計画 (候補の選択は待たない)。"""
+    request_id = data.get("request_id")
+    vehicles = [(v["id"], v["start"], v["goal"]) for v in data["vehicles"]]
+    with METRICS.timer("request_fleet"):
+        plans = await run_until_closed(session.websocket, PLANNER_POOL, plan_fleet,
+                                       vehicles, data.get("remove_edges", []), data.get("order", "given"))
+    await session.send({"type": "fleet_plan", "plans": plans}, request_id)
+    print(f"[WS送信] 複数台の経路計画: {len(vehicles)} 台")
+
+async def run_planner(session, planner, key, *args):
+    """
+    planner (plan_route / plan_k_shortest) をプールで実行する。
+    PLANNER_MODE = "process" ではワーカーの ROUTE_CACHE は親から見えないので、親のキャッシュを先に引き、
+    ワーカーが作った plan も親のキャッシュに入れる (ヒット率と stats の route_cache が親で正しく数えられる)。
+    """
+    if PLANNER_POOL.mode != "process":
+        return await run_until_closed(session.websocket, PLANNER_POOL, planner, *args)
+    plan = ROUTE_CACHE.get(key, BASE_CSR.fingerprint)
+    if plan is not None:
+        METRICS.incr("route_cache_hit")
+        return plan
+    # 外れた分はワーカーの planner が route_cache_miss (またはワーカー側のヒット) を数える
+    plan = await run_until_closed(session.websocket, PLANNER_POOL, planner, *args)
+    cache_plan(key, plan)
+    return plan
+
+async def handle_route_request(session, data):
+    """1件の経路問い合わせ: 候補経路を送り、選択結果を待ってデバイスに送る。"""
+    request_id = data.get("request_id")  # 従来形式 (p5_test.js) なら None
+    # 従来形式の問い合わせは届いた順に id を振る (後から届いたものが前のものを置き換える)
+    query_id = request_id if request_id is not None else session.new_request_id()
+    remove_edges = data.get("remove_edges", [])
+    start = data["start"]
+    goal = data["goal"]
+    encoding = data.get("encoding", "json")
+    mode = data.get("mode", "shortest")
+    print(f"[WS受信] start={start}, goal={goal}, remove_edges={remove_edges}, request_id={request_id}")
+    if encoding not in ENCODINGS:
+        await session.send({"error": f"unknown encoding: {encoding}"}, request_id)
+        return
+
+    if mode == "k_shortest":
+        # 短い順に k 本 (続きのページも k 本ずつ)
+        size_key, page_size, page_max = "k", K_SHORTEST_DEFAULT, K_SHORTEST_MAX
+        planner, page_planner, plan_key = plan_k_shortest, plan_k_shortest_page, k_shortest_key
+    elif mode == "shortest":
+        size_key, page_size, page_max = "page_size", CANDIDATE_PAGE_SIZE, CANDIDATE_PAGE_MAX
+        planner, page_planner, plan_key = plan_route, plan_candidate_page, plan_route_key
+    else:
+        await session.send({"error": f"unknown mode: {mode}"}, request_id)
+        return
+    page_size = data.get(size_key, page_size)
+    if isinstance(page_size, bool) or not isinstance(page_size, int):
+        await session.send({"error": f"{size_key} must be an integer: {page_size!r}"}, request_id)
+        return
+    page_size = max(1, min(page_size, page_max))
+    with METRICS.timer("request_route"):
+        plan = await run_planner(session, planner, plan_key(start, goal, remove_edges, page_size),
+                                 start, goal, remove_edges, page_size)
+    response = plan["response"]
+
+    if "error" in response:
+        await session.send_json(plan["response_json"], request_id)
+        return
+
+    candidate_paths = response["candidate_paths"]
+    total_paths = response["total_paths"]
+    print("最短経路の候補が見つかった。JS側に候補経路を送信する。フハハ")
+
+    # 候補を送る前に選択待ちとして登録しておく (選択結果が先に届いても取りこぼさない)
+    query = session.expect_selection(query_id, legacy=request_id is None)
+    if query.superseded:
+        # 計算している間に新しい問い合わせが届いた (古い候補は送らない)
+        print(f"新しい問い合わせに置き換えられたので候補を送らない (start={start}, goal={goal})")
+        return
+
+    # {"cursor": n} が届いたら続きのページを返す
+    async def send_page(session, data):
+        cursor = data["cursor"]
+        page = await run_until_closed(session.websocket, PLANNER_POOL, page_planner,
+                                      start, goal, remove_edges, cursor, page_size, total_paths, encoding)
+        await send_candidates(session, page, encoding, request_id)
+        print(f"[WS送信] 候補経路の続き (cursor={cursor}) を送信した。")
+    # 続きのページも run_request で実行する (失敗したら同じ request_id でエラーを返す)
+    query.on_cursor = lambda cursor: run_request(session, send_page,
+                                                 {"cursor": cursor, "request_id": request_id})
+
+    # JS側に候補経路と対応するエッジ情報を送信する (最初のページだけ)
+    if encoding == "json":
+        await session.send_json(plan["response_json"], request_id)
+    else:
+        await send_candidates(session, first_compact_page(plan), encoding, request_id)
+    print(f"[WS送信] 候補経路 {len(candidate_paths)}/{total_paths} 本を送信した。JS側の選択を待機する。")
+
+    # JS側から選択結果を受信する
+    try:
+        selection_data = await session.wait_selection(query)
+    except asyncio.TimeoutError:
+        print(f"選択待ちがタイムアウトした (request_id={request_id})")
+        await session.send({"error": "selection timed out"}, request_id)
+        return
+    except SelectionSuperseded:
+        print(f"新しい問い合わせが届いたので選択待ちをやめた (start={start}, goal={goal})")
+        await session.send({"error": "superseded by a newer request"}, request_id)
+        return
+
+    selected_path = resolve_selected_path(selection_data["selected_path"])
+    if not selected_path:
+        # 選択情報が空なら、デフォルトで最初の候補を使用する
+        selected_path = candidate_paths[0]
+        print("選択情報が受信できなかったので、デフォルトの経路を使用する。")
+    else:
+        print(f"JS側から選択された経路: {selected_path}")
+
+    drive_selected_path(plan, selected_path, remove_edges)
+    if selection_data.get("ack"):
+        # {"selected_path": ..., "ack": true} なら送信キューに積み終えたことを知らせる (負荷試験用)
+        await session.send({"type": "selection_applied"}, request_id)
+
+# =========================
+# 計測値・プロファイラ ({"type": "stats"} / {"type": "profile"})
+# =========================
+def serial_devices():
+    """{デバイス名: (SerialWriter, SerialReader)} (開いているものだけ)。"""
+    devices = {"motor": (writer_motor, reader_motor), "led1": (writer_led1, reader_led1),
+               "led2": (writer_led2, reader_led2)}
+    return {name: pair for name, pair in devices.items() if pair[0] is not None}
+
+def collect_stats():
+    return {
+        "type": "stats",
+        "metrics": METRICS.snapshot(),
+        "route_cache": ROUTE_CACHE.stats(),
+        "planner": PLANNER_POOL.stats(),
+        "serial": {name: {"write": writer.stats(), "read": reader.stats() if reader else None}
+                   for name, (writer, reader) in serial_devices().items()},
+        "led": LED_FRAMEBUFFER.stats(),
+        "profiler": {"running": PROFILER.running}
+    }
+
+def prometheus_text():
+    devices = serial_devices()
+    gauges = {
+        "route_cache_entries": ROUTE_CACHE.stats()["entries"],
+        "route_cache_bytes": ROUTE_CACHE.stats()["bytes"],
+        "planner_pending": PLANNER_POOL.stats()["pending"],
+        "serial_queue_depth": {name: writer.depth for name, (writer, _) in devices.items()},
+        "serial_bytes_written": {name: writer.bytes_written for name, (writer, _) in devices.items()},
+        "serial_frames_dropped": {name: writer.dropped for name, (writer, _) in devices.items()}
+    }
+    return METRICS.prometheus(gauges)
+
+def profile_number(data, key, default):
+    """プロファイラの設定値を数として読む。数でなければ ValueError (範囲は SamplingProfiler.start が丸める)。"""
+    value = data.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+        raise ValueError(f"{key} must be a number: {value!r}")
+    return float(value)
+
+def handle_profile(data):
+    """
+    サンプリングプロファイラの操作。
+    {"type": "profile", "action": "start", "interval_ms": 5, "duration_s": 30} で始め、
+    "stop" で止めて結果を返す ("status" は止めずに途中の結果を返す)。
+    interval_ms / duration_s は SamplingProfiler.start が PROFILE_INTERVAL_MS / PROFILE_DURATION_S の範囲に丸める。
+    計測できるのはこのプロセスのスレッドだけ (PLANNER_MODE = "process" のワーカーは含まない)。
+    """
+    action = data.get("action", "status")
+    if action == "start":
+        interval_ms = profile_number(data, "interval_ms", 5.0)
+        duration_s = profile_number(data, "duration_s", 30.0)
+        started = PROFILER.start(interval_ms, duration_s)
+        return {"type": "profile", "running": True, "started": started}
+    if action == "stop":
+        return dict(PROFILER.stop(), type="profile")
+    return dict(PROFILER.report(), type="profile")
+
+async def run_request(session, handler, data):
+    """1件の問い合わせを実行し、エラーは同じ request_id を付けて返す。"""
+    try:
+        await handler(session, data)
+    except ConnectionError as e:
+        # 計算中にクライアントが切断した (計算は取り消し済み)
+        print(f"切断: {e}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"エラー: {e}")
         try:
-            data = json.loads(message)
-            remove_edges = data.get("remove_edges", [])
-            start = data["start"]
-            goal = data["goal"]
-            print(f"[WS受信] start={start}, goal={goal}, remove_edges={remove_edges}")
-
-            # ベースグラフをコピー
-            graph = copy.deepcopy(BASE_G)
-
-            # 指定エッジの削除
-            for edge_str in remove_edges:
-                node1, node2 = edge_str.split('-')
-                if node1 in graph.edges and node2 in graph.edges:
-                    print(f"→ エッジ削除: {node1} - {node2}")
-                    graph.delete_edge(node1, node2)
-
-            # dijkstra_all による経路計算
-            distances, prev_nodes = dijkstra_all(graph, start)
-            candidate_paths = enumerate_all_paths(prev_nodes, start, goal)
-
-            if candidate_paths and len(candidate_paths[0]) > 1:
-                print("最短経路の候補が見つかった。JS側に候補経路を送信する。フハハ")
-                # 各候補経路に対応するエッジ情報も作成（必要に応じて）
-                candidate_edges = []
-                for path in candidate_paths:
-                    used_edges = []
-                    for i in range(len(path) - 1):
-                        n1, n2 = path[i], path[i+1]
-                        if (n1, n2) in EDGE_NUM_MAP:
-                            used_edges.append(EDGE_NUM_MAP[(n1, n2)])
-                    candidate_edges.append(used_edges)
-                
-                # JS側に候補経路と対応するエッジ情報を送信する
-                response = {
-                    "candidate_paths": candidate_paths,
-                    "candidate_edges": candidate_edges
-                }
-                await websocket.send(json.dumps(response))
-                print("[WS送信] 複数の候補経路を送信した。JS側の選択を待機する。")
-
-                # JS側から選択結果を受信する
-                selection_msg = await websocket.recv()
-                selection_data = json.loads(selection_msg)
-                if "selected_path" in selection_data:
-                    selected_path = selection_data["selected_path"]
-                    print(f"JS側から選択された経路: {selected_path}")
+            await session.send({"error": str(e)}, data.get("request_id"))
+        except Exception:
+            pass
+
+# 受信ループの中ですぐに返すメッセージ (タスクを作らないので busy でも受け付ける)
+INLINE_MESSAGE_TYPES = ("stats", "map", "profile", "subscribe", "unsubscribe")
+
+async def handle_connection(websocket):
+    """
+    1接続ぶんの受信ループ。問い合わせはそれぞれ別タスクで並行に処理し、
+    selected_path / cursor は Session が該当する問い合わせに振り分ける。
+    実行中の問い合わせが SESSION_MAX_REQUESTS 件あるあいだは、新しい問い合わせを {"type": "busy"} で断る。
+    """
+    session = Session(websocket, SELECTION_TIMEOUT, max_requests=SESSION_MAX_REQUESTS)
+    subscribed = False
+    try:
+        async for message in websocket:
+            try:
+                with METRICS.timer("json_parse"):
+                    data = json.loads(message)
+            except ValueError as e:
+                print(f"エラー: {e}")
+                await websocket.send(json.dumps({"error": str(e)}))
+                continue
+
+            if not isinstance(data, dict):
+                await websocket.send(json.dumps({"error": "message must be a JSON object"}))
+                continue
+
+            # 1件のメッセージの処理で失敗しても、接続と実行中の問い合わせは残す
+            try:
+                creates_task = "selected_path" not in data and data.get("type") not in INLINE_MESSAGE_TYPES
+                if creates_task and session.busy:
+                    # 問い合わせ (と cursor の続きのページ) はタスクを作る前に断る。選択結果は待っている
+                    # 問い合わせを終わらせるものなので、いつでも受け付ける
+                    METRICS.incr("session_busy")
+                    await session.send({"type": "busy", "error": "too many requests in flight",
+                                        "limit": session.max_requests}, data.get("request_id"))
+                    continue
+
+                if "selected_path" in data or "cursor" in data:
+                    if not session.route(data):
+                        print(f"対応する問い合わせがないメッセージを無視: {data}")
+                        await session.send({"error": "no pending request for this message"},
+                                           data.get("request_id"))
+                    continue
+
+                if data.get("type") == "stats":
+                    # 計測値 ({"format": "prometheus"} ならテキスト形式)
+                    if data.get("format") == "prometheus":
+                        stats = {"type": "stats", "format": "prometheus", "text": prometheus_text()}
+                    else:
+                        stats = collect_stats()
+                    await session.send(stats, data.get("request_id"))
+                    continue
+                if data.get("type") == "map":
+                    # compact / binary 形式の候補を読むための、ノード名とエッジ番号の表
+                    await session.send_json(MAP_TABLE_JSON, data.get("request_id"))
+                    continue
+                if data.get("type") == "profile":
+                    await session.send(handle_profile(data), data.get("request_id"))
+                    continue
+                if data.get("type") == "subscribe":
+                    # 車の走行状況の通知を受け取る (最初に今の状態を送る)
+                    await session.send(TELEMETRY.snapshot(), data.get("request_id"))
+                    if not subscribed:
+                        TELEMETRY.subscribe(session.push)
+                        subscribed = True
+                    continue
+                if data.get("type") == "unsubscribe":
+                    TELEMETRY.unsubscribe(session.push)
+                    subscribed = False
+                    continue
+
+                if data.get("type") == "batch":
+                    session.spawn(run_request(session, handle_batch_request, data))
+                elif data.get("type") == "fleet":
+                    session.spawn(run_request(session, handle_fleet_request, data))
+                elif data.get("type") == "block_edges":
+                    session.spawn(run_request(session, handle_block_request, data))
                 else:
-                    # 選択情報がなければ、デフォルトで最初の候補を使用する
-                    selected_path = candidate_paths[0]
-                    print("選択情報が受信できなかったので、デフォルトの経路を使用する。")
-                
-                # LED制御用ESP32へ送るエッジ情報は、選択された経路から算出
-                used_edges = []
-                for i in range(len(selected_path)-1):
-                    n1 = selected_path[i]
-                    n2 = selected_path[i+1]
-                    if (n1, n2) in EDGE_NUM_MAP:
-                        used_edges.append(EDGE_NUM_MAP[(n1, n2)])
-
-                # LED制御用ESP32へ送る
-                if LED1_ENABLED or LED2_ENABLED:
-                    send_edges_to_led_controllers(used_edges)
-
-                # 3) 車用ESP32へモータ命令 (monitor_and_respond)
-                if MOTOR_ENABLED:
-
-                    ser_motor.write(b"delay=1120\n") 
-
-                    actions = decide_directions(graph, path)
-                    # 例: ["straight","straight","left","straight", ...]
-                    # すべてを一度に送る(カンマ区切り)
-                    command_str = ",".join(actions) + "\n"
-                    ser_motor.write(command_str.encode("utf-8"))
-                    print(f"[SEND to MOTOR] {command_str.strip()}")
-            else:
-                response = {"error": "Path not found or path is too short"}
-                await websocket.send(json.dumps(response))
-
-        except Exception as e:
-            print(f"エラー: {e}")
-            await websocket.send(json.dumps({"error": str(e)}))
+                    session.spawn(run_request(session, handle_route_request, data))
+            except Exception as e:
+                print(f"エラー: {e}")
+                await session.send({"error": str(e)}, data.get("request_id"))
+    finally:
+        if subscribed:
+            TELEMETRY.unsubscribe(session.push)
+        await session.close()
 
 # ======= シリアル初期化 =======
 async def init_serial():
     global ser_motor, ser_led1, ser_led2
+    global writer_motor, writer_led1, writer_led2, motor_uploader
+    global reader_motor, reader_led1, reader_led2
 
     # MOTOR_ENABLED が Trueなら開く
     if MOTOR_ENABLED:
         print("Opening motor port...")
         ser_motor = serial.Serial(COM_PORT_MOTOR, BAUD_RATE)
-        time.sleep(1)
+        time.sleep(SERIAL_OPEN_WAIT)
         ser_motor.flushInput()
         ser_motor.flushOutput()
+        writer_motor = SerialWriter("MOTOR", ser_motor)
+        writer_motor.start()
+        # 返事を読めるので、ACK を待ちながらチャンクを送る
+        motor_uploader = ProgramUploader(writer_motor, acknowledge=True)
+        reader_motor = SerialReader("MOTOR", ser_motor)
+        reader_motor.subscribe(on_motor_line)
+        reader_motor.start()
 
     # LED1_ENABLED が Trueなら開く
     if LED1_ENABLED:
         print("Opening LED1 port...")
         ser_led1 = serial.Serial(COM_PORT_LED1, BAUD_RATE)
-        time.sleep(1)
+        time.sleep(SERIAL_OPEN_WAIT)
         ser_led1.flushInput()
         ser_led1.flushOutput()
+        writer_led1 = SerialWriter("LED1", ser_led1)
+        writer_led1.start()
+        reader_led1 = SerialReader("LED1", ser_led1)
+        reader_led1.subscribe(on_led_line("led1"))
+        reader_led1.start()
 
     # LED2_ENABLED が Trueなら開く
     if LED2_ENABLED:
         print("Opening LED2 port...")
         ser_led2 = serial.Serial(COM_PORT_LED2, BAUD_RATE)
-        time.sleep(1)
+        time.sleep(SERIAL_OPEN_WAIT)
         ser_led2.flushInput()
         ser_led2.flushOutput()
+        writer_led2 = SerialWriter("LED2", ser_led2)
+        writer_led2.start()
+        reader_led2 = SerialReader("LED2", ser_led2)
+        reader_led2.subscribe(on_led_line("led2"))
+        reader_led2.start()
 
 # ======= メイン処理 (WebSocketサーバ) =======
 async def main():
@@ -447,24 +1167,27 @@ async def main():
         except KeyboardInterrupt:
             print("サーバー終了...")
         finally:
-            # 終了時リセット/STOPを送る
-            # LED1
-            if LED1_ENABLED and ser_led1 and ser_led1.is_open:
-                ser_led1.write(b"RESET\n")
-                time.sleep(0.3)
-                ser_led1.close()
-            # LED2
-            if LED2_ENABLED and ser_led2 and ser_led2.is_open:
-                ser_led2.write(b"RESET\n")
-                time.sleep(0.3)
-                ser_led2.close()
+            # 受信をやめる
+            for reader in (reader_motor, reader_led1, reader_led2):
+                if reader is not None:
+                    reader.close()
+            # 終了時リセット/STOPを送る (未送信のフレームは捨てて、送り切ってから閉じる)
+            # LED1 / LED2
+            reset_led_controllers()
+            if writer_led1 is not None:
+                await writer_led1.close()
+            if writer_led2 is not None:
+                await writer_led2.close()
             # MOTOR
-            if MOTOR_ENABLED and ser_motor and ser_motor.is_open:
+            if writer_motor is not None:
                 # 停止コマンド
-                ser_motor.write(b"stop\n")
-                time.sleep(0.3)
-                ser_motor.close()
+                if motor_uploader is not None and MOTOR_PROTOCOL == "binary":
+                    motor_uploader.stop()
+                else:
+                    writer_motor.send(b"stop\n", RESET)
+                await writer_motor.close()
             print("Close All Ports")
+            PLANNER_POOL.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,175 @@
+import heapq
+from collections import defaultdict
+
+# =========================
+# 複数台の車の経路計画 (優先度付き計画 + 時空間予約表)
+# =========================
+# 車を優先度の高い順に1台ずつ計画し、決まった経路は「どのノード/エッジを
+# いつからいつまで使うか」を予約表に書き込む。後の車は予約とぶつからないように
+# 時空間 A* (状態 = (ノード, 時刻)) で経路を探す。待機 (その場で WAIT_STEP だけ止まる) も使える。
+# エッジの重みをそのまま走行時間とみなす。
+#   ノード: 車がいる間 [到着, 出発] (閉区間) を予約。ゴールに着いた車はそこに止まり続ける。
+#   エッジ: 走っている間 (出発, 到着) を予約。道が細いので向きに関係なく1台ずつ。
+
+WAIT_STEP = 1.0
+INF = float("inf")
+
+
+class ReservationTable:
+    """ノードとエッジの使用時間帯の予約表。"""
+
+    def __init__(self):
+        self.nodes = defaultdict(list)  # v -> [(t0, t1), ...] (閉区間)
+        self.edges = defaultdict(list)  # (min(u,v), max(u,v)) -> [(t0, t1), ...] (開区間)
+
+    def node_free(self, v, t0, t1):
+        for a, b in self.nodes.get(v, ()):
+            if a <= t1 and t0 <= b:
+                return False
+        return True
+
+    def edge_free(self, u, v, t0, t1):
+        for a, b in self.edges.get((u, v) if u < v else (v, u), ()):
+            if a < t1 and t0 < b:
+                return False
+        return True
+
+    def last_node_use(self, v):
+        """ノード v の予約の終わりで一番遅い時刻 (予約がなければ -inf)。"""
+        return max((b for _, b in self.nodes.get(v, ())), default=-INF)
+
+    def reserve_node(self, v, t0, t1):
+        self.nodes[v].append((t0, t1))
+
+    def reserve_edge(self, u, v, t0, t1):
+        self.edges[(u, v) if u < v else (v, u)].append((t0, t1))
+
+
+class FleetPlanner:
+    """
+    CSRGraph 上で複数台の車の経路を、ノード・エッジが同時刻に重ならないように計画する。
+    plan() は優先度付き計画なので、解が見つからない車が出ることはある (その車は error)。
+    """
+
+    def __init__(self, csr, blocked=None, horizon_slack=50.0):
+        self.csr = csr
+        self.blocked = blocked
+        self.horizon_slack = horizon_slack
+
+    def plan(self, vehicles, order="given"):
+        """
+        vehicles: [(車のid, start, goal), ...] (start, goal は整数インデックス)
+        order: "given" なら並び順どおり、"longest_first" なら静的な距離が長い車から計画する。
+        戻り値は vehicles と同じ順の
+          {"id", "path": [整数インデックス], "schedule": [(ノード, 到着, 出発), ...], "arrival"}
+        のリスト (失敗した車は {"id", "error"})。
+        """
+        csr = self.csr
+        table = ReservationTable()
+        heuristics = {}
+        for _, _, goal in vehicles:
+            if goal not in heuristics:
+                # 無向グラフなので goal からの距離 = goal までの距離
+                heuristics[goal], _ = csr.dijkstra(goal, self.blocked)
+
+        # 計画前の車も、時刻0〜WAIT_STEP は出発地点にいる
+        for _, start, _ in vehicles:
+            table.reserve_node(start, 0.0, WAIT_STEP)
+
+        indexed = list(enumerate(vehicles))
+        if order == "longest_first":
+            indexed.sort(key=lambda item: -heuristics[item[1][2]][item[1][1]])
+
+        results = [None] * len(vehicles)
+        for i, (vid, start, goal) in indexed:
+            h = heuristics[goal]
+            if h[start] == INF:
+                results[i] = {"id": vid, "error": "goal is unreachable"}
+                continue
+            # 自分の出発地点の予約 (時刻0) はいったん外して探索する
+            table.nodes[start].remove((0.0, WAIT_STEP))
+            schedule = self._search(table, start, goal, h)
+            if schedule is None:
+                table.reserve_node(start, 0.0, WAIT_STEP)
+                results[i] = {"id": vid, "error": "no conflict-free route within the horizon"}
+                continue
+            self._reserve(table, schedule)
+            results[i] = {
+                "id": vid,
+                "path": [v for v, _, _ in schedule],
+                "schedule": schedule,
+                "arrival": schedule[-1][1]
+            }
+        return results
+
+    def _search(self, table, start, goal, h):
+        """時空間 A*。見つかれば [(ノード, 到着, 出発), ...] (ゴールの出発は inf)。"""
+        csr = self.csr
+        indptr = csr._indptr_mv
+        indices = csr._indices_mv
+        weights = csr._weights_mv
+        blocked = self.blocked.slots if self.blocked else None
+        horizon = h[start] + self.horizon_slack
+        goal_free_after = table.last_node_use(goal)
+
+        # 状態 (ノード, 時刻)。parent[状態] = 1つ前の状態
+        start_state = (start, 0.0)
+        parent = {start_state: None}
+        heap = [(h[start], 0.0, start)]
+        closed = set()
+        while heap:
+            _, t, v = heapq.heappop(heap)
+            state = (v, t)
+            if state in closed:
+                continue
+            closed.add(state)
+            if v == goal and t > goal_free_after:
+                return self._schedule(parent, state)
+            # その場で待機
+            tw = t + WAIT_STEP
+            if tw <= horizon and table.node_free(v, t, tw):
+                nxt = (v, tw)
+                if nxt not in parent:
+                    parent[nxt] = state
+                    heapq.heappush(heap, (tw + h[v], tw, v))
+            # 隣のノードへ移動
+            for k in range(indptr[v], indptr[v + 1]):
+                if blocked is not None and k in blocked:
+                    continue
+                u = indices[k]
+                ta = t + weights[k]
+                if ta + h[u] > horizon:
+                    continue
+                if not table.edge_free(v, u, t, ta) or not table.node_free(u, ta, ta):
+                    continue
+                nxt = (u, ta)
+                if nxt not in parent:
+                    parent[nxt] = state
+                    heapq.heappush(heap, (ta + h[u], ta, u))
+        return None
+
+    @staticmethod
+    def _schedule(parent, state):
+        states = []
+        while state is not None:
+            states.append(state)
+            state = parent[state]
+        states.reverse()
+        # 同じノードでの連続した待機をまとめて [ノード, 到着, 出発] にする
+        schedule = []
+        for v, t in states:
+            if schedule and schedule[-1][0] == v:
+                schedule[-1][2] = t
+            else:
+                schedule.append([v, t, t])
+        schedule[-1][2] = INF  # ゴールに着いたら止まり続ける
+        return [tuple(item) for item in schedule]
+
+    @staticmethod
+    def _reserve(table, schedule):
+        for i, (v, arrive, depart) in enumerate(schedule):
+            table.reserve_node(v, arrive, depart)
+            if i + 1 < len(schedule):
+                u, next_arrive, _ = schedule[i + 1]
+                table.reserve_edge(v, u, depart, next_arrive)
+
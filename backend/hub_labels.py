@@ -0,0 +1,245 @@
+import heapq
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+# =========================
+# 縮約階層 (Contraction Hierarchies) とハブラベル
+# =========================
+# ベースグラフは通行止め以外は変わらないので、事前に重い前処理をしておく。
+#   1. 縮約階層: 重要でないノードから順に取り除き (縮約)、最短距離を保つための近道 (ショートカット) を足す。
+#   2. ハブラベル: 各ノード v に「上位ノード (ハブ) h とその距離」の表 L(v) を持たせる。
+#      d(s, t) = min { L(s)[h] + L(t)[h] : h は両方の表にあるハブ }
+#      で、探索をせずに2つの表を突き合わせるだけで距離が求まる。
+# ラベルは CSR と同じく連続した配列で持ち、.npy に保存して mmap で開く (map_loader と同じ)。
+# 通行止めがあるときの距離はラベルでは分からないので、ラベルの距離 (通行止めなしの最短距離) を
+# A* のヒューリスティックとして使う。通行止めで距離が伸びるだけなので許容的なまま。
+
+INF = float("inf")
+WITNESS_SETTLE_LIMIT = 200  # ショートカットが必要か調べる局所探索で確定させるノード数の上限
+FORMAT_VERSION = 1
+_ARRAYS = ("ptr", "hubs", "dists", "rank")
+
+
+def _witness_distances(adj, source, skip, limit, max_dist):
+    """skip を通らずに source から max_dist 以内で届くノードへの距離 (探索は limit ノードまで)。"""
+    dist = {source: 0}
+    heap = [(0, source)]
+    settled = 0
+    while heap and settled < limit:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        if d > max_dist:
+            break
+        settled += 1
+        for v, w in adj[u].items():
+            if v == skip:
+                continue
+            nd = d + w
+            if nd < dist.get(v, INF):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return dist
+
+
+def _shortcuts(adj, v, limit):
+    """v を縮約したときに必要なショートカット [(u, x, 重み), ...] (u < x)。"""
+    neighbors = list(adj[v].items())
+    needed = []
+    for i, (u, wu) in enumerate(neighbors):
+        others = neighbors[i + 1:]
+        if not others:
+            continue
+        max_dist = wu + max(wx for _, wx in others)
+        witness = _witness_distances(adj, u, v, limit, max_dist)
+        for x, wx in others:
+            if witness.get(x, INF) > wu + wx:
+                needed.append((u, x, wu + wx))
+    return needed
+
+
+def contract(csr, limit=WITNESS_SETTLE_LIMIT):
+    """
+    CSRGraph を縮約し、(rank, up) を返す。
+    rank[v] は縮約した順番、up[v] は v より rank が高い隣接ノードへの [(u, 重み), ...] (ショートカット込み)。
+    順番は「エッジ差分 (増えるショートカット数 - 次数) + 縮約済みの隣接数」が小さいものから (遅延更新)。
+    """
+    n = csr.num_nodes
+    adj = [dict() for _ in range(n)]
+    indptr, indices, weights = csr.indptr.tolist(), csr.indices.tolist(), csr.weights.tolist()
+    for v in range(n):
+        for k in range(indptr[v], indptr[v + 1]):
+            u = indices[k]
+            if u != v and weights[k] < adj[v].get(u, INF):
+                adj[v][u] = weights[k]
+
+    deleted_neighbors = [0] * n
+
+    def priority(v):
+        return len(_shortcuts(adj, v, limit)) - len(adj[v]) + deleted_neighbors[v]
+
+    heap = [(priority(v), v) for v in range(n)]
+    heapq.heapify(heap)
+    rank = [-1] * n
+    up = [None] * n
+    order = 0
+    while heap:
+        _, v = heapq.heappop(heap)
+        if rank[v] >= 0:
+            continue
+        # 遅延更新: 優先度を計算し直して、まだ一番小さければ縮約する
+        p = priority(v)
+        if heap and p > heap[0][0]:
+            heapq.heappush(heap, (p, v))
+            continue
+        for u, x, w in _shortcuts(adj, v, limit):
+            if w < adj[u].get(x, INF):
+                adj[u][x] = w
+                adj[x][u] = w
+        up[v] = list(adj[v].items())
+        for u in adj[v]:
+            del adj[u][v]
+            deleted_neighbors[u] += 1
+        adj[v] = {}
+        rank[v] = order
+        order += 1
+    return rank, up
+
+
+class HubLabels:
+    """
+    ノードごとのハブラベル。ptr / hubs / dists は CSR と同じ形で、
+    ノード v のラベルは hubs[ptr[v]:ptr[v+1]] (ハブ番号の昇順) と同じ位置の dists。
+    """
+
+    def __init__(self, ptr, hubs, dists, rank, fingerprint=None):
+        self.ptr = np.ascontiguousarray(ptr, dtype=np.int64)
+        self.hubs = np.ascontiguousarray(hubs, dtype=np.int32)
+        self.dists = np.ascontiguousarray(dists, dtype=np.float64)
+        self.rank = np.ascontiguousarray(rank, dtype=np.int32)
+        self.fingerprint = fingerprint  # 元の CSRGraph の fingerprint
+        self._ptr_mv = memoryview(self.ptr)
+        self._hubs_mv = memoryview(self.hubs)
+        self._dists_mv = memoryview(self.dists)
+
+    @classmethod
+    def build(cls, csr, limit=WITNESS_SETTLE_LIMIT):
+        """縮約階層を作り、上位のノードから順にラベルを組み立てる。"""
+        rank, up = contract(csr, limit)
+        n = csr.num_nodes
+        labels = [None] * n
+        for v in sorted(range(n), key=rank.__getitem__, reverse=True):
+            # L(v) = {v: 0} と、上位の隣接 u のラベルに w(v, u) を足したものの最小値
+            label = {v: 0.0}
+            for u, w in up[v]:
+                for h, d in labels[u].items():
+                    if w + d < label.get(h, INF):
+                        label[h] = w + d
+            # 他のハブ経由の方が近いエントリは最短距離ではないので捨てる
+            for h in [h for h in label if h != v]:
+                d = label[h]
+                other = labels[h]
+                if any(dh + other[g] < d for g, dh in label.items() if g != h and g in other):
+                    del label[h]
+            labels[v] = label
+
+        ptr = np.zeros(n + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum([len(label) for label in labels])
+        hubs = np.empty(ptr[-1], dtype=np.int32)
+        dists = np.empty(ptr[-1], dtype=np.float64)
+        for v, label in enumerate(labels):
+            items = sorted(label.items())
+            hubs[ptr[v]:ptr[v + 1]] = [h for h, _ in items]
+            dists[ptr[v]:ptr[v + 1]] = [d for _, d in items]
+        return cls(ptr, hubs, dists, rank, csr.fingerprint)
+
+    # ---- 問い合わせ ----
+    def label(self, v):
+        lo, hi = self._ptr_mv[v], self._ptr_mv[v + 1]
+        return self.hubs[lo:hi], self.dists[lo:hi]
+
+    def distance(self, s, t):
+        """通行止めなしの s-t 最短距離 (到達できなければ inf)。"""
+        hs, ds = self.label(s)
+        ht, dt = self.label(t)
+        _, i, j = np.intersect1d(hs, ht, assume_unique=True, return_indices=True)
+        return float((ds[i] + dt[j]).min()) if len(i) else INF
+
+    def heuristic(self, goal):
+        """h(v) = 通行止めなしの v-goal 最短距離 を返す関数 (CSRGraph.astar に渡す)。"""
+        lo, hi = self._ptr_mv[goal], self._ptr_mv[goal + 1]
+        goal_label = dict(zip(self._hubs_mv[lo:hi].tolist(), self._dists_mv[lo:hi].tolist()))
+        ptr, hubs, dists = self._ptr_mv, self._hubs_mv, self._dists_mv
+
+        def h(v):
+            best = INF
+            for k in range(ptr[v], ptr[v + 1]):
+                dg = goal_label.get(hubs[k])
+                if dg is not None and dists[k] + dg < best:
+                    best = dists[k] + dg
+            return best
+        return h
+
+    def nbytes(self):
+        return self.ptr.nbytes + self.hubs.nbytes + self.dists.nbytes + self.rank.nbytes
+
+    # ---- 保存・読み込み ----
+    def save(self, out_dir):
+        """.npy 群 + meta.json に保存する (一時ディレクトリに書いてから差し替える)。"""
+        parent = os.path.dirname(os.path.abspath(out_dir))
+        tmp_dir = tempfile.mkdtemp(prefix=".labels-", dir=parent)
+        try:
+            for key in _ARRAYS:
+                np.save(os.path.join(tmp_dir, f"{key}.npy"), getattr(self, key))
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+                json.dump({"format": FORMAT_VERSION, "fingerprint": self.fingerprint}, f)
+            if os.path.isdir(out_dir):
+                shutil.rmtree(out_dir, ignore_errors=True)
+            try:
+                os.rename(tmp_dir, out_dir)
+            except OSError:
+                pass  # 先に別のプロセスが書き終えていたらそちらを使う
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        return out_dir
+
+    @classmethod
+    def load(cls, out_dir, mmap=True):
+        with open(os.path.join(out_dir, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("format") != FORMAT_VERSION:
+            raise ValueError(f"unsupported hub label format: {meta.get('format')}")
+        mode = "r" if mmap else None
+        arrays = {key: np.load(os.path.join(out_dir, f"{key}.npy"), mmap_mode=mode) for key in _ARRAYS}
+        return cls(fingerprint=meta["fingerprint"], **arrays)
+
+
+def load_or_build(out_dir, csr):
+    """保存済みのラベルが csr と同じグラフのものなら読み込み、違えば作り直して保存する。"""
+    if os.path.isdir(out_dir):
+        try:
+            labels = HubLabels.load(out_dir)
+            if labels.fingerprint == csr.fingerprint:
+                return labels
+        except (OSError, ValueError, KeyError):
+            pass
+    labels = HubLabels.build(csr)
+    labels.save(out_dir)
+    return labels
+
+
+if __name__ == "__main__":
+    # python hub_labels.py maps/base_map.json  (オフラインで前処理しておく)
+    from map_loader import load_map
+    for path in sys.argv[1:]:
+        csr = load_map(path).csr
+        out_dir = os.path.splitext(path)[0] + ".hl"
+        labels = HubLabels.build(csr)
+        labels.save(out_dir)
+        print(f"{path} -> {out_dir} ({len(labels.hubs) / csr.num_nodes:.1f} hubs/node, {labels.nbytes()} bytes)")
@@ -0,0 +1,157 @@
+import heapq
+import itertools
+
+# =========================
+# k 最短経路 (ループなし、コストの小さい順)
+# =========================
+# dijkstra_all / iter_all_paths の候補は「最短距離とまったく同じ」経路だけなので、
+# 同距離の経路がなければ候補は1本になる。k_shortest モードでは 2 番目、3 番目 ... に短い経路も候補にする。
+# Yen のアルゴリズム: 見つけた経路の途中のノード (spur) から、根元 (start から spur まで) のノードと、
+# 同じ根元を持つ既出経路の次のエッジを通らずに goal まで行く最短経路 (spur 経路) を探し、候補に積む。
+# spur 経路の探索を速くするため、最初に goal からの最短経路木 (各ノードから goal への最短距離と次のノード) を
+# 1 回だけ作って使い回す。spur 経路は木の距離をヒューリスティックにした A* で探す。ヒューリスティックは
+# 禁止のないグラフの正確な距離なので無矛盾で、取り出したノードから先の木の経路が禁止されたノードを
+# 通らなければ、そこで探索を終えて残りは木の経路をつなぐ (たいてい数ノードで終わる)。
+# 分岐した位置より手前の spur は前の経路で調べ済みなので飛ばす (Lawler の改良)。
+
+
+class KShortestPaths:
+    """
+    start -> goal (整数ノード) のループのない経路を、コストの小さい順に1本ずつ返すイテレータ。
+    next() は (コスト, 経路) を返し、もうなければ StopIteration。blocked (BlockedEdges) は通らない。
+    グラフは無向 (CSR に両方向のエッジがある) とする。
+    """
+
+    def __init__(self, csr, start, goal, blocked=None):
+        self.csr = csr
+        self.start = start
+        self.goal = goal
+        self.blocked_slots = blocked.slots if blocked else frozenset()
+        # goal からの最短経路木。無向グラフなので to_goal[v] は v から goal への距離、next_hop[v] は次のノード
+        self.to_goal, prev = csr.dijkstra(goal, blocked)
+        self.next_hop = [p[0] if p else -1 for p in prev]
+        self.found = []        # 返した経路 [(コスト, 経路, 分岐した位置, 累積コスト), ...]
+        self._candidates = []  # (コスト, 順番, 経路, 分岐した位置)
+        self._seen = set()
+        self._order = itertools.count()
+        self._expanded = True  # 最後に返した経路から spur を作ったか
+        self.spur_searches = 0  # 計測値 (A* の回数)
+        if start != goal and self.to_goal[start] != float("inf"):
+            path = self._tree_path(start)
+            self._push(self.to_goal[start], path, 0)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._expanded:
+            self._expand(*self.found[-1][1:])
+            self._expanded = True
+        if not self._candidates:
+            raise StopIteration
+        cost, _, path, deviation = heapq.heappop(self._candidates)
+        self.found.append((cost, path, deviation, self._cumulative(path)))
+        self._expanded = False
+        return cost, path
+
+    def take(self, k):
+        """次の k 本 (足りなければあるだけ)。"""
+        return list(itertools.islice(self, k))
+
+    # ---- 内部 ----
+    def _push(self, cost, path, deviation):
+        key = tuple(path)
+        if key not in self._seen:
+            self._seen.add(key)
+            heapq.heappush(self._candidates, (cost, next(self._order), path, deviation))
+
+    def _cumulative(self, path):
+        weights = self.csr.weights
+        cum = [0.0]
+        for u, v in zip(path, path[1:]):
+            cum.append(cum[-1] + float(weights[self.csr.slot(u, v)]))
+        return cum
+
+    def _tree_path(self, v):
+        path = [v]
+        while v != self.goal:
+            v = self.next_hop[v]
+            path.append(v)
+        return path
+
+    def _expand(self, path, deviation, cum):
+        """path の deviation 番目以降の各ノードを spur にして候補を作る。"""
+        slot = self.csr.slot
+        for i in range(deviation, len(path) - 1):
+            spur = path[i]
+            root = path[:i + 1]
+            # 同じ根元を持つ既出経路が次に使ったエッジは通らない
+            banned_slots = {slot(spur, p[i + 1]) for _, p, _, _ in self.found
+                            if len(p) > i + 1 and p[:i + 1] == root}
+            spur_result = self._spur(spur, set(root[:-1]), banned_slots)
+            if spur_result is not None:
+                tail_cost, tail = spur_result
+                self._push(cum[i] + tail_cost, root[:-1] + tail, i)
+
+    def _tree_clear(self, v, avoid, memo):
+        """v から木をたどって goal まで、avoid のノードを通らずに行けるか (memo はこの spur の中だけで使う)。"""
+        walk = []
+        while True:
+            if v in memo:
+                ok = memo[v]
+                break
+            if v in avoid or v < 0:
+                ok = False
+                break
+            if v == self.goal:
+                ok = True
+                break
+            walk.append(v)
+            v = self.next_hop[v]
+        for w in walk:
+            memo[w] = ok
+        return ok
+
+    def _spur(self, s, banned_nodes, banned_slots):
+        """s から goal までの、banned_nodes / banned_slots を通らない最短経路 (コスト, 経路) か None。"""
+        to_goal = self.to_goal
+        inf = float("inf")
+        avoid = banned_nodes | {s}  # 木の経路は s にも戻れない
+        memo = {}
+        self.spur_searches += 1
+        indptr = self.csr._indptr_mv
+        indices = self.csr._indices_mv
+        weights = self.csr._weights_mv
+        blocked_slots = self.blocked_slots
+        g = {s: 0.0}
+        parent = {s: -1}
+        closed = set()
+        heap = [(to_goal[s], 0.0, s)]
+        while heap:
+            _, d, u = heapq.heappop(heap)
+            if u in closed:
+                continue
+            closed.add(u)
+            # u から先は木の経路が使えるなら、そこで最短 (ヒューリスティックが正確な下限なので)
+            if u == self.goal or (u != s and self._tree_clear(u, avoid, memo)):
+                path = []
+                w = u
+                while w >= 0:
+                    path.append(w)
+                    w = parent[w]
+                path.reverse()
+                if u != self.goal:
+                    path += self._tree_path(u)[1:]
+                return d + to_goal[u], path
+            for k in range(indptr[u], indptr[u + 1]):
+                if k in blocked_slots or k in banned_slots:
+                    continue
+                v = indices[k]
+                if v in closed or v in banned_nodes or to_goal[v] == inf:
+                    continue
+                nd = d + weights[k]
+                if nd < g.get(v, inf):
+                    g[v] = nd
+                    parent[v] = u
+                    heapq.heappush(heap, (nd + to_goal[v], nd, v))
+        return None
@@ -0,0 +1,161 @@
+# =========================
+# LED の状態管理と2進フレーム
+# =========================
+# 全エッジ (両方のLEDコントローラ分) の点灯状態をバックエンド側で持ち、
+# 前回送ったフレームとの差分だけを小さな2進フレームで送る。
+# 経路が変わっても RESET → 全部点け直し にならないので、LED がちらつかない。
+#
+# フレーム (1台のコントローラ宛て):
+#   [0xA5][種類][seq][n][payload (n バイト)][チェックサム]
+#     seq         : 0〜255 の通し番号 (コントローラごと、一周したら 0 に戻る)
+#     チェックサム : 種類・seq・n・payload の XOR
+#   種類 FULL  (0x01): payload = 点灯状態のビットマスク (ローカル番号 0 が先頭バイトの bit0)
+#   種類 DELTA (0x02): payload = [基準の seq][変更 1][変更 2]...
+#                      変更は bit7 = 点灯(1)/消灯(0)、bit0〜6 = ローカル番号
+#                      コントローラの最後の seq が「基準の seq」と違えば適用せず、次の FULL を待つ
+# ローカル番号は「エッジ番号 - そのコントローラの最初の番号」(受け持ちはマップファイルの led_controllers)。
+# 先頭が 0xA5 でなければ、ファームウェアは従来の "1,2,3\n" / "RESET\n" として扱う。
+FRAME_MAGIC = 0xA5
+FRAME_FULL = 0x01
+FRAME_DELTA = 0x02
+KEYFRAME_INTERVAL = 16  # 差分がこの数続いたら、取りこぼしに備えて FULL を送る
+
+
+def _checksum(body):
+    c = 0
+    for b in body:
+        c ^= b
+    return c
+
+
+def encode_frame(kind, seq, payload, magic=FRAME_MAGIC):
+    body = bytes([kind, seq & 0xFF, len(payload)]) + bytes(payload)
+    return bytes([magic]) + body + bytes([_checksum(body)])
+
+
+def decode_frame(data, magic=FRAME_MAGIC):
+    """
+    先頭の1フレームを読んで (種類, seq, payload, 使ったバイト数) を返す。
+    まだ全部届いていなければ None、壊れていれば ValueError。
+    magic を変えればモーター用のフレーム (motor_program.py) にも使える。
+    """
+    if len(data) < 4:
+        return None
+    if data[0] != magic:
+        raise ValueError("unexpected frame magic")
+    n = data[3]
+    if len(data) < 5 + n:
+        return None
+    body = bytes(data[1:4 + n])
+    if _checksum(body) != data[4 + n]:
+        raise ValueError("LED frame checksum mismatch")
+    return body[0], body[1], body[3:], 5 + n
+
+
+def full_payload(lit, count):
+    """ローカル番号の集合 lit -> ビットマスク。"""
+    mask = bytearray((count + 7) // 8)
+    for i in lit:
+        mask[i >> 3] |= 1 << (i & 7)
+    return bytes(mask)
+
+
+def apply_frame(state, kind, seq, payload, last_seq):
+    """
+    フレームを点灯状態 (bool のリスト) に適用し、新しい last_seq を返す (ファームウェアと同じ処理)。
+    DELTA の基準が合わなければ何もせず None を返す (FULL を待つ)。
+    """
+    if kind == FRAME_FULL:
+        for i in range(len(state)):
+            state[i] = bool(payload[i >> 3] & (1 << (i & 7)))
+        return seq
+    if kind == FRAME_DELTA:
+        if last_seq is None or payload[0] != last_seq:
+            return None
+        for entry in payload[1:]:
+            i = entry & 0x7F
+            if i < len(state):
+                state[i] = bool(entry & 0x80)
+        return seq
+    raise ValueError(f"unknown LED frame type: {kind}")
+
+
+class LedController:
+    """1台のLEDコントローラの受け持ち範囲と、最後に送った状態。"""
+
+    def __init__(self, name, first, last):
+        if not 0 < last - first + 1 <= 128:
+            raise ValueError(f"LED controller {name} must have 1-128 edges")  # DELTA の番号は7ビット
+        self.name = name
+        self.first = first
+        self.last = last
+        self.count = last - first + 1
+        self.sent = None  # 最後に送ったローカル番号の集合 (None なら何も送っていない)
+        self.seq = 0
+        self.deltas_since_full = 0
+
+    def frame_for(self, lit, force_full=False):
+        """lit (ローカル番号の集合) を表示するフレーム。前回と同じなら None。"""
+        if self.sent is not None and lit == self.sent and not force_full:
+            return None
+        full = full_payload(lit, self.count)
+        kind, payload = FRAME_FULL, full
+        if self.sent is not None and not force_full and self.deltas_since_full < KEYFRAME_INTERVAL:
+            changes = [i | 0x80 for i in sorted(lit - self.sent)] + sorted(self.sent - lit)
+            delta = bytes([self.seq]) + bytes(changes)
+            if len(delta) < len(full):
+                kind, payload = FRAME_DELTA, delta
+        self.deltas_since_full = self.deltas_since_full + 1 if kind == FRAME_DELTA else 0
+        self.seq = (self.seq + 1) & 0xFF
+        self.sent = set(lit)
+        return encode_frame(kind, self.seq, payload)
+
+
+class LedFramebuffer:
+    """
+    全エッジの点灯状態。show(edges) で「edges だけが点いている」状態にするための
+    コントローラごとのフレームを返す (変化のないコントローラには送らない)。
+    controllers はマップファイルの led_controllers ({名前: (最初の番号, 最後の番号)})。
+    """
+
+    def __init__(self, controllers):
+        self.controllers = {name: LedController(name, first, last)
+                            for name, (first, last) in controllers.items()}
+        self.lit = frozenset()  # 点いているエッジ番号
+        self.frames_sent = 0
+        self.bytes_sent = 0
+
+    def controller_of(self, edge):
+        for controller in self.controllers.values():
+            if controller.first <= edge <= controller.last:
+                return controller
+        return None
+
+    def show(self, edges, force_full=False):
+        """{コントローラ名: フレームのバイト列} を返す。"""
+        self.lit = frozenset(e for e in edges if self.controller_of(e) is not None)
+        frames = {}
+        for name, controller in self.controllers.items():
+            local = {e - controller.first for e in self.lit if controller.first <= e <= controller.last}
+            frame = controller.frame_for(local, force_full)
+            if frame is not None:
+                frames[name] = frame
+                self.frames_sent += 1
+                self.bytes_sent += len(frame)
+        return frames
+
+    def clear(self):
+        """全消灯のフレーム (RESET の代わり)。どのコントローラにも FULL を送る。"""
+        return self.show((), force_full=True)
+
+    def resync(self, name):
+        """コントローラが取りこぼしたとき用: 次は FULL を送るようにする。"""
+        self.controllers[name].sent = None
+
+    def stats(self):
+        return {
+            "lit": sorted(self.lit),
+            "frames_sent": self.frames_sent,
+            "bytes_sent": self.bytes_sent,
+            "seq": {name: c.seq for name, c in self.controllers.items()}
+        }
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from csr_graph import CSRGraph
+
+# =========================
+# マップファイルの読み込み (宣言的な定義 -> コンパイル済みバイナリ)
+# =========================
+# マップは JSON (または TOML) で書く:
+#   {
+#     "name": "base",
+#     "nodes": {"v0": [0, 7], ...},                                   # ノード名: 座標
+#     "edges": [{"from": "v0", "to": "v1", "weight": 1, "led": 1}, ...], # 無向、led はLEDエッジ番号 (省略時 0)
+#     "led_controllers": {"led1": [1, 17], "led2": [18, 26]}          # 各LEDコントローラが受け持つ番号の範囲
+#   }
+# 初回だけ CSR の配列に変換して "<マップ名>.csr/" ディレクトリに .npy として保存し、
+# 2回目以降はそれを mmap で開くだけにする (大きなマップでも起動が速く、
+# 複数のワーカープロセスが同じページを共有できる)。
+# 元ファイルの中身が変わったら (ハッシュで判定) 自動でコンパイルし直す。
+
+COMPILED_SUFFIX = ".csr"
+FORMAT_VERSION = 1
+_ARRAYS = ("xy", "indptr", "indices", "weights", "edge_ids")
+
+
+class MapData:
+    """読み込んだマップ。csr はグラフ本体、led_controllers は {名前: (最小番号, 最大番号)}。"""
+
+    def __init__(self, name, csr, led_controllers):
+        self.name = name
+        self.csr = csr
+        self.led_controllers = led_controllers
+
+
+def _source_digest(raw):
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def parse_map_source(path):
+    """
+    JSON / TOML のマップ定義を読み、(名前, ノード名, 座標, edge_list, led_controllers, 元ファイルのハッシュ) を返す。
+    edge_list は CSRGraph.from_edge_list に渡せる [(u, v, 重み, エッジ番号), ...]。
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    if path.endswith(".toml"):
+        import tomllib  # Python 3.11 以降
+        spec = tomllib.loads(raw.decode("utf-8"))
+    else:
+        spec = json.loads(raw)
+
+    names = list(spec["nodes"])
+    index = {name: i for i, name in enumerate(names)}
+    xy = np.array([spec["nodes"][name] for name in names], dtype=np.float64).reshape(-1, 2)
+    edge_list = []
+    for edge in spec["edges"]:
+        u, v = edge["from"], edge["to"]
+        if u not in index or v not in index:
+            raise ValueError(f"edge refers to an unknown node: {u}-{v}")
+        edge_list.append((index[u], index[v], edge.get("weight", 1), edge.get("led", 0)))
+    led_controllers = {
+        name: (int(first), int(last))
+        for name, (first, last) in spec.get("led_controllers", {}).items()
+    }
+    map_name = spec.get("name", os.path.splitext(os.path.basename(path))[0])
+    return map_name, names, xy, edge_list, led_controllers, _source_digest(raw)
+
+
+def compiled_path(source_path):
+    return os.path.splitext(source_path)[0] + COMPILED_SUFFIX
+
+
+def compile_map(source_path, out_dir=None):
+    """マップ定義を CSR の .npy 群 + meta.json にコンパイルし、出力先ディレクトリを返す。"""
+    out_dir = out_dir or compiled_path(source_path)
+    map_name, names, xy, edge_list, led_controllers, digest = parse_map_source(source_path)
+    csr = CSRGraph.from_edge_list(names, xy, edge_list)
+
+    # 別のプロセスが同時にコンパイルしても壊れないよう、一時ディレクトリに書いてから差し替える
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    tmp_dir = tempfile.mkdtemp(prefix=".compile-", dir=parent)
+    try:
+        for key in _ARRAYS:
+            np.save(os.path.join(tmp_dir, f"{key}.npy"), getattr(csr, key))
+        stat = os.stat(source_path)
+        meta = {
+            "format": FORMAT_VERSION,
+            "name": map_name,
+            "source_digest": digest,
+            "source_stat": [stat.st_size, stat.st_mtime_ns],
+            "fingerprint": csr.fingerprint,
+            "names": csr.names,
+            "led_controllers": led_controllers
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            pass  # 先に別のプロセスが書き終えていたらそちらを使う
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_dir
+
+
+def load_compiled(compiled_dir, mmap=True):
+    """コンパイル済みのマップを開く。mmap=True なら配列はファイルを mmap したまま使う。"""
+    with open(os.path.join(compiled_dir, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("format") != FORMAT_VERSION:
+        raise ValueError(f"unsupported compiled map format: {meta.get('format')}")
+    mode = "r" if mmap else None
+    arrays = {key: np.load(os.path.join(compiled_dir, f"{key}.npy"), mmap_mode=mode) for key in _ARRAYS}
+    csr = CSRGraph(meta["names"], fingerprint=meta["fingerprint"], **arrays)
+    led_controllers = {name: tuple(r) for name, r in meta["led_controllers"].items()}
+    return MapData(meta["name"], csr, led_controllers), meta
+
+
+def load_map(source_path, mmap=True):
+    """
+    マップを読み込む。コンパイル済みのものがあり、元ファイルと一致すればそれを mmap で開く。
+    なければ (または元ファイルが変わっていれば) コンパイルしてから開く。
+    """
+    out_dir = compiled_path(source_path)
+    if os.path.isdir(out_dir):
+        try:
+            data, meta = load_compiled(out_dir, mmap)
+            stat = os.stat(source_path)
+            if meta["source_stat"] == [stat.st_size, stat.st_mtime_ns]:
+                return data  # サイズと更新時刻が同じなら読み直さない
+            with open(source_path, "rb") as f:
+                if meta["source_digest"] == _source_digest(f.read()):
+                    return data
+        except (OSError, ValueError, KeyError):
+            pass  # 壊れている・古い形式ならコンパイルし直す
+    compile_map(source_path, out_dir)
+    return load_compiled(out_dir, mmap)[0]
+
+
+if __name__ == "__main__":
+    # python map_loader.py maps/base_map.json  (事前にコンパイルしておく)
+    for path in sys.argv[1:]:
+        print(f"{path} -> {compile_map(path)}")
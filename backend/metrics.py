@@ -0,0 +1,304 @@
+import bisect
+import collections
+import sys
+import threading
+import time
+
+# =========================
+# 処理時間の計測 (段階ごとのヒストグラム) とサンプリングプロファイラ
+# =========================
+# 問い合わせの処理を段階 (JSON の解析、通行止めの重ね合わせ、探索、経路の列挙、
+# モーター命令の変換、応答の JSON 化、シリアルの書き込み ...) に分け、
+# 段階ごとに所要時間をヒストグラムに数える。1回の記録は bisect とたし算だけなので、常に有効にしておける。
+#   with METRICS.timer("search"): ...      段階の時間を測る
+#   METRICS.incr("route_cache_hit")         回数を数える
+#   METRICS.snapshot()                      {"stages": {段階: {count, p50_ms, p99_ms, ...}}, "counters": {...}}
+#   METRICS.prometheus()                    Prometheus のテキスト形式
+# ワーカープロセスで測った分は call_and_drain で結果と一緒に持ち帰り、merge で足す。
+
+# ヒストグラムの境界 (ms)。10µs から 2 倍ずつ 20 段 (約 5 秒まで)、最後はそれより大きいもの
+BUCKET_BOUNDS_MS = tuple(0.01 * 2 ** i for i in range(20))
+
+
+class Histogram:
+    """1つの段階の所要時間の分布 (固定の境界で数えるだけ)。"""
+
+    __slots__ = ("counts", "count", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def merge(self, counts, total_ms, max_ms):
+        for i, c in enumerate(counts):
+            self.counts[i] += c
+        self.count += sum(counts)
+        self.total_ms += total_ms
+        self.max_ms = max(self.max_ms, max_ms)
+
+    def quantile(self, q):
+        """q 分位点の推定値 (入っているバケットの中で線形補間。最後のバケットは max)。"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                if i == len(BUCKET_BOUNDS_MS):
+                    return self.max_ms
+                lo = BUCKET_BOUNDS_MS[i - 1] if i > 0 else 0.0
+                hi = min(BUCKET_BOUNDS_MS[i], self.max_ms)
+                return lo + (hi - lo) * (rank - seen) / c
+            seen += c
+        return self.max_ms
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 4) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.50), 4),
+            "p95_ms": round(self.quantile(0.95), 4),
+            "p99_ms": round(self.quantile(0.99), 4),
+            "max_ms": round(self.max_ms, 4)
+        }
+
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "t0")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, (time.perf_counter() - self.t0) * 1000)
+        return False
+
+
+class Metrics:
+    """段階ごとのヒストグラムと回数のカウンタ。スレッド (planner の thread モード) からも記録できる。"""
+
+    def __init__(self, prefix="lsk"):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def observe(self, stage, ms):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(ms)
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    # ---- ワーカープロセスとのやりとり ----
+    def drain(self):
+        """今までの記録を取り出して空にする (ワーカープロセスから送り返す用)。"""
+        with self._lock:
+            raw = {
+                "histograms": {stage: (h.counts, h.total_ms, h.max_ms)
+                               for stage, h in self.histograms.items()},
+                "counters": dict(self.counters)
+            }
+            self.histograms = {}
+            self.counters = collections.Counter()
+        return raw
+
+    def merge(self, raw):
+        with self._lock:
+            for stage, (counts, total_ms, max_ms) in raw["histograms"].items():
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    histogram = self.histograms[stage] = Histogram()
+                histogram.merge(counts, total_ms, max_ms)
+            self.counters.update(raw["counters"])
+
+    # ---- 出力 ----
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime_s": round(time.time() - self.started, 1),
+                "stages": {stage: h.summary() for stage, h in sorted(self.histograms.items())},
+                "counters": dict(sorted(self.counters.items()))
+            }
+
+    def prometheus(self, gauges=None):
+        """
+        Prometheus のテキスト形式。段階の時間は <prefix>_stage_seconds (histogram)、
+        カウンタは <prefix>_events_total、gauges ({名前: 値} または {名前: {ラベル値: 値}}) は
+        <prefix>_<名前> として出す。
+        """
+        p = self.prefix
+        lines = [f"# HELP {p}_stage_seconds Time spent in each processing stage.",
+                 f"# TYPE {p}_stage_seconds histogram"]
+        with self._lock:
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, c in zip(BUCKET_BOUNDS_MS, h.counts):
+                    cumulative += c
+                    lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound / 1000:g}"}} {cumulative}')
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+                lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {h.total_ms / 1000:.6f}')
+                lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {h.count}')
+            lines.append(f"# HELP {p}_events_total Number of events by name.")
+            lines.append(f"# TYPE {p}_events_total counter")
+            for name, n in sorted(self.counters.items()):
+                lines.append(f'{p}_events_total{{name="{name}"}} {n}')
+        for name, value in sorted((gauges or {}).items()):
+            if value == {}:
+                continue
+            lines.append(f"# TYPE {p}_{name} gauge")
+            if isinstance(value, dict):
+                for label, v in sorted(value.items()):
+                    lines.append(f'{p}_{name}{{name="{label}"}} {v}')
+            else:
+                lines.append(f"{p}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# プロセスごとに1つ
+METRICS = Metrics()
+
+
+def call_and_drain(fn, *args):
+    """fn(*args) を実行し、(結果, その間にこのプロセスで記録した計測値) を返す (ワーカープロセス用)。"""
+    result = fn(*args)
+    return result, METRICS.drain()
+
+
+# 待っているだけのスレッドのスタック (一番内側の関数名がこれなら数えない)
+IDLE_FUNCTIONS = frozenset(("select", "poll", "wait", "_worker", "accept", "get"))
+
+# サンプリング間隔 (ms) と計測時間 (秒) の範囲 (これより外の値は丸める)
+PROFILE_INTERVAL_MS = (1.0, 1000.0)
+PROFILE_DURATION_S = (0.1, 600.0)
+
+
+def clamp(value, low, high):
+    return min(max(value, low), high)
+
+
+class SamplingProfiler:
+    """
+    必要なときだけ動かすサンプリングプロファイラ。
+    interval_ms ごとに対象スレッドのスタックを覗き、同じスタックの回数を数える
+    (デバッガをつながずに、本番で p99 が跳ねる原因の関数を探す用)。
+    duration_s たつと自動で止まる。
+    stacks などはサンプリングのスレッドが書き換えるので、_lock を取ってから読み書きする。
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.idle = 0
+        self.interval_ms = 0
+        self.started = None
+        self.stopped = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval_ms=5.0, duration_s=30.0, thread_ids=None):
+        """
+        サンプリングを始める。thread_ids を省くとプロファイラ以外の全スレッド。
+        すでに動いていれば何もしない。interval_ms / duration_s は PROFILE_INTERVAL_MS / PROFILE_DURATION_S の範囲に丸める。
+        """
+        if self.running:
+            return False
+        interval_ms = clamp(interval_ms, *PROFILE_INTERVAL_MS)
+        duration_s = clamp(duration_s, *PROFILE_DURATION_S)
+        with self._lock:
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.idle = 0
+            self.interval_ms = interval_ms
+            self.started = time.time()
+            self.stopped = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval_ms / 1000, duration_s, thread_ids),
+                                        name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+        return self.report()
+
+    def _run(self, interval, duration, thread_ids):
+        me = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self._stop.wait(interval):
+            # スタックを集めるのはロックの外で、数えるときだけロックを取る
+            stacks, idle = [], 0
+            for tid, frame in sys._current_frames().items():
+                if tid == me or (thread_ids is not None and tid not in thread_ids):
+                    continue
+                if frame.f_code.co_name in IDLE_FUNCTIONS:
+                    idle += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stacks.append(tuple(reversed(stack)))
+            with self._lock:
+                self.stacks.update(stacks)
+                self.idle += idle
+                self.samples += 1
+            if time.monotonic() >= deadline:
+                break
+        with self._lock:
+            self.stopped = time.time()
+
+    def report(self, top=20):
+        """
+        集計結果。"collapsed" は flamegraph.pl / speedscope にそのまま渡せる
+        「呼び出し元;...;関数 回数」の行、"top_functions" は一番内側 (実行中) の関数の回数。
+        """
+        with self._lock:
+            stacks = collections.Counter(self.stacks)
+            samples, idle, started, stopped = self.samples, self.idle, self.started, self.stopped
+        self_counts = collections.Counter()
+        for stack, n in stacks.items():
+            if stack:
+                self_counts[stack[-1]] += n
+        return {
+            "running": self.running,
+            "samples": samples,
+            "idle": idle,
+            "interval_ms": self.interval_ms,
+            "seconds": round((stopped or time.time()) - started, 2) if started else 0.0,
+            "top_functions": [[name, n] for name, n in self_counts.most_common(top)],
+            "collapsed": [f"{';'.join(stack)} {n}" for stack, n in stacks.most_common()]
+        }
+
+
+PROFILER = SamplingProfiler()
@@ -0,0 +1,345 @@
+import asyncio
+import itertools
+import struct
+
+from led_frames import encode_frame, decode_frame
+from serial_writer import APPEND, RESET
+
+# =========================
+# モーター命令の2進プログラム
+# =========================
+# 経路のモーター命令 ("straight,left,..." の文字列) を、1命令 ≒ 1バイトのプログラムにして送る。
+# 長いプログラムはチャンクに分け、車 ESP32 からの ACK を待ちながら送る。
+#
+# プログラム本体 (命令の並び):
+#   1バイト目の bit0〜2 = 命令番号 (send_command_motor と同じ: straight 0, right 1, left 2, stop 3, back 4)
+#   bit7 が立っていれば、続く2バイト (リトルエンディアン) がこの命令の旋回時間 (ms)。
+#   立っていなければ BEGIN で送った既定の旋回時間を使う。
+# フレーム ([0xA6][種類][seq][n][payload][XOR] 、形式は led_frames.py と同じ):
+#   BEGIN (0x10): [版][プログラムid][本体の長さ u16][命令数 u16][既定の旋回時間 u16][CRC-16 u16]
+#   CHUNK (0x11): [プログラムid][開始位置 u16][本体の一部...]
+#   END   (0x12): [プログラムid]  (車は CRC を確かめてから走り出す)
+#   STOP  (0x13): なし           (今のプログラムを止める)
+# 車からの返事 (1行のテキスト):
+#   "ACK <id> <受け取った長さ>" / "NAK <id> <期待している開始位置>"
+#   "OK <id> <命令数>" (END を受け取り、走り出した) / "ERR <id> <理由>"
+#   理由は version / too_long (本体が MAX_PROGRAM_BYTES 超) / too_many (命令が MAX_COMMANDS 超) /
+#   unknown / incomplete / checksum。長すぎるプログラムは切り詰めて走らせることはしない。
+PROGRAM_MAGIC = 0xA6
+PROGRAM_VERSION = 1
+FRAME_BEGIN = 0x10
+FRAME_CHUNK = 0x11
+FRAME_END = 0x12
+FRAME_STOP = 0x13
+
+OPCODES = {"straight": 0, "right": 1, "left": 2, "stop": 3, "back": 4}
+OPCODE_NAMES = {code: name for name, code in OPCODES.items()}
+HAS_DELAY = 0x80
+CHUNK_SIZE = 64          # CHUNK 1つで送る本体のバイト数
+MAX_PROGRAM_BYTES = 4096  # 車側のバッファの大きさ
+MAX_COMMANDS = 1024       # 車側の命令配列の大きさ (超えるプログラムは切り詰めずに ERR too_many)
+
+
+def crc16(data, crc=0xFFFF):
+    """CRC-16/CCITT-FALSE (ファームウェアと同じ)。"""
+    for b in data:
+        crc ^= b << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+    return crc
+
+
+def encode_steps(actions, delays=None):
+    """
+    命令名のリストをプログラム本体にする。
+    delays は命令ごとの旋回時間 (ms) のリスト (None の要素や delays=None なら既定値を使う)。
+    """
+    body = bytearray()
+    for i, action in enumerate(actions):
+        op = OPCODES[action]
+        delay = delays[i] if delays is not None else None
+        if delay is None:
+            body.append(op)
+        else:
+            body.append(op | HAS_DELAY)
+            body += struct.pack("<H", delay)
+    return bytes(body)
+
+
+def decode_steps(body):
+    """プログラム本体 -> [(命令名, 旋回時間 or None), ...]。"""
+    steps = []
+    i = 0
+    while i < len(body):
+        b = body[i]
+        i += 1
+        delay = None
+        if b & HAS_DELAY:
+            if i + 2 > len(body):
+                raise ValueError("truncated motor program")
+            delay = struct.unpack_from("<H", body, i)[0]
+            i += 2
+        name = OPCODE_NAMES.get(b & 0x07)
+        if name is None:
+            raise ValueError(f"unknown motor opcode: {b & 0x07}")
+        steps.append((name, delay))
+    return steps
+
+
+def parse_reply(line):
+    """
+    車からの返事の行を (種類, プログラムid, 値) にする。プログラムの返事でなければ None。
+    種類は "ACK" / "NAK" / "OK" / "ERR"。ERR の値は理由の文字列、それ以外は整数。
+    """
+    parts = line.strip().split()
+    if len(parts) != 3 or parts[0] not in ("ACK", "NAK", "OK", "ERR"):
+        return None
+    try:
+        program_id = int(parts[1])
+        value = parts[2] if parts[0] == "ERR" else int(parts[2])
+    except ValueError:
+        return None
+    return parts[0], program_id, value
+
+
+class MotorProgram:
+    """送る1本のプログラム。"""
+
+    def __init__(self, program_id, actions, default_delay, delays=None):
+        self.program_id = program_id & 0xFF
+        self.actions = list(actions)
+        self.default_delay = default_delay
+        if len(self.actions) > MAX_COMMANDS:
+            raise ValueError(f"motor program too long: {len(self.actions)} steps (max {MAX_COMMANDS})")
+        self.body = encode_steps(self.actions, delays)
+        if len(self.body) > MAX_PROGRAM_BYTES:
+            raise ValueError(f"motor program too long: {len(self.body)} bytes")
+        self.crc = crc16(self.body)
+
+    def begin_payload(self):
+        return struct.pack("<BBHHHH", PROGRAM_VERSION, self.program_id, len(self.body),
+                           len(self.actions), self.default_delay, self.crc)
+
+    def chunk_payload(self, offset, size=CHUNK_SIZE):
+        return struct.pack("<BH", self.program_id, offset) + self.body[offset:offset + size]
+
+    def end_payload(self):
+        return bytes([self.program_id])
+
+
+class ProgramUploader:
+    """
+    車 ESP32 へのプログラムの送信。新しいプログラムを start() すると、送信中の古いものは取り消す。
+    返事を読めるとき (on_reply に車からの行を渡すとき) は acknowledge=True にすると、
+    window 個までのチャンクを ACK を待たずに送り、NAK / タイムアウトならそこから送り直す (Go-Back-N)。
+    acknowledge=False なら全フレームをそのまま送信キューに積む。
+    """
+
+    def __init__(self, writer, acknowledge=False, chunk_size=CHUNK_SIZE, window=4,
+                 ack_timeout=1.0, retries=3):
+        self.writer = writer
+        self.acknowledge = acknowledge
+        self.chunk_size = chunk_size
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self._ids = itertools.count()
+        self._seq = itertools.count()
+        self._replies = asyncio.Queue()
+        self._task = None
+        self.last_result = None
+        self.retransmits = 0
+
+    def _send(self, kind, payload, mode=APPEND):
+        self.writer.send(encode_frame(kind, next(self._seq), payload, PROGRAM_MAGIC), mode)
+
+    def start(self, actions, default_delay, delays=None):
+        """actions を新しいプログラムとして送り始める (待たない)。"""
+        program = MotorProgram(next(self._ids), actions, default_delay, delays)
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        while not self._replies.empty():
+            self._replies.get_nowait()
+        self._task = asyncio.get_running_loop().create_task(self._upload(program))
+        return program
+
+    def stop(self):
+        """走行を止める (未送信のフレームは捨てる)。"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._send(FRAME_STOP, b"", RESET)
+
+    def on_reply(self, line):
+        """車から届いた1行を渡す (プログラムの返事でなければ無視)。"""
+        reply = parse_reply(line)
+        if reply is not None:
+            self._replies.put_nowait(reply)
+
+    async def wait(self):
+        """送信中のプログラムが終わる (OK / ERR / 失敗) まで待ち、結果を返す。"""
+        if self._task is not None:
+            await asyncio.shield(self._task)
+        return self.last_result
+
+    async def _upload(self, program):
+        # BEGIN は RESET で積むので、まだ送っていない古いプログラムのフレームは捨てられる
+        self._send(FRAME_BEGIN, program.begin_payload(), RESET)
+        size = len(program.body)
+        if not self.acknowledge:
+            for offset in range(0, size, self.chunk_size):
+                self._send(FRAME_CHUNK, program.chunk_payload(offset, self.chunk_size))
+            self._send(FRAME_END, program.end_payload())
+            self.last_result = {"program_id": program.program_id, "status": "sent"}
+            return
+
+        acked = 0      # 車が受け取ったと返してきた長さ
+        next_offset = 0
+        failures = 0
+        rewound_to = None  # 最後に送り直しを始めた位置 (同じ位置への NAK は送り直し前のチャンクの分なので無視する)
+        while acked < size:
+            while next_offset < size and next_offset < acked + self.window * self.chunk_size:
+                self._send(FRAME_CHUNK, program.chunk_payload(next_offset, self.chunk_size))
+                next_offset += self.chunk_size
+            reply = await self._next_reply(program)
+            if reply is not None and reply[0] == "NAK" and reply[2] == rewound_to:
+                continue
+            if reply is None or reply[0] == "NAK":
+                failures += 1
+                if failures > self.retries:
+                    return self._fail(program, "no acknowledgement")
+                self.retransmits += 1
+                if reply is not None:
+                    acked = reply[2]  # 車が期待している位置から送り直す
+                next_offset = rewound_to = acked
+            elif reply[0] == "ACK":
+                acked = max(acked, reply[2])
+                failures = 0
+            elif reply[0] == "ERR":
+                return self._fail(program, reply[2])
+
+        for _ in range(self.retries + 1):
+            self._send(FRAME_END, program.end_payload())
+            reply = await self._next_reply(program, final=True)
+            if reply is None:
+                self.retransmits += 1
+                continue
+            if reply[0] == "OK" and reply[2] != len(program.actions):
+                # 車が読み込んだ命令数が違う (途中で切れたプログラムを走らせている) ので止める
+                self._send(FRAME_STOP, b"", RESET)
+                return self._fail(program, f"step count mismatch: sent {len(program.actions)}, "
+                                           f"car loaded {reply[2]}")
+            if reply[0] == "OK":
+                self.last_result = {"program_id": program.program_id, "status": "running",
+                                    "steps": reply[2], "bytes": size}
+                return
+            return self._fail(program, reply[2])
+        return self._fail(program, "no response to END")
+
+    async def _next_reply(self, program, final=False):
+        """このプログラム宛ての返事を待つ (タイムアウトなら None)。"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.ack_timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                reply = await asyncio.wait_for(self._replies.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if reply[1] != program.program_id:
+                continue
+            if final and reply[0] not in ("OK", "ERR"):
+                continue
+            return reply
+
+    def _fail(self, program, reason):
+        self.last_result = {"program_id": program.program_id, "status": "failed", "reason": reason}
+        print(f"[MOTOR] プログラム {program.program_id} の送信に失敗: {reason}")
+
+
+class ProgramReceiver:
+    """
+    車 ESP32 側の受信処理 (ファームウェアと同じ動き)。シミュレータや動作確認用。
+    feed(data) で受け取ったバイト列を渡すと、返事の行のリストを返す。
+    走り出したプログラムは self.steps に [(命令名, 旋回時間), ...] で入る。
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self.program_id = None
+        self.length = 0
+        self.count = 0
+        self.default_delay = 0
+        self.crc = 0
+        self.body = bytearray()
+        self.steps = None
+        self.stopped = False
+
+    def feed(self, data):
+        self._buf += data
+        replies = []
+        while self._buf:
+            if self._buf[0] != PROGRAM_MAGIC:
+                # 従来のテキストの行 (stop / delay= / コマンド列) は読み飛ばす
+                end = self._buf.find(b"\n")
+                if end < 0:
+                    break
+                if bytes(self._buf[:end]).strip() == b"stop":
+                    self.stopped = True
+                del self._buf[:end + 1]
+                continue
+            try:
+                frame = decode_frame(self._buf, PROGRAM_MAGIC)
+            except ValueError:
+                del self._buf[0]
+                continue
+            if frame is None:
+                break
+            kind, _, payload, used = frame
+            del self._buf[:used]
+            reply = self.handle_frame(kind, payload)
+            if reply:
+                replies.append(reply)
+        return replies
+
+    def handle_frame(self, kind, payload):
+        """1フレームを処理して返事の行 (なければ None) を返す。"""
+        if kind == FRAME_BEGIN:
+            version, pid, length, count, delay, crc = struct.unpack("<BBHHHH", payload)
+            if version != PROGRAM_VERSION:
+                return f"ERR {pid} version"
+            if length > MAX_PROGRAM_BYTES:
+                return f"ERR {pid} too_long"
+            if count > MAX_COMMANDS:
+                return f"ERR {pid} too_many"
+            self.program_id, self.length, self.count = pid, length, count
+            self.default_delay, self.crc = delay, crc
+            self.body = bytearray()
+            return f"ACK {pid} 0"
+        if kind == FRAME_CHUNK:
+            pid, offset = struct.unpack_from("<BH", payload)
+            if pid != self.program_id:
+                return f"ERR {pid} unknown"
+            if offset != len(self.body):
+                return f"NAK {pid} {len(self.body)}"
+            self.body += payload[3:]
+            return f"ACK {pid} {len(self.body)}"
+        if kind == FRAME_END:
+            pid = payload[0]
+            if pid != self.program_id or len(self.body) != self.length:
+                return f"ERR {pid} incomplete"
+            if crc16(self.body) != self.crc:
+                return f"ERR {pid} checksum"
+            steps = decode_steps(bytes(self.body))
+            if len(steps) > MAX_COMMANDS:
+                return f"ERR {pid} too_many"
+            self.steps = [(name, delay if delay is not None else self.default_delay)
+                          for name, delay in steps]
+            self.stopped = False
+            return f"OK {pid} {len(self.steps)}"
+        if kind == FRAME_STOP:
+            self.steps = None
+            self.stopped = True
+        return None
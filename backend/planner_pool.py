@@ -0,0 +1,120 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from metrics import METRICS, call_and_drain
+
+# =========================
+# 経路計算のワーカープール
+# =========================
+# 経路計算をイベントループの外 (スレッド/プロセス) で実行し、重い問い合わせの間も
+# 他のクライアントの WebSocket (ping を含む) が止まらないようにする。
+#   "thread"  : ThreadPoolExecutor (既定。NumPy の処理は GIL を離すので並列に動く)
+#   "process" : ProcessPoolExecutor (各プロセスが起動時にベースグラフを読み込む)
+#   "inline"  : コルーチンの中でそのまま実行 (デバッグ用。計算中は他の接続も止まるので明示的に選んだときだけ)
+# process モードでは、ワーカーで測った段階ごとの時間 (metrics.py) を結果と一緒に持ち帰る。
+PLANNER_MODES = ("inline", "thread", "process")
+
+
+class PlannerPool:
+    """
+    経路計算を実行するプール。同時に受け付ける数は max_pending までで、
+    それを超えた問い合わせは空きが出るまで待たされる (バックプレッシャー)。
+    """
+
+    def __init__(self, mode="thread", workers=4, max_pending=32, initializer=None, initargs=()):
+        if mode not in PLANNER_MODES:
+            raise ValueError(f"unknown planner mode: {mode}")
+        self.mode = mode
+        self.workers = workers
+        self.max_pending = max_pending
+        self._initializer = initializer
+        self._initargs = initargs
+        self._executor = None
+        self._slots = None
+        self.pending = 0    # 実行中 + 空き待ちの数
+        self.completed = 0
+        self.cancelled = 0
+
+    def _get_executor(self):
+        # プロセスは最初に使うときに作る (import しただけではワーカーを起動しない)
+        if self._executor is None:
+            if self.mode == "thread":
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="planner",
+                    initializer=self._initializer, initargs=self._initargs)
+            else:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=self._initializer, initargs=self._initargs)
+        return self._executor
+
+    async def run(self, fn, *args):
+        """fn(*args) をプールで実行して結果を返す。"""
+        if self.mode == "inline":
+            self.completed += 1
+            return fn(*args)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        self.pending += 1
+        queued = time.perf_counter()
+        try:
+            async with self._slots:
+                METRICS.observe("planner_wait", (time.perf_counter() - queued) * 1000)
+                loop = asyncio.get_running_loop()
+                if self.mode == "process":
+                    future = loop.run_in_executor(self._get_executor(), call_and_drain, fn, *args)
+                else:
+                    future = loop.run_in_executor(self._get_executor(), fn, *args)
+                try:
+                    result = await future
+                except asyncio.CancelledError:
+                    # まだ始まっていなければ取り消す (実行中のものは終わるまで走る)
+                    future.cancel()
+                    self.cancelled += 1
+                    raise
+                self.completed += 1
+                if self.mode == "process":
+                    result, measured = result
+                    METRICS.merge(measured)
+                return result
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "cancelled": self.cancelled
+        }
+
+
+async def run_until_closed(websocket, pool, fn, *args):
+    """
+    pool で fn(*args) を実行する。待っている間にクライアントが切断したら計算を取り消し、
+    ConnectionError を送出する。
+    """
+    task = asyncio.ensure_future(pool.run(fn, *args))
+    wait_closed = getattr(websocket, "wait_closed", None)
+    if wait_closed is None:
+        return await task
+    closed = asyncio.ensure_future(wait_closed())
+    try:
+        done, _ = await asyncio.wait({task, closed}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        closed.cancel()
+    if task not in done:
+        task.cancel()
+        raise ConnectionError("client disconnected while planning")
+    return task.result()
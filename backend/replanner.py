@@ -0,0 +1,293 @@
+import heapq
+import math
+
+# =========================
+# 走行中の経路の引き直し (D* Lite)
+# =========================
+# 走っている途中で通行止め (車が進めなくなった / 画面で指定された) が見つかったとき、
+# start から探し直すと大きなマップでは時間がかかる。D* Lite (Koenig & Likhachev) は goal から
+# 逆向きに探索した状態 (g / rhs と優先度つきキュー) を走行中ずっと持っておき、
+#   - 車が進んだら start を今いるノードに動かす (km にヒューリスティックの変化を足すだけで、キューは作り直さない)
+#   - エッジが通れなくなったら、その両端の値だけ直して、影響のあるノードだけを展開し直す
+# ので、引き直しは通行止めの周りだけの計算で済む。
+# g / rhs は辞書 (触ったノードだけ)。グラフは無向 (CSR に両方向のエッジがあり、重みも同じ) とする。
+
+
+class DStarLite:
+    """
+    start -> goal (整数ノード) の経路を持ち続ける D* Lite。
+    blocked (BlockedEdges) は最初から通らない。block_edge で通行止めを足し、move_to で start を動かす。
+    """
+
+    def __init__(self, csr, start, goal, blocked=None, metric="euclidean"):
+        self.csr = csr
+        self.start = start
+        self.goal = goal
+        self.blocked_slots = set(blocked.slots) if blocked else set()
+        self.metric = metric
+        self.scale = csr.heuristic_scale(metric)
+        self.km = 0.0
+        self._last = start
+        self.g = {}
+        self.rhs = {goal: 0.0}
+        self._heap = []
+        self._open = {}    # キューに入っているノード -> 有効なキー (古いエントリは取り出すときに捨てる)
+        self.expanded = 0  # 計測値 (展開したノードの数)
+        self._push(goal)
+
+    # ---- ヒューリスティックとキー ----
+    def _h(self, a, b):
+        xy = self.csr._xy_mv
+        dx = xy[2 * a] - xy[2 * b]
+        dy = xy[2 * a + 1] - xy[2 * b + 1]
+        if self.metric == "manhattan":
+            return self.scale * (abs(dx) + abs(dy))
+        return self.scale * math.hypot(dx, dy)
+
+    def _key(self, s):
+        m = min(self.g.get(s, math.inf), self.rhs.get(s, math.inf))
+        return (m + self._h(self.start, s) + self.km, m)
+
+    def _push(self, s):
+        key = self._key(s)
+        self._open[s] = key
+        heapq.heappush(self._heap, (key[0], key[1], s))
+
+    def _settle(self, s):
+        """s の g と rhs が違えばキューに入れ、同じならキューから外す。"""
+        if self.g.get(s, math.inf) != self.rhs.get(s, math.inf):
+            self._push(s)
+        else:
+            self._open.pop(s, None)
+
+    def _recompute_rhs(self, s):
+        """rhs(s) = min (重み + g(隣)) を隣接エッジから計算し直す。"""
+        if s == self.goal:
+            return
+        indptr = self.csr._indptr_mv
+        indices = self.csr._indices_mv
+        weights = self.csr._weights_mv
+        g = self.g
+        best = math.inf
+        for k in range(indptr[s], indptr[s + 1]):
+            if k in self.blocked_slots:
+                continue
+            c = weights[k] + g.get(indices[k], math.inf)
+            if c < best:
+                best = c
+        if best == math.inf:
+            self.rhs.pop(s, None)
+        else:
+            self.rhs[s] = best
+
+    # ---- 探索 ----
+    def compute(self):
+        """start の値が確定するまでキューを展開する (ComputeShortestPath)。"""
+        indptr = self.csr._indptr_mv
+        indices = self.csr._indices_mv
+        weights = self.csr._weights_mv
+        heap = self._heap
+        open_keys = self._open
+        g = self.g
+        rhs = self.rhs
+        blocked_slots = self.blocked_slots
+        inf = math.inf
+        while heap:
+            k1, k2, u = heap[0]
+            if open_keys.get(u) != (k1, k2):
+                heapq.heappop(heap)
+                continue
+            if (k1, k2) >= self._key(self.start) and rhs.get(self.start, inf) == g.get(self.start, inf):
+                break
+            heapq.heappop(heap)
+            new_key = self._key(u)
+            if (k1, k2) < new_key:
+                # km が増えた後の古いキー。今のキーで入れ直す
+                open_keys[u] = new_key
+                heapq.heappush(heap, (new_key[0], new_key[1], u))
+                continue
+            del open_keys[u]
+            self.expanded += 1
+            g_old = g.get(u, inf)
+            r = rhs.get(u, inf)
+            if g_old > r:
+                # 値が下がった: 隣の rhs はこのエッジを使った方が小さければ下げるだけ
+                g[u] = r
+                for k in range(indptr[u], indptr[u + 1]):
+                    if k in blocked_slots:
+                        continue
+                    p = indices[k]
+                    if p != self.goal:
+                        c = weights[k] + r
+                        if c < rhs.get(p, inf):
+                            rhs[p] = c
+                            self._settle(p)
+            else:
+                # 値が上がった: u を通っていた隣 (と u 自身) の rhs を計算し直す
+                g.pop(u, None)
+                for k in range(indptr[u], indptr[u + 1]):
+                    if k in blocked_slots:
+                        continue
+                    p = indices[k]
+                    if p != self.goal and rhs.get(p, inf) == weights[k] + g_old:
+                        self._recompute_rhs(p)
+                        self._settle(p)
+                self._recompute_rhs(u)
+                self._settle(u)
+
+    def move_to(self, node):
+        """車が node まで進んだ (または戻った) ので、そこを新しい start にする。"""
+        if node != self.start:
+            self.km += self._h(self._last, node)
+            self._last = node
+            self.start = node
+
+    def block_edge(self, u, v):
+        """u - v を通行止めにする (両方向)。新しく通行止めになったら True。"""
+        slots = [k for k in (self.csr.slot(u, v), self.csr.slot(v, u)) if k >= 0]
+        if not slots or all(k in self.blocked_slots for k in slots):
+            return False
+        self.blocked_slots.update(slots)
+        for s in (u, v):
+            self._recompute_rhs(s)
+            self._settle(s)
+        return True
+
+    def cost(self):
+        """start から goal までの距離 (compute の後。届かなければ inf)。"""
+        return self.rhs.get(self.start, math.inf)
+
+    def path(self):
+        """start から goal までの最短経路 (整数ノードのリスト)。届かなければ None。"""
+        self.compute()
+        if self.cost() == math.inf:
+            return None
+        indptr = self.csr._indptr_mv
+        indices = self.csr._indices_mv
+        weights = self.csr._weights_mv
+        g = self.g
+        s = self.start
+        path = [s]
+        seen = {s}
+        while s != self.goal:
+            best, best_v = math.inf, -1
+            for k in range(indptr[s], indptr[s + 1]):
+                if k in self.blocked_slots:
+                    continue
+                v = indices[k]
+                c = weights[k] + (0.0 if v == self.goal else g.get(v, math.inf))
+                if c < best:
+                    best, best_v = c, v
+            if best_v < 0 or best_v in seen:
+                return None
+            s = best_v
+            seen.add(s)
+            path.append(s)
+        return path
+
+
+class ActiveRoute:
+    """走行中の1台の経路と、その D* Lite の状態。"""
+
+    def __init__(self, planner, path):
+        self.planner = planner
+        self.path = list(path)
+        self.replans = 0
+
+
+class RouteReplanner:
+    """
+    車ごとの走行中の経路 (ActiveRoute) を持ち、通行止めが見つかったら今の位置から経路と命令を作り直す。
+    スレッドセーフではないので、呼び出し側で1本のスレッドにまとめて呼ぶ。
+    position (CarTelemetry.position を整数ノードにしたもの) の state:
+      "driving"  edge = (u, v) を走っている。v まではそのまま走り、v から先を引き直す
+      "at_node"  node で heading = (a, b) の向きを向いて、まだ走り出していない
+      "blocked"  edge = (u, v) の途中で進めなくなった。u まで戻って (back) から引き直す
+    """
+
+    def __init__(self, csr, turn_table, metric="euclidean"):
+        self.csr = csr
+        self.turn_table = turn_table
+        self.metric = metric
+        self.routes = {}  # 車 -> ActiveRoute
+
+    def start(self, vehicle, path, blocked=None):
+        """vehicle が path (整数ノード) を走り始めた。goal からの探索はここで済ませておく。"""
+        planner = DStarLite(self.csr, path[0], path[-1], blocked, self.metric)
+        planner.compute()
+        self.routes[vehicle] = ActiveRoute(planner, path)
+        return self.routes[vehicle]
+
+    def stop(self, vehicle):
+        self.routes.pop(vehicle, None)
+
+    def block(self, vehicle, pairs, position):
+        """
+        pairs ([(u, v), ...]) を通行止めにし、車の残りの経路にかかるなら引き直す。
+        引き直さなくてよければ None、引き直したら
+        {"path", "actions", "heading", "cost", "expanded"} (届かなければ path / actions は None)。
+        heading は新しいプログラムを始めるときの車の向き (path[0] -> path[1] と違うことがある)。
+        """
+        route = self.routes.get(vehicle)
+        if route is None:
+            return None
+        planner = route.planner
+        for u, v in pairs:
+            planner.block_edge(u, v)
+        if position is None:
+            return None
+        state = position["state"]
+        if state == "at_node":
+            origin = position["node"]
+        else:
+            u, v = position["edge"]
+            # 走っているエッジ自体が通行止めになったら、進めなくなったときと同じく戻る
+            if state == "driving" and planner.csr.slot(u, v) in planner.blocked_slots:
+                state = "blocked"
+            origin = u
+        if state != "blocked" and not self._affected(route.path, origin, pairs):
+            return None
+
+        expanded = planner.expanded
+        if state == "driving":
+            # u -> v は走り続け (プログラムは u -> v の straight から始め直す)、v から先を引き直す
+            heading = (u, v)
+            planner.move_to(v)
+            tail = planner.path()
+            new_path = None if tail is None else [u] + tail
+            actions = None if tail is None else ["straight"] + self._actions_from(heading, tail)
+        else:
+            # 止まっている (進めなくなったなら u まで戻った) ところから引き直す
+            heading = (u, v) if state == "blocked" else tuple(position["heading"])
+            planner.move_to(origin)
+            new_path = planner.path()
+            actions = None if new_path is None else self._actions_from(heading, new_path)
+            if actions is not None and state == "blocked":
+                actions = ["back"] + actions
+        route.replans += 1
+        if new_path is not None:
+            route.path = new_path
+        return {
+            "path": new_path,
+            "actions": actions,
+            "heading": heading,
+            "cost": planner.cost(),
+            "expanded": planner.expanded - expanded
+        }
+
+    def _actions_from(self, heading, path):
+        """heading の向きで path[0] にいる車が path を走る命令 (最初に向きを変えてから compile_actions と同じ)。"""
+        if len(path) < 2:
+            return []
+        return (self.turn_table.turn_from_heading(heading, path[0], path[1])
+                + self.turn_table.compile_actions([path])[0])
+
+    @staticmethod
+    def _affected(path, origin, pairs):
+        """path の origin から先に、pairs のエッジ (向きは問わない) があるか。"""
+        try:
+            rest = path[path.index(origin):]
+        except ValueError:
+            return True
+        edges = set(zip(rest, rest[1:]))
+        return any((u, v) in edges or (v, u) in edges for u, v in pairs)
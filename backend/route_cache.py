@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+# =========================
+# 経路計算結果のキャッシュ (LRU)
+# =========================
+# デモやテストでは同じ start / goal / 障害物の組み合わせが何度も送られてくるので、
+# 応答 (候補経路・エッジ番号・モーター命令) を丸ごと覚えておき、探索をせずに返す。
+
+
+def make_route_key(start, goal, remove_edges, page_size=None):
+    """
+    キャッシュのキーを作る。remove_edges は順番・向き ("v1-v2" と "v2-v1") を区別しない。
+    """
+    edges = set()
+    for edge_str in remove_edges:
+        node1, node2 = edge_str.split('-')
+        edges.add((node1, node2) if node1 <= node2 else (node2, node1))
+    return (start, goal, tuple(sorted(edges)), page_size)
+
+
+class RouteCache:
+    """
+    件数 (max_entries) とおおよそのバイト数 (max_bytes) の両方で上限を持つ LRU キャッシュ。
+    version (ベースグラフの fingerprint) が変わったら中身を自動で捨てる。
+    """
+
+    def __init__(self, max_entries=256, max_bytes=8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = None
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # PLANNER_MODE = "thread" のときは複数スレッドから使われる
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+            self.clear()
+            self.version = version
+
+    def get(self, key, version=None):
+        """キャッシュにあれば値を返す (なければ None)。"""
+        with self._lock:
+            return self._get(key, version)
+
+    def _get(self, key, version):
+        self._check_version(version)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, nbytes, version=None):
+        """値を登録し、上限を超えた分を古い順に追い出す。"""
+        with self._lock:
+            self._put(key, value, nbytes, version)
+
+    def _put(self, key, value, nbytes, version):
+        self._check_version(version)
+        if nbytes > self.max_bytes:
+            return  # 1件で上限を超えるものは覚えない
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._entries[key] = (value, nbytes)
+        self.bytes += nbytes
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self.bytes -= evicted_bytes
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
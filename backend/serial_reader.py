@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from metrics import METRICS
+
+# =========================
+# 非同期シリアル受信
+# =========================
+# 以前の monitor_and_respond は in_waiting を 0.1 秒おきに見て readline() していたので、
+# 停止信号が届いてから処理するまで最大 100ms 遅れていた。
+# ここではポートが読めるようになった時点でイベントループから呼ばれ (loop.add_reader)、
+# 届いた行をその場で subscribe した関数に渡す。
+# add_reader が使えない環境 (Windows のイベントループなど) では、受信専用のスレッドで読む。
+# 受け取った行は直近 history 行だけリングバッファに残す。
+
+
+class SerialReader:
+    """1台のデバイス (シリアルポート) からの受信。行ごとに handler(受信時刻, 行) を呼ぶ。"""
+
+    def __init__(self, name, port, history=1024):
+        self.name = name
+        self.port = port
+        self.lines = deque(maxlen=history)  # (受信時刻 perf_counter, 行)
+        self._handlers = []
+        self._buf = bytearray()
+        self._loop = None
+        self._fd = None
+        self._thread = None
+        self._closing = False
+        # 計測値
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.handler_errors = 0
+        self.max_dispatch_ms = 0.0  # 読んでから全 handler が終わるまで
+        self.total_dispatch_ms = 0.0
+
+    def subscribe(self, handler):
+        self._handlers.append(handler)
+        return handler
+
+    def unsubscribe(self, handler):
+        if handler in self._handlers:
+            self._handlers.remove(handler)
+
+    # ---- 受信 ----
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        try:
+            fd = self.port.fileno()
+            self._loop.add_reader(fd, self._on_readable)
+            self._fd = fd
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            self._thread = threading.Thread(target=self._read_thread, name=f"{self.name}-reader",
+                                            daemon=True)
+            self._thread.start()
+
+    def _on_readable(self):
+        try:
+            data = self.port.read(self.port.in_waiting or 1)
+        except Exception as e:
+            print(f"[{self.name}] 読み込みエラー: {e}")
+            self._stop_reader()
+            return
+        self.feed(data, time.perf_counter())
+
+    def _read_thread(self):
+        while not self._closing:
+            try:
+                data = self.port.read(self.port.in_waiting or 1)
+            except Exception as e:
+                if not self._closing:
+                    print(f"[{self.name}] 読み込みエラー: {e}")
+                return
+            if data:
+                self._loop.call_soon_threadsafe(self.feed, data, time.perf_counter())
+
+    def feed(self, data, received=None):
+        """受け取ったバイト列を行に分け、1行ずつ handler に渡す。"""
+        if received is None:
+            received = time.perf_counter()
+        self.bytes_read += len(data)
+        self._buf += data
+        while True:
+            end = self._buf.find(b"\n")
+            if end < 0:
+                break
+            line = self._buf[:end].decode("utf-8", errors="replace").strip()
+            del self._buf[:end + 1]
+            if line:
+                self._dispatch(received, line)
+
+    def _dispatch(self, received, line):
+        self.lines_read += 1
+        self.lines.append((received, line))
+        for handler in list(self._handlers):
+            try:
+                handler(received, line)
+            except Exception as e:
+                self.handler_errors += 1
+                print(f"[{self.name}] 受信処理のエラー: {e}")
+        dispatch_ms = (time.perf_counter() - received) * 1000
+        METRICS.observe(f"serial_dispatch_{self.name.lower()}", dispatch_ms)
+        self.max_dispatch_ms = max(self.max_dispatch_ms, dispatch_ms)
+        self.total_dispatch_ms += dispatch_ms
+
+    def _stop_reader(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+
+    def close(self):
+        """受信をやめる (ポートは SerialWriter.close で閉じる)。"""
+        self._closing = True
+        self._stop_reader()
+
+    def stats(self):
+        return {
+            "device": self.name,
+            "mode": "thread" if self._thread is not None else "add_reader",
+            "bytes_read": self.bytes_read,
+            "lines_read": self.lines_read,
+            "handler_errors": self.handler_errors,
+            "max_dispatch_ms": round(self.max_dispatch_ms, 3),
+            "avg_dispatch_ms": (round(self.total_dispatch_ms / self.lines_read, 3)
+                                if self.lines_read else 0.0)
+        }
@@ -0,0 +1,151 @@
+import asyncio
+import time
+from collections import deque
+
+from metrics import METRICS
+
+# =========================
+# 非同期シリアル送信キュー
+# =========================
+# pyserial の write は Bluetooth SPP だと数十ms止まることがあるので、
+# ESP32 1台ごとに送信専用のタスクを持ち、イベントループの外 (executor) で書き込む。
+# WebSocket の処理側は send() でキューに積むだけで、すぐに戻る。
+#
+# フレームの種類 (send の mode):
+#   APPEND  : そのまま順番に送る (LED のエッジ番号リストなど)
+#   REPLACE : 同じ key の未送信フレームがあれば置き換える (モーターのコマンド列、delay= など)
+#   RESET   : これより前の未送信フレームはすべて不要になる (RESET、stop など)
+APPEND = "append"
+REPLACE = "replace"
+RESET = "reset"
+
+
+class SerialWriter:
+    """1台のデバイス (シリアルポート) への送信キューと送信タスク。"""
+
+    def __init__(self, name, port, max_queue=64):
+        self.name = name
+        self.port = port
+        self.max_queue = max_queue
+        self._queue = deque()  # [mode, key, data, 積んだ時刻]
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = None
+        # 計測値
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.writes = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.last_write_ms = 0.0
+        self.max_write_ms = 0.0
+        self.total_write_ms = 0.0
+        self.max_latency_ms = 0.0  # 積んでから書き終わるまで
+
+    # ---- 積む側 (イベントループから呼ぶ) ----
+    def send(self, data, mode=APPEND, key=None):
+        """フレームをキューに積む。書き込みは待たない。"""
+        queue = self._queue
+        now = time.perf_counter()
+        if mode == RESET:
+            self.coalesced += len(queue)
+            queue.clear()
+        elif mode == REPLACE:
+            for frame in queue:
+                if frame[0] == REPLACE and frame[1] == key:
+                    frame[2] = data  # 順番はそのまま、中身だけ新しくする
+                    frame[3] = now
+                    self.coalesced += 1
+                    self._wake()
+                    return
+        if len(queue) >= self.max_queue:
+            queue.popleft()
+            self.dropped += 1
+            print(f"[{self.name}] 送信キューがいっぱいなので古いフレームを捨てた")
+        queue.append([mode, key, data, now])
+        self.max_depth = max(self.max_depth, len(queue))
+        self._wake()
+
+    def _wake(self):
+        self._idle.clear()
+        self._wakeup.set()
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    # ---- 送信タスク ----
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._idle.set()
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # 溜まっているフレームを1回の write にまとめる
+            frames = list(self._queue)
+            self._queue.clear()
+            data = b"".join(frame[2] for frame in frames)
+            t0 = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, self._write_blocking, data)
+            except Exception as e:
+                print(f"[{self.name}] 書き込みエラー: {e}")
+                continue
+            t1 = time.perf_counter()
+            write_ms = (t1 - t0) * 1000
+            METRICS.observe(f"serial_write_{self.name.lower()}", write_ms)
+            self.writes += 1
+            self.frames_written += len(frames)
+            self.bytes_written += len(data)
+            self.last_write_ms = write_ms
+            self.max_write_ms = max(self.max_write_ms, write_ms)
+            self.total_write_ms += write_ms
+            self.max_latency_ms = max(self.max_latency_ms, (t1 - frames[0][3]) * 1000)
+
+    def _write_blocking(self, data):
+        self.port.write(data)
+        self.port.flush()
+
+    async def drain(self):
+        """キューが空になり、書き込みが終わるまで待つ。"""
+        if self._task is None:
+            return
+        await self._idle.wait()
+
+    async def close(self):
+        """残りを送り切ってからタスクを止め、ポートを閉じる。"""
+        await self.drain()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.port is not None and self.port.is_open:
+            self.port.close()
+
+    def stats(self):
+        return {
+            "device": self.name,
+            "queue_depth": len(self._queue),
+            "max_queue_depth": self.max_depth,
+            "frames_written": self.frames_written,
+            "bytes_written": self.bytes_written,
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "last_write_ms": round(self.last_write_ms, 3),
+            "max_write_ms": round(self.max_write_ms, 3),
+            "avg_write_ms": round(self.total_write_ms / self.writes, 3) if self.writes else 0.0,
+            "max_latency_ms": round(self.max_latency_ms, 3)
+        }
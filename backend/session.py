@@ -0,0 +1,180 @@
+import asyncio
+import itertools
+import json
+from collections import deque
+
+# =========================
+# WebSocket セッション (1接続ぶんの状態)
+# =========================
+# 1つの接続で複数の問い合わせを同時に扱えるようにする。
+#   - 問い合わせごとにタスクを作り、終わった順に応答を返す (順不同)
+#   - "request_id" を付けて送ってきたら、応答・候補の続き・選択結果にも同じ id を付ける
+#   - "request_id" がない (今までの p5_test.js) 場合は、その形式で一番新しく届いた問い合わせに
+#     selected_path / cursor を渡すので、従来のメッセージ形式のまま動く。新しい問い合わせが届いたら
+#     前のものは選択を待たずに終わらせる (画面には新しい問い合わせの候補が出るので、前の経路を走らせない)
+#   - 問い合わせと関係ないメッセージを選択結果として扱うことはない
+#   - 購読しているクライアントには、車の走行状況などの通知を push() で送る (応答とは別のキュー)
+#   - 同時に実行中の問い合わせは max_requests 件まで。超えたら busy になり、呼び出し側は
+#     タスクを作らずに断る (送り続けるクライアントのタスクや計算待ちが際限なく積み上がらないように)
+
+
+class SelectionSuperseded(Exception):
+    """request_id なしの問い合わせが、後から届いた問い合わせに置き換えられた。"""
+
+
+class PendingQuery:
+    """候補経路を送って、JS側の選択を待っている問い合わせ。"""
+
+    def __init__(self, request_id, legacy):
+        self.request_id = request_id
+        self.legacy = legacy  # request_id なしで届いた問い合わせ
+        self.selection = asyncio.get_running_loop().create_future()  # 置き換えられたら None
+        self.on_cursor = None  # cursor 要求を処理するコルーチン関数 (cursor) -> None
+
+    @property
+    def superseded(self):
+        return self.selection.done() and self.selection.result() is None
+
+
+class Session:
+    def __init__(self, websocket, selection_timeout=120.0, max_notifications=256, max_requests=16):
+        self.websocket = websocket
+        self.selection_timeout = selection_timeout
+        self._ids = itertools.count(1)
+        self._pending = {}  # request_id -> PendingQuery (選択待ち、登録順)
+        self._latest_legacy = None  # 一番新しく届いた request_id なしの問い合わせの id
+        self._tasks = set()
+        self.max_requests = max_requests
+        self._requests = set()  # _tasks のうち問い合わせのもの (通知の送信タスクは含まない)
+        self._notifications = deque(maxlen=max_notifications)  # push() で積んだ未送信の通知
+        self._notify = asyncio.Event()
+        self._notifier = None
+
+    def new_request_id(self):
+        """
+        request_id なしの問い合わせ用に、接続内で一意な id を作る (問い合わせが届いたときに呼ぶ)。
+        選択を受け付けるのは、最後に作った id の問い合わせだけになる。
+        """
+        self._latest_legacy = f"_{next(self._ids)}"
+        return self._latest_legacy
+
+    async def send(self, obj, request_id=None):
+        """応答を送る。request_id 付きの問い合わせなら応答にも同じ id を付ける。"""
+        if request_id is not None:
+            obj = dict(obj, request_id=request_id)
+        await self.websocket.send(json.dumps(obj))
+
+    async def send_json(self, text, request_id=None):
+        """json.dumps 済みの応答を送る (request_id 付きなら付け直す)。"""
+        if request_id is not None:
+            return await self.send(json.loads(text), request_id)
+        await self.websocket.send(text)
+
+    # ---- 選択待ち ----
+    def expect_selection(self, request_id, legacy):
+        """
+        選択待ちとして登録する。request_id なしの問い合わせは、後から別の問い合わせが届いていれば
+        登録せずに置き換えられたもの (superseded) として返し、そうでなければ前のものを置き換える。
+        """
+        query = PendingQuery(request_id, legacy)
+        if legacy:
+            if request_id != self._latest_legacy:
+                query.selection.set_result(None)
+                return query
+            for old in self._pending.values():
+                if old.legacy and not old.selection.done():
+                    old.selection.set_result(None)
+        self._pending[request_id] = query
+        return query
+
+    async def wait_selection(self, query):
+        """
+        選択結果 (selected_path を含むメッセージ) を待つ。
+        selection_timeout 秒たっても来なければ asyncio.TimeoutError、
+        新しい問い合わせに置き換えられたら SelectionSuperseded。
+        """
+        try:
+            selection = await asyncio.wait_for(query.selection, self.selection_timeout)
+            if selection is None:
+                raise SelectionSuperseded(query.request_id)
+            return selection
+        finally:
+            self._pending.pop(query.request_id, None)
+
+    def _find_pending(self, data):
+        request_id = data.get("request_id")
+        if request_id is not None:
+            return self._pending.get(request_id)
+        # request_id がなければ、従来形式で一番新しく届いた問い合わせ (まだ計算中なら None)
+        return self._pending.get(self._latest_legacy)
+
+    def route(self, data):
+        """
+        selected_path / cursor のメッセージを該当する問い合わせに渡す。
+        渡した (または処理を始めた) なら True。cursor が 0 以上の整数でなければ ValueError。
+        """
+        if "selected_path" not in data and "cursor" in data:
+            cursor = data["cursor"]
+            if isinstance(cursor, bool) or not isinstance(cursor, int) or cursor < 0:
+                raise ValueError(f"cursor must be a non-negative integer: {cursor!r}")
+        query = self._find_pending(data)
+        if query is None:
+            return False
+        if "selected_path" in data:
+            if not query.selection.done():
+                query.selection.set_result(data)
+            return True
+        if "cursor" in data and query.on_cursor is not None:
+            self.spawn(query.on_cursor(data["cursor"]))
+            return True
+        return False
+
+    # ---- 通知 (テレメトリなど、問い合わせと関係なくサーバーから送るもの) ----
+    def push(self, obj):
+        """
+        通知を送信キューに積む (待たない。イベントループから呼ぶ)。
+        クライアントが遅くて溜まりすぎたら、古い通知から捨てる。
+        """
+        self._notifications.append(obj)
+        self._notify.set()
+        if self._notifier is None:
+            self._notifier = self.spawn(self._send_notifications(), request=False)
+
+    async def _send_notifications(self):
+        try:
+            while True:
+                while self._notifications:
+                    await self.websocket.send(json.dumps(self._notifications.popleft()))
+                self._notify.clear()
+                await self._notify.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass  # 切断された (残りの通知は捨てる)
+
+    # ---- タスク管理 ----
+    def spawn(self, coro, request=True):
+        """タスクを作る。request=True なら問い合わせとして数える (先に busy を確かめておく)。"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if request:
+            self._requests.add(task)
+            task.add_done_callback(self._requests.discard)
+        return task
+
+    @property
+    def busy(self):
+        """実行中の問い合わせが max_requests 件に達している (新しい問い合わせは断る)。"""
+        return len(self._requests) >= self.max_requests
+
+    @property
+    def in_flight(self):
+        return len(self._requests)
+
+    async def close(self):
+        """接続が切れたら、実行中の問い合わせをすべて取り消す。"""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
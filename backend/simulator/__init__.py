@@ -0,0 +1,8 @@
+# =========================
+# ESP32 (車・LED 2台) のシミュレータ
+# =========================
+# 擬似端末 (PTY) を開き、ファームウェアと同じ形式のデータを受け取って同じように返事をする。
+# 使い方 (backend ディレクトリで):
+#   python -m simulator.run                       (擬似端末のパスを表示して待つ)
+#   python -m simulator.run --probe 20            (サーバーも同じプロセスで起動し、WebSocket -> シリアルの往復時間を測る)
+# サーバーを別に起動するときは、表示された環境変数 (ESP32_MOTOR_PORT など) を付けて dijkstra.py を起動する。
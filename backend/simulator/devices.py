@@ -0,0 +1,379 @@
+import asyncio
+import os
+import random
+import time
+import tty
+
+from led_frames import FRAME_MAGIC, decode_frame, apply_frame
+from motor_program import PROGRAM_MAGIC, FRAME_STOP, MAX_COMMANDS, ProgramReceiver
+
+# =========================
+# 擬似端末の上のデバイス
+# =========================
+# Bluetooth SPP の遅さは「受信側が link_bps バイト/秒でしか読まない」ことで表す。
+# 読まなかった分は擬似端末のバッファに溜まり、いっぱいになるとバックエンドの write が止まる
+# (本物の SPP と同じバックプレッシャー)。stall_prob の確率で stall_ms だけ受信が止まる (電波の再送など)。
+# 受け取ったデータは、ファームウェアと同じく loop() の周期ごとに処理する。
+
+SPP_BPS = 11520  # 115200 bps (8N1) 相当のバイト/秒
+READ_CHUNK = 256
+
+
+class SimDevice:
+    """1台の ESP32。擬似端末の master 側を持ち、slave 側のパス (self.path) をバックエンドに開かせる。"""
+
+    def __init__(self, name, link_bps=SPP_BPS, stall_prob=0.0, stall_ms=0.0, loop_ms=1.0,
+                 time_scale=1.0, seed=None):
+        self.name = name
+        self.link_bps = link_bps
+        self.stall_prob = stall_prob
+        self.stall_ms = stall_ms
+        self.loop_ms = loop_ms
+        self.time_scale = time_scale  # 走行・旋回などファームウェア内の待ち時間に掛ける (通信の速さは変えない)
+        self.rng = random.Random(seed)
+        self.master, slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(slave)
+        self._slave = slave  # バックエンドが開くまで閉じない (閉じると master の読み込みがエラーになる)
+        self._rx = bytearray()     # 届いたが、まだファームウェアが処理していないデータ
+        self._arrived = asyncio.Event()
+        self._tasks = []
+        self.hooks = []  # hook(デバイス名, 種類, 時刻) (何かを適用したとき。計測用)
+        # 計測値
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.replies_dropped = 0
+        self.stalls = 0
+
+    # ---- 通信 ----
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._link()), loop.create_task(self._firmware_loop())]
+
+    async def _link(self):
+        """link_bps の速さで擬似端末から読む。"""
+        loop = asyncio.get_running_loop()
+        free_at = loop.time()
+        while True:
+            readable = loop.create_future()
+            loop.add_reader(self.master, readable.set_result, None)
+            try:
+                await readable
+            finally:
+                loop.remove_reader(self.master)
+            try:
+                data = os.read(self.master, READ_CHUNK)
+            except BlockingIOError:
+                continue
+            except OSError:
+                return
+            free_at = max(free_at, loop.time()) + len(data) / self.link_bps
+            if self.stall_prob and self.rng.random() < self.stall_prob:
+                self.stalls += 1
+                free_at += self.stall_ms / 1000
+            await asyncio.sleep(free_at - loop.time())
+            self.bytes_received += len(data)
+            self._rx += data
+            self._arrived.set()
+
+    def reply(self, line):
+        """バックエンドへ1行送る (SerialBT.println)。"""
+        data = (line + "\r\n").encode("utf-8")
+        try:
+            os.write(self.master, data)
+        except BlockingIOError:
+            self.replies_dropped += 1  # バックエンドが読んでいない
+            return
+        self.bytes_sent += len(data)
+
+    def notify(self, kind):
+        now = time.perf_counter()
+        for hook in self.hooks:
+            hook(self.name, kind, now)
+
+    async def sleep(self, ms):
+        """ファームウェアの delay(ms)。"""
+        await asyncio.sleep(ms * self.time_scale / 1000)
+
+    # ---- ファームウェア ----
+    async def _firmware_loop(self):
+        while True:
+            if not self._rx:
+                self._arrived.clear()
+                await self._arrived.wait()
+            await self.process_input()
+            await self.sleep(self.loop_ms)
+
+    async def process_input(self):
+        raise NotImplementedError
+
+    def _take_line(self):
+        """"\\n" までの1行を取り出す (まだ届いていなければ None)。"""
+        end = self._rx.find(b"\n")
+        if end < 0:
+            return None
+        line = bytes(self._rx[:end]).decode("utf-8", errors="replace").strip()
+        del self._rx[:end + 1]
+        return line
+
+    def _take_frame(self, magic):
+        """先頭の2進フレームを取り出す。まだ全部届いていなければ None、壊れていれば先頭を捨てて False。"""
+        try:
+            frame = decode_frame(self._rx, magic)
+        except ValueError:
+            del self._rx[0]
+            return False
+        if frame is not None:
+            del self._rx[:frame[3]]
+        return frame
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for fd in (self.master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            "device": self.name,
+            "path": self.path,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "replies_dropped": self.replies_dropped,
+            "stalls": self.stalls
+        }
+
+
+class SimLedController(SimDevice):
+    """
+    LED_Control_1.ino / LED_control_2.ino と同じ動き。
+    0xA5 の2進フレーム (FULL / DELTA、基準が合わなければ "RESYNC") と、
+    従来の "18,19\\n" (点けるだけ) / "RESET\\n" を受け付ける。
+    """
+
+    def __init__(self, name, first, count, **kwargs):
+        super().__init__(name, **kwargs)
+        self.first = first
+        self.count = count
+        self.states = [False] * count
+        self.last_seq = None
+        self.frames_applied = 0
+        self.resyncs = 0
+
+    @property
+    def lit(self):
+        """点いている LED のエッジ番号。"""
+        return [self.first + i for i, on in enumerate(self.states) if on]
+
+    async def process_input(self):
+        while self._rx:
+            if self._rx[0] == FRAME_MAGIC:
+                frame = self._take_frame(FRAME_MAGIC)
+                if frame is None:
+                    return
+                if frame is False:
+                    self._request_resync()
+                    continue
+                kind, seq, payload, _ = frame
+                new_seq = apply_frame(self.states, kind, seq, payload, self.last_seq)
+                if new_seq is None:
+                    self._request_resync()
+                    continue
+                self.last_seq = new_seq
+                self.frames_applied += 1
+                self.notify("led_frame")
+                continue
+            line = self._take_line()
+            if line is None:
+                return
+            if line.upper() == "RESET":
+                self.states = [False] * self.count
+                self.last_seq = None
+                self.notify("led_reset")
+                continue
+            for token in line.split(","):
+                try:
+                    signal = int(token)
+                except ValueError:
+                    continue
+                # LED2 は 18〜26 を 1〜9 に直す (ファームウェアと同じ)
+                if self.first > 1 and self.first <= signal < self.first + self.count:
+                    signal -= self.first - 1
+                if 1 <= signal <= self.count:
+                    self.states[signal - 1] = True
+            self.notify("led_ascii")
+
+    def _request_resync(self):
+        self.last_seq = None
+        self.resyncs += 1
+        self.reply("RESYNC")
+
+    def stats(self):
+        return dict(super().stats(), lit=self.lit, frames_applied=self.frames_applied,
+                    resyncs=self.resyncs)
+
+
+class SimCar(SimDevice):
+    """
+    Bluetooth_Monitor_car.ino と同じ動き。
+    0xA6 の2進プログラム (ACK / NAK / OK / ERR を返す) と、従来の "delay=1120\\n" / "stop\\n" /
+    "straight,left,...\\n" を受け付け、命令を順に実行して STEP / STOP / dist / All commands finished を返す。
+    straight は segment_ms 走ると壁がなくなり (超音波の距離が 13cm 以下 -> 25cm 超)、止まって次の命令へ進む。
+    block_prob の確率 (または block_next() の後) で straight の区間が通行止めになり、segment_timeout_ms で
+    止まって "BLOCKED <i>" を返し、次のプログラムを待つ。
+    """
+
+    def __init__(self, name="MOTOR", segment_ms=2000.0, segment_jitter=0.2, loop_ms=200.0,
+                 segment_timeout_ms=15000.0, block_prob=0.0, **kwargs):
+        super().__init__(name, loop_ms=loop_ms, **kwargs)
+        self.segment_ms = segment_ms
+        self.segment_jitter = segment_jitter
+        self.segment_timeout_ms = segment_timeout_ms
+        self.block_prob = block_prob
+        self.block_pending = 0
+        self.segment_deadline = None
+        self.blocked = 0
+        self.receiver = ProgramReceiver()
+        self.turn_delay = 1300
+        self.ops = []       # [(命令名, 旋回時間), ...]
+        self.index = 0
+        self.running = False
+        self.ignoring_wall = True
+        self.wall_gone_at = None
+        self.programs_started = 0
+        self.finished = 0
+
+    async def _firmware_loop(self):
+        # 走っている間は入力がなくても loop() を回す (壁の確認)
+        while True:
+            if not self._rx and not self.running:
+                self._arrived.clear()
+                await self._arrived.wait()
+            await self.process_input()
+            if self.running:
+                await self._check_wall()
+            await self.sleep(self.loop_ms)
+
+    async def process_input(self):
+        # 2進プログラムのフレームは届いている分を全部処理する
+        while self._rx and self._rx[0] == PROGRAM_MAGIC:
+            frame = self._take_frame(PROGRAM_MAGIC)
+            if frame is None:
+                return
+            if frame is False:
+                continue
+            kind, _, payload, _ = frame
+            reply = self.receiver.handle_frame(kind, payload)
+            if reply:
+                self.reply(reply)
+            if reply and reply.startswith("OK "):
+                self.notify("program")
+                await self._run(list(self.receiver.steps))
+            elif kind == FRAME_STOP:
+                self._stop_all()
+                self.notify("stop")
+        if not self._rx:
+            return
+        # テキストは1回の loop() で1行
+        line = self._take_line()
+        if line is None:
+            return
+        if line.startswith("delay="):
+            try:
+                self.turn_delay = int(line[6:])
+            except ValueError:
+                pass
+            return
+        if line == "stop":
+            self._stop_all()
+            self.notify("stop")
+            return
+        ops = [(cmd.strip(), self.turn_delay) for cmd in line.split(",") if cmd.strip()]
+        if len(ops) > MAX_COMMANDS:
+            # 命令の配列に入りきらない行は切り詰めずに捨てて止まる (ファームウェアと同じ)
+            self._stop_all()
+            self.notify("stop")
+            return
+        self.notify("program")
+        await self._run(ops)
+
+    def _stop_all(self):
+        self.running = False
+        self.ops = []
+        self.index = 0
+
+    async def _run(self, ops):
+        self._stop_all()
+        self.ops = ops
+        self.programs_started += 1
+        if ops:
+            await self._execute(0)
+
+    async def _execute(self, index):
+        """executeCommand。旋回は delay の間 loop() を止める (ファームウェアと同じ)。"""
+        while index < len(self.ops):
+            self.index = index
+            op, delay = self.ops[index]
+            self.reply(f"STEP {index} {op}")
+            if op in ("straight", "back"):
+                self.running = True
+                self.ignoring_wall = True
+                now = time.perf_counter()
+                jitter = 1 + self.rng.uniform(-self.segment_jitter, self.segment_jitter)
+                self.wall_gone_at = now + self.segment_ms * jitter * self.time_scale / 1000
+                self.segment_deadline = now + self.segment_timeout_ms * self.time_scale / 1000
+                if op == "straight" and (self.block_pending or self.rng.random() < self.block_prob):
+                    self.block_pending = max(0, self.block_pending - 1)
+                    self.wall_gone_at = float("inf")
+                return
+            self.running = False
+            if op in ("left", "right", "stop"):
+                # 旋回と、プログラムの途中の stop (その場で待つ) は delay の間 loop() を止める
+                await self.sleep(delay)
+                if op == "left" and index + 1 < len(self.ops) and self.ops[index + 1][0] != "straight":
+                    self.ops[index + 1] = ("straight", self.ops[index + 1][1])
+            index += 1
+        self.running = False
+        self.finished += 1
+        self.reply("All commands finished")
+        self.notify("finished")
+
+    def block_next(self):
+        """走っている straight (なければ次の straight) を通行止めにする。"""
+        if self.running and self.ops[self.index][0] == "straight":
+            self.wall_gone_at = float("inf")
+        else:
+            self.block_pending += 1
+
+    async def _check_wall(self):
+        if time.perf_counter() > self.segment_deadline:
+            # 区間が終わらない -> 止まって知らせ、新しいプログラムを待つ
+            self.reply(f"BLOCKED {self.index}")
+            self.notify("blocked")
+            self.blocked += 1
+            self.running = False
+            return
+        # 走り出した直後は必ず壁の横にいる (最初の確認で壁を見つける)
+        wall = self.ignoring_wall or time.perf_counter() < self.wall_gone_at
+        dist = 10.0 if wall else 40.0
+        self.reply(f"dist1: {dist:.2f}")
+        self.reply(f"dist2: {dist:.2f}")
+        if self.ignoring_wall:
+            if dist <= 13.0:
+                self.ignoring_wall = False
+        elif dist > 25.0:
+            self.reply(f"STOP {self.index}")
+            self.notify("segment_stop")
+            self.running = False
+            await self.sleep(500)
+            await self._execute(self.index + 1)
+
+    def stats(self):
+        return dict(super().stats(), programs_started=self.programs_started, finished=self.finished,
+                    blocked=self.blocked,
+                    step=self.index if self.ops else None)
@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+from map_loader import load_map
+from simulator.devices import SimCar, SimLedController, SPP_BPS
+
+# =========================
+# シミュレータの起動と、WebSocket -> シリアルの往復時間の計測
+# =========================
+# 車 1台と LED コントローラ (マップファイルの led_controllers の数) の擬似端末を開く。
+#   通常:     擬似端末のパスと、dijkstra.py に渡す環境変数を表示して待つ (Ctrl+C で統計を表示して終了)
+#   --probe N: 同じプロセスで dijkstra のサーバーも起動し、N 件の問い合わせについて
+#              候補が返るまで (plan)、選択してから LED にフレームが届くまで (led)、
+#              車がプログラムを受け取り終えて走り出すまで (motor) の時間を測る
+
+MAP_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "maps", "base_map.json")
+ENV_NAMES = {"motor": "ESP32_MOTOR_PORT", "led1": "ESP32_LED1_PORT", "led2": "ESP32_LED2_PORT"}
+
+
+def create_devices(args):
+    """{デバイス名: SimDevice}。"""
+    link = {"link_bps": args.link_bps, "stall_prob": args.stall_prob, "stall_ms": args.stall_ms,
+            "time_scale": args.time_scale}
+    devices = {"motor": SimCar(segment_ms=args.segment_ms, seed=args.seed,
+                               segment_timeout_ms=getattr(args, "segment_timeout_ms", 15000.0),
+                               block_prob=getattr(args, "block_prob", 0.0), **link)}
+    for name, (first, last) in load_map(MAP_FILE).led_controllers.items():
+        devices[name] = SimLedController(name.upper(), first, last - first + 1, seed=args.seed, **link)
+    return devices
+
+
+def device_env(devices):
+    return {ENV_NAMES[name]: device.path for name, device in devices.items() if name in ENV_NAMES}
+
+
+def summarize(samples_ms):
+    if not samples_ms:
+        return {"runs": 0}
+    return {
+        "runs": len(samples_ms),
+        "p50_ms": round(float(np.percentile(samples_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples_ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(samples_ms, 99)), 3),
+        "max_ms": round(max(samples_ms), 3)
+    }
+
+
+async def serve(args):
+    devices = create_devices(args)
+    for device in devices.values():
+        device.start()
+    print("擬似端末を開きました。サーバーは次の環境変数を付けて起動してください:")
+    for key, path in device_env(devices).items():
+        print(f"  export {key}={path}")
+    try:
+        await asyncio.Future()
+    finally:
+        print(json.dumps({name: d.stats() for name, d in devices.items()}, indent=2, ensure_ascii=False))
+        for device in devices.values():
+            device.close()
+
+
+class EventWaiter:
+    """デバイスの hook から、次に起きた種類 kind のイベントの時刻を待つ。"""
+
+    def __init__(self):
+        self._waiting = {}  # kind -> future
+
+    def hook(self, device, kind, t):
+        future = self._waiting.pop(kind, None)
+        if future is not None and not future.done():
+            future.set_result(t)
+
+    def arm(self, kind):
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[kind] = future
+        return future
+
+
+async def wait_or_none(future, timeout):
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def probe(args):
+    import websockets
+
+    devices = create_devices(args)
+    for device in devices.values():
+        device.start()
+    os.environ.update(device_env(devices))
+    os.environ["ESP32_OPEN_WAIT"] = "0"
+    import dijkstra  # 環境変数を設定してから読み込む
+
+    waiter = EventWaiter()
+    for device in devices.values():
+        device.hooks.append(waiter.hook)
+
+    await dijkstra.init_serial()
+    rng = random.Random(args.seed)
+    names = list(dijkstra.BASE_CSR.names)
+    indptr, indices = dijkstra.BASE_CSR.indptr, dijkstra.BASE_CSR.indices
+    edges = sorted({f"{names[u]}-{names[int(v)]}"
+                    for u in range(len(names)) for v in indices[indptr[u]:indptr[u + 1]] if u < v})
+    samples = {"plan": [], "led": [], "motor": []}
+    missed = {"led": 0, "motor": 0}
+    errors = 0
+    t_start = time.perf_counter()
+    async with websockets.serve(dijkstra.handle_connection, "localhost", args.port):
+        async with websockets.connect(f"ws://localhost:{args.port}") as ws:
+            for i in range(args.probe):
+                start, goal = rng.sample(names, 2)
+                remove = rng.sample(edges, rng.randint(0, args.max_remove))
+                t0 = time.perf_counter()
+                await ws.send(json.dumps({"start": start, "goal": goal, "remove_edges": remove,
+                                          "request_id": i}))
+                response = json.loads(await ws.recv())
+                samples["plan"].append((time.perf_counter() - t0) * 1000)
+                if "error" in response:
+                    errors += 1
+                    continue
+                selected = rng.choice(response["candidate_paths"])
+                led_applied = waiter.arm("led_frame")
+                program = waiter.arm("program")
+                t1 = time.perf_counter()
+                await ws.send(json.dumps({"selected_path": selected, "request_id": i}))
+                t_motor = await wait_or_none(program, args.timeout)
+                # 前と同じ LED の状態ならフレームは送られない
+                t_led = await wait_or_none(led_applied, 0.0 if led_applied.done() else 0.5)
+                for key, t in (("motor", t_motor), ("led", t_led)):
+                    if t is None:
+                        missed[key] += 1
+                    else:
+                        samples[key].append((t - t1) * 1000)
+    elapsed = time.perf_counter() - t_start
+
+    stats = dijkstra.collect_stats()
+    report = {
+        "meta": {"requests": args.probe, "link_bps": args.link_bps, "stall_prob": args.stall_prob,
+                 "stall_ms": args.stall_ms, "time_scale": args.time_scale, "seed": args.seed},
+        "throughput_rps": round(args.probe / elapsed, 2),
+        "latency": {key: summarize(values) for key, values in samples.items()},
+        "missed": missed,
+        "route_errors": errors,
+        "serial": stats["serial"],
+        "devices": {name: d.stats() for name, d in devices.items()}
+    }
+    for reader in (dijkstra.reader_motor, dijkstra.reader_led1, dijkstra.reader_led2):
+        if reader is not None:
+            reader.close()
+    for writer in (dijkstra.writer_motor, dijkstra.writer_led1, dijkstra.writer_led2):
+        if writer is not None:
+            await writer.close()
+    for device in devices.values():
+        device.close()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ESP32 (車・LED) の擬似端末シミュレータ")
+    parser.add_argument("--link-bps", type=float, default=SPP_BPS, help="Bluetooth SPP の速さ (バイト/秒)")
+    parser.add_argument("--stall-prob", type=float, default=0.0, help="受信が止まる確率 (読み込み1回ごと)")
+    parser.add_argument("--stall-ms", type=float, default=0.0, help="止まる時間 (ms)")
+    parser.add_argument("--segment-ms", type=float, default=2000.0, help="車が1区間を走る時間 (ms)")
+    parser.add_argument("--segment-timeout-ms", type=float, default=15000.0,
+                        help="straight の区間がこの時間で終わらなければ BLOCKED を返す (ms)")
+    parser.add_argument("--block-prob", type=float, default=0.0,
+                        help="straight の区間が通行止めになっている確率 (経路の引き直しの確認用)")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="ファームウェア内の待ち時間 (loop の周期、旋回、走行) に掛ける倍率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--probe", type=int, default=0, help="往復時間を測る問い合わせの数 (0 なら待つだけ)")
+    parser.add_argument("--max-remove", type=int, default=2, help="問い合わせごとの通行止めの最大数")
+    parser.add_argument("--timeout", type=float, default=10.0, help="車の応答を待つ最大秒数")
+    parser.add_argument("--port", type=int, default=8766, help="probe で起動するサーバーのポート")
+    parser.add_argument("--out", help="probe の結果の JSON を書き出すファイル")
+    args = parser.parse_args(argv)
+
+    if not args.probe:
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    report = asyncio.run(probe(args))
+    for key, row in report["latency"].items():
+        print(f"{key:<6} " + "  ".join(f"{k}={v}" for k, v in row.items()), file=sys.stderr)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
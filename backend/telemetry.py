@@ -0,0 +1,218 @@
+import time
+from collections import deque
+
+from motor_program import parse_reply
+
+# =========================
+# 車の走行状況 (テレメトリ)
+# =========================
+# 車 ESP32 から SerialBT で届く行を解釈し、走行中のプログラムの進み具合と
+# 区間ごとの所要時間を記録して、購読している WebSocket クライアントに通知する。
+# 車から届く行:
+#   "STEP <i> <命令>"        i 番目の命令を始めた (区間の始まり)
+#   "STOP <i>"               壁がなくなって止まった (straight の区間の終わり)
+#   "BLOCKED <i>"            i 番目の straight / back が時間内に終わらず、止まって次のプログラムを待っている
+#                            (通行止め・障害物。replanner.py で今の位置から引き直す)
+#   "1"                      従来の停止信号 (STOP と同じ扱い)
+#   "dist1: <cm>" / "dist2: <cm>"  超音波センサの距離
+#   "All commands finished"  全部の命令が終わった
+#   "ACK ..." / "NAK ..." / "OK ..." / "ERR ..."  プログラム送信の返事 (motor_program.py)
+# それ以外の行は "log" として残す。
+
+
+def parse_line(line):
+    """車からの1行 -> イベントの辞書 ({"kind": ..., ...})。"""
+    if line.startswith("STEP "):
+        parts = line.split()
+        if len(parts) == 3 and parts[1].isdigit():
+            return {"kind": "step", "index": int(parts[1]), "action": parts[2]}
+    if line.startswith("STOP "):
+        index = line[5:].strip()
+        if index.isdigit():
+            return {"kind": "stop", "index": int(index)}
+    if line.startswith("BLOCKED "):
+        index = line[8:].strip()
+        if index.isdigit():
+            return {"kind": "blocked", "index": int(index)}
+    if line == "1":
+        return {"kind": "stop", "index": None}
+    if line.startswith("dist1:") or line.startswith("dist2:"):
+        try:
+            return {"kind": "distance", "sensor": int(line[4]), "cm": float(line[6:])}
+        except ValueError:
+            pass
+    if line == "All commands finished":
+        return {"kind": "finished"}
+    reply = parse_reply(line)
+    if reply is not None:
+        return {"kind": "program", "reply": reply[0], "program_id": reply[1], "value": reply[2]}
+    return {"kind": "log", "text": line}
+
+
+class CarTelemetry:
+    """
+    車のイベントの記録 (直近 history 件のリングバッファ) と、走行中のプログラムの区間ごとの時間。
+    subscribe(callback) すると、イベントごとに callback(通知の辞書) が呼ばれる。
+    """
+
+    def __init__(self, history=1024):
+        self.events = deque(maxlen=history)
+        self._subscribers = []
+        self.program = None   # 走行中のプログラム {"program_id", "actions", "path", "started"}
+        self.segments = []    # 終わった区間 [{"index", "action", "from", "to", "ms"}, ...]
+        self._open = None     # 走っている区間 (index, action, 始まった時刻)
+        self._last = None     # 最後に始めた命令の番号
+        self._blocked = None  # 進めなくなった命令の番号
+        self._finished = False
+        self.distance = {1: None, 2: None}
+        self.stop_signals = 0
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def start_program(self, actions, path=None, program_id=None, heading=None):
+        """
+        新しいプログラムを送ったときに呼ぶ (区間の記録をやり直す)。
+        heading は走り出す前の車の向き (a, b) (省略時は path[0] -> path[1])。
+        """
+        if heading is None and path is not None and len(path) >= 2:
+            heading = (path[0], path[1])
+        self.program = {
+            "program_id": program_id,
+            "actions": list(actions),
+            "path": list(path) if path is not None else None,
+            "heading": heading,
+            "started": time.perf_counter()
+        }
+        self.segments = []
+        self._open = None
+        self._last = None
+        self._blocked = None
+        self._finished = False
+        self._publish({"kind": "program_started", "steps": len(self.program["actions"])},
+                      self.program["started"])
+
+    def _edge_of(self, index):
+        """
+        index 番目の命令が straight なら、走っているエッジ (from, to)。
+        straight の数はエッジの数と同じ (decide_directions の規則) なので、何番目の straight かで分かる。
+        """
+        program = self.program
+        if program is None or program["path"] is None or index >= len(program["actions"]):
+            return None, None
+        if program["actions"][index] != "straight":
+            return None, None
+        k = program["actions"][:index].count("straight")
+        path = program["path"]
+        if k + 1 >= len(path):
+            return None, None
+        return path[k], path[k + 1]
+
+    def _close_segment(self, t):
+        if self._open is None:
+            return None
+        index, action, began = self._open
+        self._open = None
+        src, dst = self._edge_of(index)
+        segment = {"index": index, "action": action, "from": src, "to": dst,
+                   "ms": round((t - began) * 1000, 1)}
+        self.segments.append(segment)
+        return segment
+
+    def on_line(self, received, line):
+        """SerialReader の handler。"""
+        event = parse_line(line)
+        kind = event["kind"]
+        if kind == "step":
+            event["from"], event["to"] = self._edge_of(event["index"])
+            self._last = event["index"]
+        elif kind == "blocked":
+            event["from"], event["to"] = self._edge_of(event["index"])
+            self._blocked = event["index"]
+        elif kind == "stop":
+            self.stop_signals += 1
+            if event["index"] is None and self._open is not None:
+                event["index"] = self._open[0]
+        elif kind == "distance":
+            self.distance[event["sensor"]] = event["cm"]
+        elif kind == "finished" and self.program is not None:
+            event["total_ms"] = round((received - self.program["started"]) * 1000, 1)
+            self._finished = True
+
+        # 次の命令を始めた / 止まった / 進めなくなった / 全部終わった なら、走っていた区間を閉じる
+        if kind in ("step", "stop", "blocked", "finished"):
+            segment = self._close_segment(received)
+            if segment is not None:
+                self._publish(dict(segment, kind="segment"), received)
+        self._publish(event, received)
+        if kind == "step":
+            self._open = (event["index"], event["action"], received)
+
+    def position(self):
+        """
+        走行中の車の位置 (経路を引き直す起点)。プログラムがない・経路が分からない・走り終えたなら None。
+          {"state": "driving", "edge": (u, v)}   u -> v を走っている (旋回中も、旋回の後に走るエッジ)
+          {"state": "at_node", "node": n, "heading": (a, b)}  n で a -> b の向きを向いて走り出すのを待っている
+          {"state": "blocked", "edge": (u, v)}   u -> v の途中で進めなくなった (back 中も同じ扱い)
+        """
+        program = self.program
+        if program is None or program["path"] is None or self._finished or len(program["path"]) < 2:
+            return None
+        path = program["path"]
+        actions = program["actions"]
+        heading = program["heading"]
+        if self._blocked is not None:
+            edge = self._edge_of(self._blocked)
+            return {"state": "blocked", "edge": edge if edge[0] is not None else heading}
+        if self._open is not None:
+            index, action = self._open[0], self._open[1]
+            if action == "back":
+                # 戻っている途中 (path[0] へ戻り、heading の向きのまま止まる)
+                return {"state": "blocked", "edge": heading}
+            k = actions[:index].count("straight")
+            if k + 1 < len(path):
+                return {"state": "driving", "edge": (path[k], path[k + 1])}
+            return None
+        if self._last is None:
+            return {"state": "at_node", "node": path[0], "heading": heading}
+        # 止まった直後でも、ファームウェアは 500ms 待ってすぐ次の命令を始め、新しいプログラムはその後に読む。
+        # なので次のエッジを走っているものとして扱う
+        k = actions[:self._last + 1].count("straight")
+        if k + 1 < len(path):
+            return {"state": "driving", "edge": (path[k], path[k + 1])}
+        return None
+
+    def notify(self, event):
+        """テレメトリ以外の通知 (経路の引き直しなど) を購読者に送る。"""
+        self._publish(event, time.perf_counter())
+
+    def _publish(self, event, received):
+        event["type"] = "telemetry"
+        if self.program is not None:
+            event["elapsed_ms"] = round((received - self.program["started"]) * 1000, 1)
+        self.events.append(event)
+        for callback in list(self._subscribers):
+            callback(event)
+
+    def snapshot(self, recent=50):
+        """今の状態 (購読を始めたクライアントに最初に送る)。"""
+        program = self.program
+        return {
+            "type": "telemetry_state",
+            "program": None if program is None else {
+                "program_id": program["program_id"],
+                "steps": len(program["actions"]),
+                "path": program["path"]
+            },
+            "current_step": None if self._open is None else self._open[0],
+            "position": self.position(),
+            "segments": self.segments,
+            "distance": {f"dist{k}": v for k, v in self.distance.items()},
+            "stop_signals": self.stop_signals,
+            "recent": list(self.events)[-recent:]
+        }
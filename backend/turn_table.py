@@ -0,0 +1,173 @@
+import numpy as np
+
+# =========================
+# 曲がる向きの表 (ターンテーブル) と、経路 -> モーター命令のまとめて変換
+# =========================
+# decide_directions は経路ごとに座標の差分と外積を1つずつ計算している。
+# 道路網は変わらないので、(前のノード, 今のノード, 次のノード) の組ごとの向きを
+# グラフを読み込んだときに全部計算しておき、経路の変換は表を引くだけにする。
+# 表はノード cur ごとに 次数×次数 のブロックで、
+#   table[block_ptr[cur] + (prev の隣接番号) * 次数 + (next の隣接番号)]
+# が向き (STRAIGHT / RIGHT / LEFT)。番号はモーター ESP32 のコマンド番号と同じ。
+STRAIGHT = 0
+RIGHT = 1
+LEFT = 2
+ACTION_NAMES = np.array(["straight", "right", "left"], dtype=object)
+CROSS_EPS = 1e-5  # decide_directions と同じ「ほぼまっすぐ」の閾値
+# 向きごとに足す命令 (left/right の直後には straight を挟む)
+_TOKENS = tuple((name,) if code == STRAIGHT else (name, "straight") for code, name in enumerate(ACTION_NAMES))
+TURN_CACHE_MAX = 1 << 16  # compile_actions が覚えておく (prev, cur, next) の組の数
+TURN_BATCH_MIN = 64  # まだ引いていない組がこれ以上なら、lookup (numpy) でまとめて引く
+
+
+def _turn_codes(xy, prev, cur, nxt):
+    """座標から向きを計算する (decide_directions と同じ外積の判定)。"""
+    d1 = xy[cur] - xy[prev]
+    d2 = xy[nxt] - xy[cur]
+    cross = d1[:, 0] * d2[:, 1] - d1[:, 1] * d2[:, 0]
+    codes = np.where(cross > 0, LEFT, RIGHT).astype(np.int8)
+    codes[np.abs(cross) < CROSS_EPS] = STRAIGHT
+    return codes
+
+
+class TurnTable:
+    """CSRGraph の全ての (prev, cur, next) の組の向きを持つ表。"""
+
+    def __init__(self, csr):
+        self.csr = csr
+        n = csr.num_nodes
+        indptr = csr.indptr
+        degree = np.diff(indptr)
+        self.degree = degree
+        self.block_ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(degree * degree, out=self.block_ptr[1:])
+
+        # スロット k (cur -> x) の隣接番号と、x が prev のときに見るブロック内の行の先頭。
+        # (prev, cur, next) の向きは table[_row_base[cur -> prev] + _local[cur -> next]]
+        src = np.repeat(np.arange(n, dtype=np.int64), degree)
+        self._local = np.arange(len(csr.indices), dtype=np.int64) - indptr[src]
+        self._row_base = self.block_ptr[src] + self._local * degree[src]
+        self._turns = {}  # compile_actions で引いた (prev, cur, next) -> 向き
+
+        # ブロック内の全ての (i, j) の組について向きを計算する
+        cur = np.repeat(np.arange(n, dtype=np.int64), degree * degree)
+        local = np.arange(self.block_ptr[-1]) - self.block_ptr[cur]
+        deg = degree[cur]
+        prev = csr.indices[indptr[cur] + local // np.maximum(deg, 1)]
+        nxt = csr.indices[indptr[cur] + local % np.maximum(deg, 1)]
+        self.table = _turn_codes(csr.xy, prev, cur, nxt)
+        # turn() 用: memoryview の添字アクセスは Python の int をそのまま返すので速い
+        self._table_mv = memoryview(self.table)
+        self._block_ptr_mv = memoryview(self.block_ptr)
+
+    def nbytes(self):
+        return (self.block_ptr.nbytes + self.table.nbytes
+                + self._local.nbytes + self._row_base.nbytes)
+
+    def lookup(self, prev, cur, nxt):
+        """(prev, cur, next) の配列の向きを表から引く。エッジでない組は座標から計算する。"""
+        prev = np.asarray(prev, dtype=np.int64)
+        cur = np.asarray(cur, dtype=np.int64)
+        nxt = np.asarray(nxt, dtype=np.int64)
+        s_in = self.csr.slots(cur, prev)
+        s_out = self.csr.slots(cur, nxt)
+        ok = (s_in >= 0) & (s_out >= 0)
+        codes = np.empty(len(cur), dtype=np.int8)
+        codes[ok] = self.table[self._row_base[s_in[ok]] + self._local[s_out[ok]]]
+        if not ok.all():
+            bad = ~ok
+            codes[bad] = _turn_codes(self.csr.xy, prev[bad], cur[bad], nxt[bad])
+        return codes
+
+    def turn(self, prev, cur, nxt):
+        """lookup の1組版 (numpy を使わずに、cur の隣接を順に見て表を引く)。"""
+        csr = self.csr
+        indptr = csr._indptr_mv
+        indices = csr._indices_mv
+        lo, hi = indptr[cur], indptr[cur + 1]
+        i = j = -1
+        for k in range(lo, hi):
+            if indices[k] == prev:
+                i = k - lo
+            if indices[k] == nxt:
+                j = k - lo
+        if i >= 0 and j >= 0:
+            return self._table_mv[self._block_ptr_mv[cur] + i * (hi - lo) + j]
+        xy = csr._xy_mv
+        d1x, d1y = xy[2 * cur] - xy[2 * prev], xy[2 * cur + 1] - xy[2 * prev + 1]
+        d2x, d2y = xy[2 * nxt] - xy[2 * cur], xy[2 * nxt + 1] - xy[2 * cur + 1]
+        cross = d1x * d2y - d1y * d2x
+        if abs(cross) < CROSS_EPS:
+            return STRAIGHT
+        return LEFT if cross > 0 else RIGHT
+
+    def turn_from_heading(self, heading, cur, nxt):
+        """
+        heading = (a, b) の向きで cur にいる車が nxt へ向かうための命令 (まっすぐなら [])。
+        途中で経路を引き直したとき、前のノードがない (戻ってきた・Uターンする) 場合に使う。
+        真後ろなら right を2回 (その場で180度回る)。
+        """
+        xy = self.csr.xy
+        d1 = xy[heading[1]] - xy[heading[0]]
+        d2 = xy[nxt] - xy[cur]
+        cross = d1[0] * d2[1] - d1[1] * d2[0]
+        if abs(cross) < CROSS_EPS:
+            return [] if d1 @ d2 > 0 else ["right", "right"]
+        return ["left"] if cross > 0 else ["right"]
+
+    def compile_actions(self, paths):
+        """
+        整数インデックスの経路のリストを、まとめてモーター命令のリストに変換する。
+        decide_directions と同じ規則 (先頭に straight、left/right の直後に straight)。
+        向きは (prev, cur, next) の組ごとに覚えておき、まだ引いていない組だけを表から引く
+        (TURN_BATCH_MIN 組以上ならページ全体で1回の lookup でまとめて)。
+        """
+        turns = self._turns
+        if len(turns) > TURN_CACHE_MAX:
+            # 大きなマップで際限なく増えないように、いっぱいになったら作り直す
+            turns = self._turns = {}
+        triples = [list(zip(path, path[1:], path[2:])) for path in paths]
+        missing = list({t for path_triples in triples for t in path_triples if t not in turns})
+        if missing and len(missing) >= TURN_BATCH_MIN:
+            turns.update(zip(missing, self.lookup(*zip(*missing)).tolist()))
+        else:
+            for t in missing:
+                turns[t] = self.turn(*t)
+        result = []
+        for path_triples in triples:
+            actions = ["straight"] if path_triples else []
+            for code in map(turns.__getitem__, path_triples):
+                actions += _TOKENS[code]
+            result.append(actions)
+        return result
+
+    def compile_schedules(self, schedules, wait_step):
+        """
+        FleetPlanner の時刻表 [(ノード, 到着, 出発), ...] のリストを、まとめてモーター命令のリストに変換する。
+        compile_actions と同じ規則に、ノードで待つ wait_step ごとの stop (その場で止まる) と、
+        来た道を戻るところの Uターン (turn_from_heading の right 2回) を足したもの。
+        待ちも折り返しもない時刻表は compile_actions と同じ結果になる。
+        """
+        results = []
+        for schedule in schedules:
+            path = [v for v, _, _ in schedule]
+            waits = [0 if depart == float("inf") else int(round((depart - arrive) / wait_step))
+                     for _, arrive, depart in schedule]
+            codes = self.lookup(path[:-2], path[1:-1], path[2:]).tolist() if len(path) > 2 else []
+            actions = ["stop"] * waits[0]
+            if len(path) > 2 or (len(path) == 2 and waits[0]):
+                actions.append("straight")
+            for i in range(1, len(path) - 1):
+                actions += ["stop"] * waits[i]
+                prev, cur, nxt = path[i - 1], path[i], path[i + 1]
+                if prev == nxt:
+                    actions += self.turn_from_heading((prev, cur), cur, nxt)
+                elif codes[i - 1] != STRAIGHT:
+                    actions.append(ACTION_NAMES[codes[i - 1]])
+                actions.append("straight")
+            results.append(actions)
+        return results
+
+    def compile_commands(self, paths):
+        """compile_actions の結果をモーター ESP32 に送るカンマ区切りの文字列にする。"""
+        return [",".join(actions) for actions in self.compile_actions(paths)]
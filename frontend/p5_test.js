@@ -12,6 +12,7 @@ let obstacleConfirmed = false;
 let confirmButton;       // 「スタート確定」ボタン
 let backButton;          // 「戻る」ボタン
 let selectedEdges = [];  // 選択されたエッジ一覧
+let driving = false;     // 経路を確定して車が走っている間 true（障害物をクリックすると走行中の通行止めとして送る）
 
 // 受信した経路（既定経路）
 let receivedPath = null;
@@ -19,7 +20,10 @@ let receivedPath = null;
 // 複数候補の経路情報
 let candidatePaths = [];
 let candidateEdges = [];
+let candidateCosts = [];   // "k_shortest" のときの各候補のコスト
 let EdgesWeight = [];
+let nextCursor = null;     // 候補経路の続きを取りに行くときの cursor（null なら全部受信済み）
+let moreCandidatesButton;  // 「候補をさらに表示」ボタン
 
 // 候補経路選択用UI部品（線モード用）
 let candidateConfirmButton;
@@ -33,6 +37,13 @@ let candidateConfirmButtonBtn;  // モーダル内の候補確定ボタン
 // WebSocketオブジェクト
 let ws;
 
+// 候補経路の受け取り方 ("json": 従来の形 / "compact": ノード番号の木 / "binary": 木をバイナリフレームで)
+const CANDIDATE_ENCODING = "json";
+// 候補経路の選び方 ("shortest": 最短距離と同じ経路だけ / "k_shortest": 短い順に CANDIDATE_K 本)
+const CANDIDATE_MODE = "shortest";
+const CANDIDATE_K = 10;
+let mapTable = null;  // compact / binary のときの、ノード名とエッジ番号の表 ({"type": "map"} の応答)
+
 // カラーパレット（パステル調、黄色は除く）
 let candidatePalette = [
     '#ff9999', // パステルレッド
@@ -57,20 +68,53 @@ function setup() {
 
     // ===== WebSocket 接続 =====
     ws = new WebSocket('ws://localhost:8765');
+    ws.binaryType = 'arraybuffer';
     ws.onopen = (event) => {
         console.log('WebSocket 接続成功');
+        if (CANDIDATE_ENCODING !== "json") {
+            ws.send(JSON.stringify({ type: "map" }));
+        }
     };
     ws.onmessage = (event) => {
         console.log('サーバからのメッセージ:', event.data);
         try {
-            const msg = JSON.parse(event.data);
+            let msg = (event.data instanceof ArrayBuffer)
+                ? decodeBinaryCandidates(event.data)
+                : JSON.parse(event.data);
+            if (msg.type === "map") {
+                mapTable = buildMapTable(msg);
+                return;
+            }
+            if (msg.encoding === "compact" || msg.encoding === "binary") {
+                msg = expandCandidates(msg);
+            }
+            if (msg.type === "replan" || msg.kind === "replanned") {
+                // 走行中の通行止めで経路が引き直された（path が null なら goal に行けなくなった）
+                console.log('経路の引き直し:', msg);
+                if (msg.path) {
+                    receivedPath = msg.path;
+                } else if (msg.error) {
+                    console.error('サーバからエラー:', msg.error);
+                }
+                return;
+            }
             if (msg.error) {
                 console.error('サーバからエラー:', msg.error);
             } else if (msg.candidate_paths) {
                 console.log('受信した候補経路群:', msg.candidate_paths);
-                candidatePaths = msg.candidate_paths;
-                candidateEdges = msg.candidate_edges;
-                if (candidatePaths.length === 1) {
+                if (msg.cursor > 0) {
+                    // 続きのページなので後ろに追加する
+                    candidatePaths = candidatePaths.concat(msg.candidate_paths);
+                    candidateEdges = candidateEdges.concat(msg.candidate_edges);
+                    candidateCosts = candidateCosts.concat(msg.candidate_costs || []);
+                } else {
+                    candidatePaths = msg.candidate_paths;
+                    candidateEdges = msg.candidate_edges;
+                    candidateCosts = msg.candidate_costs || [];
+                }
+                nextCursor = (msg.next_cursor === undefined) ? null : msg.next_cursor;
+                updateMoreCandidatesButton();
+                if (candidatePaths.length === 1 && nextCursor === null) {
                     selectedCandidateIndex = 0;
                     receivedPath = candidatePaths[0];
                     console.log("候補経路が一個だけなので自動確定:", receivedPath);
@@ -148,6 +192,25 @@ function toggleSelectionMode() {
     }
 }
 
+function updateMoreCandidatesButton() {
+    // サーバ側にまだ候補経路が残っていれば「さらに表示」ボタンを出す
+    if (nextCursor === null) {
+        if (moreCandidatesButton) {
+            moreCandidatesButton.remove();
+            moreCandidatesButton = null;
+        }
+        return;
+    }
+    if (!moreCandidatesButton) {
+        moreCandidatesButton = createButton("候補をさらに表示");
+        moreCandidatesButton.parent("container");
+        moreCandidatesButton.position(420, 750);
+        moreCandidatesButton.mousePressed(() => {
+            ws.send(JSON.stringify({ cursor: nextCursor }));
+        });
+    }
+}
+
 function createCandidateSelectionUI() {
     // 線モードの場合の候補確定ボタン（既存の方法）
     if (candidateConfirmButton) candidateConfirmButton.remove();
@@ -197,7 +260,11 @@ function createCandidateModalUI() {
     candidateRouteButtons = []; // 初期化
     for (let i = 0; i < candidatePaths.length; i++) {
         let path = candidatePaths[i];
-        let btn = createButton("経路 " + (i + 1) + ": " + path.join(" → "));
+        let label = "経路 " + (i + 1) + ": " + path.join(" → ");
+        if (candidateCosts[i] !== undefined) {
+            label = "経路 " + (i + 1) + " (" + candidateCosts[i] + "): " + path.join(" → ");
+        }
+        let btn = createButton(label);
         btn.parent(buttonsContainer);
         // 各ボタンの最大幅を設定
         btn.style('max-width', '150px');
@@ -462,8 +529,11 @@ function confirmCandidateSelection() {
     let selectedPath = candidatePaths[selectedCandidateIndex];
     console.log("ユーザーが確定した候補経路:", selectedPath);
     ws.send(JSON.stringify({ selected_path: selectedPath }));
+    driving = true;
     candidatePaths = [];
     candidateEdges = [];
+    nextCursor = null;
+    updateMoreCandidatesButton();
     if (candidateModalDiv) {
         candidateModalDiv.remove();
         candidateModalDiv = null;
@@ -507,6 +577,16 @@ function mousePressed() {
                 break;
             }
         }
+    } else if (driving) {
+        // 走行中に見つかった通行止め: 車の今の位置から経路を引き直してもらう
+        for (let o of obstacles) {
+            if (dist(mouseX, mouseY, o.x, o.y) < 15 && !o.selected) {
+                o.selected = true;
+                updateSelectedEdges();
+                ws.send(JSON.stringify({ type: "block_edges", edges: [`${o.node1}-${o.node2}`] }));
+                break;
+            }
+        }
     }
 }
 
@@ -531,6 +611,13 @@ function confirmSelection() {
             goal: goalNodeLabel,
             remove_edges: selectedEdges
         };
+        if (CANDIDATE_ENCODING !== "json") {
+            dataToSend.encoding = CANDIDATE_ENCODING;
+        }
+        if (CANDIDATE_MODE !== "shortest") {
+            dataToSend.mode = CANDIDATE_MODE;
+            dataToSend.k = CANDIDATE_K;
+        }
         ws.send(JSON.stringify(dataToSend));
         console.log('サーバに送信:', dataToSend);
     }
@@ -539,6 +626,7 @@ function confirmSelection() {
 function goBack() {
     if (obstacleConfirmed) {
         obstacleConfirmed = false;
+        driving = false;
         confirmButton.html('障害物確定');
     } else if (goalSelected) {
         goalSelected = false;
@@ -551,4 +639,64 @@ function goBack() {
         startNodeLabel = null;
         confirmButton.html('スタート確定');
     }
-}
\ No newline at end of file
+}
+
+// ===== compact / binary 形式の候補経路を従来の形に戻す =====
+function buildMapTable(msg) {
+    let edgeOf = new Map();  // "u,v" -> エッジ番号
+    for (const [u, v, num] of msg.edges) {
+        edgeOf.set(u + "," + v, num);
+        edgeOf.set(v + "," + u, num);
+    }
+    return { names: msg.names, edgeOf: edgeOf, fingerprint: msg.fingerprint };
+}
+
+function decodeBinaryCandidates(buffer) {
+    // 0xA7, 版, ヘッダ長 (u16), ヘッダ (JSON), 4 バイト境界まで 0 埋め, parent / node / leaves (int32)
+    const view = new DataView(buffer);
+    if (view.getUint8(0) !== 0xA7) {
+        throw new Error('候補経路のフレームではありません');
+    }
+    const headerLen = view.getUint16(2, true);
+    const msg = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLen)));
+    let offset = 4 + headerLen;
+    offset += (4 - offset % 4) % 4;
+    const n = msg.trie_nodes;
+    msg.parent = new Int32Array(buffer, offset, n);
+    msg.node = new Int32Array(buffer, offset + 4 * n, n);
+    msg.leaves = new Int32Array(buffer, offset + 8 * n, msg.paths);
+    return msg;
+}
+
+function expandCandidates(msg) {
+    if (!mapTable || mapTable.fingerprint !== msg.fingerprint) {
+        console.warn('マップの表がサーバと一致していません');
+    }
+    // leaf から親をたどると start -> goal の順になる。エッジ番号は隣り合うノードの組から引く
+    let paths = [];
+    let edges = [];
+    for (const leaf of msg.leaves) {
+        let path = [];
+        let pathEdges = [];
+        let prev = -1;
+        for (let t = leaf; t >= 0; t = msg.parent[t]) {
+            const v = msg.node[t];
+            path.push(mapTable.names[v]);
+            const num = (prev >= 0) ? mapTable.edgeOf.get(prev + "," + v) : undefined;
+            if (num) {
+                pathEdges.push(num);
+            }
+            prev = v;
+        }
+        paths.push(path);
+        edges.push(pathEdges);
+    }
+    return {
+        candidate_paths: paths,
+        candidate_edges: edges,
+        cursor: msg.cursor,
+        candidate_costs: msg.candidate_costs,
+        next_cursor: msg.next_cursor,
+        total_paths: msg.total_paths
+    };
+}